@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'impelsurvey.settings')
+os.environ.setdefault('SURVEY_ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
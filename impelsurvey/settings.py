@@ -10,7 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
-from decouple import config
+from decouple import Csv, config
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'survey.middleware.PerformanceMiddleware',
+    'survey.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,11 +57,15 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'impelsurvey.urls'
 
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'survey.metrics.TimedDjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -67,12 +73,55 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # Templates are compiled once per process unless DEBUG is on
+            'loaders': TEMPLATE_LOADERS if DEBUG else [
+                ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+            ],
         },
     },
 ]
 
 WSGI_APPLICATION = 'impelsurvey.wsgi.application'
 
+# Serve the survey steps and the timeout API with async views, on by
+# default in impelsurvey.asgi
+SURVEY_ASYNC_VIEWS = config('SURVEY_ASYNC_VIEWS', default=False, cast=bool)
+
+# Size of the thread pool running the ORM calls of the async views, which
+# is also the maximum number of database connections per ASGI worker
+SURVEY_DB_THREADS = config('SURVEY_DB_THREADS', default=16, cast=int)
+
+# Directory shared by the worker processes to aggregate the request metrics
+# served by /metrics, in-process only if empty
+SURVEY_METRICS_DIR = config('SURVEY_METRICS_DIR', default='') or None
+
+# Where the archive_responses command moves the responses of the surveys
+# expired for more than SURVEY_ARCHIVE_AFTER_DAYS days
+SURVEY_ARCHIVE_DIR = config('SURVEY_ARCHIVE_DIR', default=str(BASE_DIR / 'archives'))
+SURVEY_ARCHIVE_AFTER_DAYS = config('SURVEY_ARCHIVE_AFTER_DAYS', default=365, cast=int)
+
+# Live dashboards: seconds between two updates, seconds a snapshot is
+# kept, long event streams (each holds a worker thread, off: one snapshot
+# by request) and their duration before the browser reconnects
+SURVEY_LIVE_INTERVAL = config('SURVEY_LIVE_INTERVAL', default=1.0, cast=float)
+SURVEY_LIVE_SNAPSHOT_SECONDS = config('SURVEY_LIVE_SNAPSHOT_SECONDS', default=60, cast=int)
+SURVEY_LIVE_LONG_STREAMS = config('SURVEY_LIVE_LONG_STREAMS', default=False, cast=bool)
+SURVEY_LIVE_STREAM_SECONDS = config('SURVEY_LIVE_STREAM_SECONDS', default=300, cast=int)
+
+# Warm the web workers up at startup (URLs, templates and the question sets
+# of the SURVEY_WARMUP_SURVEYS newest open surveys), see survey.warmup
+SURVEY_WARMUP = config('SURVEY_WARMUP', default=False, cast=bool)
+SURVEY_WARMUP_SURVEYS = config('SURVEY_WARMUP_SURVEYS', default=50, cast=int)
+
+# Accept the final submissions into a buffer table saved in batches by the
+# flush_submissions command, see survey.buffer
+SURVEY_WRITE_BEHIND = config('SURVEY_WRITE_BEHIND', default=False, cast=bool)
+
+# Full-text search of the text answers: hits by page, and number of newest
+# matches ranked by query (0 ranks them all), see survey.search
+SURVEY_SEARCH_PER_PAGE = config('SURVEY_SEARCH_PER_PAGE', default=20, cast=int)
+SURVEY_SEARCH_MAX_RANKED = config('SURVEY_SEARCH_MAX_RANKED', default=1000, cast=int)
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
@@ -84,7 +133,46 @@ DATABASES = {
         'USER': config('DATABASE_USER', default=''),
         'PASSWORD': config('DATABASE_PASSWORD', default=''),
         'HOST': config('DATABASE_HOST', default=''),
-        'PORT': 5432,
+        'PORT': config('DATABASE_PORT', default='5432'),
+        # Keep the connections open across requests for this many seconds,
+        # 0 to close them after each request (e.g. behind PgBouncer)
+        'CONN_MAX_AGE': config('DATABASE_CONN_MAX_AGE', default=60, cast=int),
+        # Server-side cursors don't work through a transaction pooler
+        'DISABLE_SERVER_SIDE_CURSORS': config('DATABASE_POOLER', default=False, cast=bool),
+    }
+}
+
+# Read replicas, comma separated hosts (file names with SQLite). The read
+# heavy pages read from them, see survey.db.
+for index, replica in enumerate(config('DATABASE_REPLICAS', default='', cast=Csv()), 1):
+    DATABASES[f'replica{index}'] = dict(
+        DATABASES['default'],
+        **{'NAME' if 'sqlite' in DATABASES['default']['ENGINE'] else 'HOST': replica},
+        TEST={'MIRROR': 'default'},
+    )
+
+DATABASE_ROUTERS = ['survey.db.ReplicaRouter']
+
+SURVEY_DB_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# Seconds the clients read from the primary after writing, so they see
+# their writes despite the replication lag
+SURVEY_REPLICA_PIN_SECONDS = config('SURVEY_REPLICA_PIN_SECONDS', default=10, cast=int)
+
+# Check that the persistent connections still work at the start of each
+# request and reconnect if they don't
+SURVEY_DB_HEALTH_CHECKS = config('SURVEY_DB_HEALTH_CHECKS', default=True, cast=bool)
+
+
+# Cache
+# The survey schema versions, the participations and the live dashboards
+# are shared by the workers through the default cache: with several worker
+# processes it must be a shared backend (Memcached, DatabaseCache...), the
+# per-process default only suits a single process, see survey.checks
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
     }
 }
 
@@ -1,6 +1,80 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.forms.models import BaseInlineFormSet
+from django.http import Http404, HttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
 
-from survey.models import Answer, Question, Response, Survey
+from survey.db import read_replica
+from survey.definitions import (
+    dumps, export_definition, get_format, import_definition, loads)
+from survey.models import Answer, Question, QuestionType, Response, Survey
+from survey.search import highlight, search_answers
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the row estimate of PostgreSQL instead of COUNT(*) for
+    unfiltered lists of big tables.
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == "postgresql" and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.estimate_threshold:
+                return int(row[0])
+        return super().count
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    Filter typed in a text input, for relations with too many objects to
+    be listed in the sidebar.
+    """
+    template = "admin/survey/input_filter.html"
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        # The other filters, kept as hidden inputs
+        yield {
+            "query_parts": [
+                (key, value)
+                for key, value in changelist.get_filters_params().items()
+                if key != self.parameter_name
+            ],
+        }
+
+
+class SurveyInputFilter(InputFilter):
+    title = "survey (id or title)"
+    parameter_name = "survey"
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if not value:
+            return queryset
+        if value.isdigit():
+            return queryset.filter(survey_id=int(value))
+        return queryset.filter(survey__title__icontains=value)
 
 
 class QuestionInline(admin.StackedInline):
@@ -8,10 +82,199 @@ class QuestionInline(admin.StackedInline):
     extra = 1
 
 
+class DefinitionImportForm(forms.Form):
+    definition = forms.FileField(help_text="JSON or YAML survey definition.")
+    survey = forms.IntegerField(
+        required=False,
+        help_text="Id of the survey to update, empty to create a new survey.")
+    force = forms.BooleanField(
+        required=False,
+        help_text="Delete the answered questions missing from the "
+                  "definition, with their answers.")
+
+    def clean_survey(self):
+        survey_id = self.cleaned_data["survey"]
+        if survey_id is None:
+            return None
+        survey = Survey.objects.filter(pk=survey_id).first()
+        if survey is None:
+            raise ValidationError(f"Survey {survey_id} doesn't exist.")
+        return survey
+
+
+class AnswerSearchForm(forms.Form):
+    q = forms.CharField(label="Words", required=False)
+    question = forms.ModelChoiceField(
+        queryset=Question.objects.none(), required=False,
+        empty_label="All the text questions")
+
+    def __init__(self, *args, survey, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["question"].queryset = survey.questions.filter(
+            question_type=QuestionType.TEXT)
+
+
 class SurveyAdmin(admin.ModelAdmin):
-    list_display = ("title", "duration", "created_by", "created_at", "total_responses")
-    list_filter = ("created_by", "created_at")
+    list_display = ("title", "duration", "created_by", "created_at",
+                    "total_responses", "live_dashboard")
+    list_filter = (
+        "is_active", ("created_by", admin.RelatedOnlyFieldListFilter),
+        "created_at")
+    list_select_related = ("created_by", "tally")
     inlines = [QuestionInline]
+    actions = ["export_definitions"]
+    change_list_template = "admin/survey/survey/change_list.html"
+    change_form_template = "admin/survey/survey/change_form.html"
+
+    @read_replica
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, extra_context)
+
+    @admin.display(description="Live")
+    def live_dashboard(self, obj):
+        return format_html('<a href="{}">Watch</a>',
+                           reverse("survey-live", args=[obj.pk]))
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Keep the positions contiguous, as shown in the inline
+        form.instance.renumber_questions()
+
+    @admin.action(
+        description="Export the definitions of the selected surveys (JSON)")
+    def export_definitions(self, request, queryset):
+        definitions = [export_definition(survey) for survey in queryset]
+        content = dumps(
+            definitions[0] if len(definitions) == 1 else definitions)
+        response = HttpResponse(content, content_type="application/json")
+        response["Content-Disposition"] = 'attachment; filename="surveys.json"'
+        return response
+
+    def get_urls(self):
+        return [
+            path("import/", self.admin_site.admin_view(self.import_view),
+                 name="survey_survey_import"),
+            path("<path:object_id>/search/",
+                 self.admin_site.admin_view(self.search_view),
+                 name="survey_survey_search"),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """
+        Create or update a survey from an uploaded definition.
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = DefinitionImportForm(
+            request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            upload = form.cleaned_data["definition"]
+            try:
+                definition = loads(
+                    upload.read().decode("utf-8"), get_format(upload.name))
+                result = import_definition(
+                    definition, user=request.user,
+                    survey=form.cleaned_data["survey"],
+                    force=form.cleaned_data["force"])
+            except UnicodeDecodeError:
+                form.add_error(
+                    "definition", "The definition must be UTF-8 encoded.")
+            except ValidationError as error:
+                form.add_error("definition", error)
+            else:
+                self.message_user(
+                    request,
+                    f"Survey '{result.survey}': {result.created} questions "
+                    f"created, {result.updated} updated, "
+                    f"{result.deleted} deleted, {len(result.kept)} kept, "
+                    f"{result.unchanged} unchanged "
+                    f"in {sum(result.timings.values()):.2f}s.",
+                    messages.SUCCESS)
+                if result.kept:
+                    self.message_user(
+                        request,
+                        "Questions with answers kept, import again with "
+                        "'Force' to delete them: " + ", ".join(
+                            f"'{question.text}'" for question in result.kept),
+                        messages.WARNING)
+                return redirect(reverse(
+                    "admin:survey_survey_change", args=[result.survey.pk]))
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            form=form,
+            title="Import a survey definition",
+        )
+        return TemplateResponse(
+            request, "admin/survey/survey/import.html", context)
+
+    @read_replica
+    def search_view(self, request, object_id):
+        """
+        Search the answers to the text questions of a survey, best matches
+        first, see survey.search.
+        """
+        survey = self.get_object(request, object_id)
+        if survey is None:
+            raise Http404
+        if not self.has_view_permission(request, survey):
+            raise PermissionDenied
+        form = AnswerSearchForm(request.GET or None, survey=survey)
+        results = hits = None
+        pages = {}
+        if form.is_valid() and form.cleaned_data["q"]:
+            question = form.cleaned_data["question"]
+            try:
+                page = int(request.GET.get("page", 1))
+            except ValueError:
+                page = 1
+            results = search_answers(
+                form.cleaned_data["q"], survey_id=survey.pk,
+                question_id=question.pk if question else None, page=page)
+            questions = dict(survey.questions.values_list("pk", "text"))
+            hits = [
+                {"hit": hit, "question": questions.get(hit.question_id),
+                 "highlight": highlight(hit.snippet)}
+                for hit in results.hits
+            ]
+            if results.page > 1:
+                pages["previous"] = self.get_page_query(
+                    request, results.page - 1)
+            if results.has_next:
+                pages["next"] = self.get_page_query(request, results.page + 1)
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            original=survey,
+            form=form,
+            results=results,
+            hits=hits,
+            pages=pages,
+            title=f"Search the answers of {survey}",
+        )
+        return TemplateResponse(
+            request, "admin/survey/survey/search.html", context)
+
+    @staticmethod
+    def get_page_query(request, page):
+        params = request.GET.copy()
+        params["page"] = page
+        return params.urlencode()
+
+
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """
+    Inline formset showing one page of the related objects.
+    """
+    per_page = 50
+    page_number = 1
+
+    def get_queryset(self):
+        if not hasattr(self, "page"):
+            paginator = Paginator(super().get_queryset(), self.per_page)
+            self.page = paginator.get_page(self.page_number)
+            self._queryset = self.page.object_list
+        return self._queryset
 
 
 class AnswerBaseInline(admin.StackedInline):
@@ -19,16 +282,40 @@ class AnswerBaseInline(admin.StackedInline):
     readonly_fields = ("question",)
     extra = 0
     model = Answer
+    formset = PaginatedInlineFormSet
+    template = "admin/survey/paginated_inline.html"
+    page_parameter = "answers_page"
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("question")
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.page_number = request.GET.get(self.page_parameter, 1)
+        formset.page_parameter = self.page_parameter
+        return formset
 
 
 class ResponseAdmin(admin.ModelAdmin):
     list_display = ("survey", "created_at", "user", "response_type")
-    list_filter = ("survey", "response_type", "created_at")
-    date_hierarchy = "created_at"
+    list_filter = (SurveyInputFilter, "response_type", "created_at")
+    list_select_related = ("survey", "user")
+    # No date_hierarchy: its drill-down reads the distinct dates of the
+    # whole table on each load, the created_at filter doesn't
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = [AnswerBaseInline]
     # specifies the order as well as which fields to act on
     readonly_fields = ("survey", "created_at", "updated_at","user")
 
+    @read_replica
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, extra_context)
+
+    def get_queryset(self, request):
+        # Also used by the change view to show the survey and the user
+        return super().get_queryset(request).select_related("survey", "user")
+
 
 admin.site.register(Survey, SurveyAdmin)
 admin.site.register(Response, ResponseAdmin)
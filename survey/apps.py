@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class SurveyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'survey'
+
+    def ready(self):
+        # Connect signal handlers
+        from django.core.signals import request_started
+
+        from survey import checks, signals  # noqa: F401
+        from survey.db import check_connections
+        request_started.connect(check_connections)
+
+        if getattr(settings, "SURVEY_WARMUP", False):
+            from survey.warmup import warm_up
+            warm_up()
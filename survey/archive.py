@@ -0,0 +1,366 @@
+"""
+Archival of the responses of long expired surveys.
+
+archive_survey() moves the responses and answers of a survey into a gzip
+JSON lines file in SURVEY_ARCHIVE_DIR and deletes them from the database.
+The first line of the file describes the archive and the survey (its
+definition, see survey.definitions), then each line is a response with its
+answers, as stored:
+
+    {"id": 12, "user_id": 3, "user": "jdoe", "response_type": "submitted",
+     "created_at": "...", "updated_at": "...",
+     "answers": [{"id": 40, "question_id": 7, "body": "...",
+                  "created": "...", "updated": "..."}]}
+
+The file is read back and checked before anything is deleted. The tallies
+are kept, so the results of the survey don't change. ArchiveReader reads an
+archive, the exports read the archived responses transparently, and
+restore_survey() moves them back to the database.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, router, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from survey.definitions import export_definition
+from survey.models import Answer, AnswerChoice, Response, Survey, SurveyArchive
+from survey.schema import get_compiled_survey
+
+LOGGER = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT = "impel-survey-archive"
+ARCHIVE_VERSION = 1
+CHUNK_SIZE = 2000
+BATCH_SIZE = 500
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def get_archive_dir():
+    return getattr(settings, "SURVEY_ARCHIVE_DIR",
+                   os.path.join(settings.BASE_DIR, "archives"))
+
+
+def get_retention():
+    return timedelta(days=getattr(settings, "SURVEY_ARCHIVE_AFTER_DAYS", 365))
+
+
+def get_archivable_surveys(retention=None):
+    """
+    Return the surveys expired for longer than the retention, not archived
+    yet and with responses in the database.
+
+    :param timedelta retention: SURVEY_ARCHIVE_AFTER_DAYS by default.
+    """
+    retention = get_retention() if retention is None else retention
+    return Survey.objects.filter(
+        expire_date__lt=timezone.now() - retention, archive__isnull=True,
+    ).filter(
+        Exists(Response.objects.filter(survey=OuterRef("pk"))),
+    ).order_by("pk")
+
+
+def iter_archive_records(survey_id, chunk_size=CHUNK_SIZE):
+    """
+    Yield the archive records of the responses of a survey, ordered by id.
+    """
+    responses = Response.objects.filter(
+        survey_id=survey_id).order_by("pk").values_list(
+        "pk", "user_id", "user__username", "response_type", "created_at",
+        "updated_at"
+    ).iterator(chunk_size=chunk_size)
+    answers = Answer.objects.filter(response__survey_id=survey_id).order_by(
+        "response_id", "pk").values_list(
+        "response_id", "pk", "question_id", "body", "created", "updated"
+    ).iterator(chunk_size=chunk_size)
+
+    answer = next(answers, None)
+    for (response_id, user_id, username, response_type, created_at,
+         updated_at) in responses:
+        record = {
+            "id": response_id,
+            "user_id": user_id,
+            "user": username,
+            "response_type": response_type,
+            "created_at": created_at.isoformat(),
+            "updated_at": updated_at.isoformat(),
+            "answers": [],
+        }
+        while answer is not None and answer[0] < response_id:
+            answer = next(answers, None)
+        while answer is not None and answer[0] == response_id:
+            record["answers"].append({
+                "id": answer[1],
+                "question_id": answer[2],
+                "body": answer[3],
+                "created": answer[4].isoformat(),
+                "updated": answer[5].isoformat(),
+            })
+            answer = next(answers, None)
+        yield record
+
+
+class ArchiveReader:
+    """
+    Read-only access to an archive file.
+
+    :param str path: The archive file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            try:
+                self.header = json.loads(file.readline())
+            except ValueError:
+                self.header = None
+        if (not isinstance(self.header, dict)
+                or self.header.get("format") != ARCHIVE_FORMAT):
+            raise ArchiveError(f"{path} is not a survey archive")
+        if self.header["version"] > ARCHIVE_VERSION:
+            raise ArchiveError(
+                f"Unsupported archive version {self.header['version']}")
+
+    @property
+    def survey(self):
+        """
+        The definition of the survey, with its id.
+        """
+        return self.header["survey"]
+
+    def __iter__(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            file.readline()
+            for line in file:
+                yield json.loads(line)
+
+    def responses(self, user=None, response_type=None):
+        """
+        Yield the archived responses, optionally filtered.
+
+        :param user: A username or a user id.
+        :param str response_type: A ResponseType.
+        """
+        for record in self:
+            if user is not None and user not in (
+                    record["user"], record["user_id"]):
+                continue
+            if (response_type is not None
+                    and record["response_type"] != response_type):
+                continue
+            yield record
+
+    def get(self, response_id):
+        """
+        Return an archived response by id, None if it isn't in the archive.
+        """
+        for record in self:
+            if record["id"] == response_id:
+                return record
+        return None
+
+
+def open_archive(survey):
+    """
+    Return the ArchiveReader of a survey, None if it isn't archived.
+
+    :param survey: A Survey or a survey id.
+    """
+    archive = SurveyArchive.objects.filter(
+        survey_id=getattr(survey, "pk", survey)).first()
+    return ArchiveReader(archive.path) if archive else None
+
+
+def write_archive(survey, path, chunk_size=CHUNK_SIZE):
+    """
+    Write the responses of a survey to an archive file.
+
+    :rtype: tuple (responses count, answers count, last response id)
+    """
+    header = {
+        "format": ARCHIVE_FORMAT,
+        "version": ARCHIVE_VERSION,
+        "archived_at": timezone.now().isoformat(),
+        "survey": dict(id=survey.pk, **export_definition(survey)),
+    }
+    responses = answers = 0
+    last_id = None
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        file.write(json.dumps(header) + "\n")
+        for record in iter_archive_records(survey.pk, chunk_size=chunk_size):
+            file.write(json.dumps(record) + "\n")
+            responses += 1
+            answers += len(record["answers"])
+            last_id = record["id"]
+    return responses, answers, last_id
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(partial(file.read, 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def archive_survey(survey, directory=None, chunk_size=CHUNK_SIZE):
+    """
+    Move the responses of a survey to an archive file.
+
+    :param Survey survey: The survey, not archived yet.
+    :param str directory: SURVEY_ARCHIVE_DIR by default.
+    :rtype: SurveyArchive
+    :raises ArchiveError: If the survey is already archived or the archive
+        doesn't match the database, nothing is deleted then.
+    """
+    if SurveyArchive.objects.filter(survey=survey).exists():
+        raise ArchiveError(f"Survey {survey.pk} is already archived")
+    start = time.perf_counter()
+    directory = directory or get_archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.abspath(
+        os.path.join(directory, f"survey-{survey.pk}.jsonl.gz"))
+    temporary = path + ".tmp"
+    try:
+        responses, answers, last_id = write_archive(
+            survey, temporary, chunk_size)
+        # Read the file back before deleting anything
+        read = sum(1 for _ in ArchiveReader(temporary))
+        if read != responses:
+            raise ArchiveError(
+                f"Read {read} responses back from {temporary}, "
+                f"{responses} written")
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+    with transaction.atomic():
+        archived = Response.objects.filter(survey=survey, pk__lte=last_id or 0)
+        if archived.count() != responses:
+            os.remove(path)
+            raise ArchiveError(
+                f"The responses of survey {survey.pk} changed while "
+                "archiving")
+        AnswerChoice.objects.filter(response__in=archived).delete()
+        Answer.objects.filter(response__in=archived).delete()
+        # Deleted in SQL: the archived responses still are participations,
+        # the delete signals must not forget them.
+        connection = connections[router.db_for_write(Response)]
+        table = connection.ops.quote_name(Response._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE survey_id = %s AND id <= %s",
+                [survey.pk, last_id or 0])
+        archive = SurveyArchive.objects.create(
+            survey=survey, path=path, responses=responses, answers=answers,
+            size=os.path.getsize(path), sha256=_sha256(path))
+    LOGGER.info(
+        "Archived %s responses and %s answers of survey %s to %s "
+        "(%s bytes) in %.2fs", responses, answers, survey.pk, path,
+        archive.size, time.perf_counter() - start)
+    return archive
+
+
+def _parse(value):
+    return parse_datetime(value) if value else None
+
+
+def restore_survey(survey):
+    """
+    Move the archived responses of a survey back to the database, with
+    their ids and dates, and delete the archive. Answers to questions
+    deleted since are dropped.
+
+    :param Survey survey: An archived survey.
+    :rtype: tuple (responses count, answers count)
+    :raises ArchiveError: If the survey isn't archived or the archive file
+        was modified.
+    """
+    archive = SurveyArchive.objects.filter(survey=survey).first()
+    if archive is None:
+        raise ArchiveError(f"Survey {survey.pk} isn't archived")
+    if _sha256(archive.path) != archive.sha256:
+        raise ArchiveError(f"{archive.path} doesn't match its checksum")
+    reader = ArchiveReader(archive.path)
+    questions = get_compiled_survey(survey.pk).questions_by_id
+    user_ids = set(User.objects.values_list("pk", flat=True).filter(
+        pk__in={record["user_id"] for record in reader if record["user_id"]}))
+
+    restored = answers_count = 0
+    with transaction.atomic():
+        batch = []
+        for record in reader:
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                answers_count += _restore_batch(
+                    survey, batch, questions, user_ids)
+                restored += len(batch)
+                batch = []
+        if batch:
+            answers_count += _restore_batch(
+                survey, batch, questions, user_ids)
+            restored += len(batch)
+        archive.delete()
+        transaction.on_commit(partial(os.remove, archive.path))
+    LOGGER.info("Restored %s responses of survey %s from %s",
+                restored, survey.pk, archive.path)
+    return restored, answers_count
+
+
+def _insert_raw(model, objs):
+    # Raw inserts keep the dates of the archive instead of the auto_now
+    # ones, like loaddata
+    fields = model._meta.concrete_fields
+    connection = connections[router.db_for_write(model)]
+    batch_size = min(
+        BATCH_SIZE, connection.ops.bulk_batch_size(fields, objs) or BATCH_SIZE)
+    for start in range(0, len(objs), batch_size):
+        model._base_manager._insert(
+            objs[start:start + batch_size], fields=fields, raw=True,
+            using=connection.alias)
+
+
+def _restore_batch(survey, records, questions, user_ids):
+    responses = []
+    answers = []
+    choices = []
+    for record in records:
+        response = Response(
+            pk=record["id"], survey=survey,
+            response_type=record["response_type"],
+            user_id=(record["user_id"] if record["user_id"] in user_ids
+                     else None),
+            created_at=_parse(record["created_at"]),
+            updated_at=_parse(record["updated_at"]))
+        responses.append(response)
+        for data in record["answers"]:
+            question = questions.get(data["question_id"])
+            if question is None:
+                continue
+            answers.append(Answer(
+                pk=data["id"], response_id=response.pk,
+                question_id=question.pk, body=data["body"],
+                created=_parse(data["created"]),
+                updated=_parse(data["updated"])))
+            choices.extend(
+                AnswerChoice(response_id=response.pk, question_id=question.pk,
+                             choice=choice)
+                for choice in question.get_answer_choices(data["body"]))
+    _insert_raw(Response, responses)
+    _insert_raw(Answer, answers)
+    AnswerChoice.objects.bulk_create(choices, batch_size=BATCH_SIZE)
+    return len(answers)
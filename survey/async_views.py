@@ -0,0 +1,72 @@
+"""
+Async versions of the survey step, submit and timeout endpoints, used when
+SURVEY_ASYNC_VIEWS is on (the default of impelsurvey.asgi).
+
+They share the logic of the sync views: the ORM work runs in the bounded
+thread pool of survey.asyncdb while the event loop only waits for it, and
+the templates are rendered on the event loop.
+"""
+import logging
+from functools import wraps
+
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.http import HttpResponseNotAllowed
+from django.shortcuts import redirect, render, reverse
+
+from survey.asyncdb import get_user, load_session, run_cache, run_db
+from survey.participation import get_cached_participation
+from survey.views import SurveyDetail, save_timeout
+
+LOGGER = logging.getLogger(__name__)
+
+
+def async_staff_member_required(view_func):
+    """
+    Async equivalent of staff_member_required.
+    """
+
+    @wraps(view_func)
+    async def _wrapped_view(request, *args, **kwargs):
+        await load_session(request)
+        user = await run_db(get_user, request)
+        if not (user.is_active and user.is_staff):
+            return redirect_to_login(
+                request.get_full_path(), reverse("admin:login"))
+        return await view_func(request, *args, **kwargs)
+
+    return _wrapped_view
+
+
+@async_staff_member_required
+async def survey_detail(request, id, step=0):
+    """
+    Show and submit a step of a survey.
+    """
+    if request.method not in ("GET", "POST"):
+        return HttpResponseNotAllowed(["GET", "POST"])
+
+    # Answered surveys are redirected without touching the database when
+    # the participation is cached
+    if request.method == "GET" and await run_cache(
+            cache, get_cached_participation, request.user.pk, id):
+        return redirect(reverse("survey-participated"))
+
+    view = SurveyDetail()
+    await run_db(view.setup, request, id=id, step=step)
+    if request.method == "POST":
+        return await run_db(view.post, request, id=id, step=step)
+
+    if view.survey_status in ['participated', 'timeout']:
+        return redirect(reverse("survey-participated"))
+    form = await run_db(view.get_form, request)
+    return render(request, "survey/survey.html", view.get_context_data(form))
+
+
+@async_staff_member_required
+async def timeout(request, id):
+    """
+    API endpoint for saving user input from session of a survey when
+    the survey time is out.
+    """
+    return await run_db(save_timeout, request, id)
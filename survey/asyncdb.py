@@ -0,0 +1,109 @@
+"""
+Helpers for the async views.
+
+The ORM is synchronous, so async views hand every blocking call to
+run_db(), which runs it in a thread pool of SURVEY_DB_THREADS threads. Each
+thread keeps its own database connection, so the pool size also caps the
+number of connections opened by an ASGI worker, however many requests are
+waiting on the event loop.
+
+Cache and session accesses go through the same pool unless the backend is
+in-process (local memory cache, signed cookie sessions), in which case they
+run directly on the event loop.
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import close_old_connections
+
+from survey.db import check_connections
+
+NON_BLOCKING_CACHES = (LocMemCache, DummyCache)
+NON_BLOCKING_SESSION_ENGINES = (
+    "django.contrib.sessions.backends.signed_cookies",
+)
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_pool_size():
+    return getattr(settings, "SURVEY_DB_THREADS", 16)
+
+
+def get_executor():
+    """
+    Return the thread pool running the blocking calls of the async views.
+    """
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_pool_size(),
+                    thread_name_prefix="survey-db")
+    return _executor
+
+
+def _call(func, args, kwargs):
+    # Same connection handling as the request_started/request_finished
+    # signals of a sync request, per pool thread.
+    close_old_connections()
+    check_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run a blocking function in the database thread pool and return its
+    result.
+    """
+    loop = asyncio.get_running_loop()
+    # Keep the context variables of the request, e.g. its metrics
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(), partial(context.run, _call, func, args, kwargs))
+
+
+def is_non_blocking_cache(cache):
+    return isinstance(cache, NON_BLOCKING_CACHES)
+
+
+async def run_cache(cache, func, *args, **kwargs):
+    """
+    Run a function using a cache, on the event loop if the cache is
+    in-process, else in the database thread pool.
+    """
+    if is_non_blocking_cache(cache):
+        return func(*args, **kwargs)
+    return await run_db(func, *args, **kwargs)
+
+
+async def load_session(request):
+    """
+    Load the session of a request so later accesses don't block the event
+    loop.
+    """
+    if settings.SESSION_ENGINE in NON_BLOCKING_SESSION_ENGINES:
+        request.session.keys()
+    else:
+        await run_db(request.session.keys)
+
+
+def get_user(request):
+    """
+    Return the user of a request, loading it from the session. Blocking.
+    """
+    user = request.user
+    # Evaluate the lazy object while we are in the pool
+    user.is_authenticated
+    return user
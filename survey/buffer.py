@@ -0,0 +1,117 @@
+"""
+Write-behind buffer of the final submissions.
+
+When a survey closes, many respondents submit at once and each submission
+saving its response, answers, choices and tallies in its own transaction
+contends on the same tables. With SURVEY_WRITE_BEHIND on, a valid final
+submission is only stored as a PendingSubmission row (one insert) and
+acknowledged, and the flush_submissions command saves the pending
+submissions in batches with persist_responses, one transaction by batch.
+
+A pending submission counts as a participation (see
+survey.participation.has_participated) and finalizes the attempt of the
+user, so the finalize_expired_attempts command leaves it alone. The
+responses are dated when they are flushed.
+"""
+import json
+import logging
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+from survey import inbox
+from survey.models import PendingSubmission, ResponseType
+from survey.participation import set_participated
+from survey.persistence import (
+    Submission, clean_values, finalize_attempts, persist_responses)
+from survey.schema import get_compiled_survey
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return getattr(settings, "SURVEY_WRITE_BEHIND", False)
+
+
+def _accept(user_id, survey_id):
+    set_participated(user_id, survey_id)
+    inbox.remove_entry(user_id, survey_id)
+
+
+def enqueue(form):
+    """
+    Store the answers of a valid ResponseForm as a pending submission,
+    instead of saving the response.
+
+    :param ResponseForm form: A valid form with all the answers.
+    :rtype: PendingSubmission
+    :raises IntegrityError: if the user already has a pending submission.
+    """
+    response_type = form.session_data.get(
+        "response_type", ResponseType.SUBMITTED)
+    with transaction.atomic():
+        pending = PendingSubmission.objects.create(
+            survey=form.survey, user=form.user, response_type=response_type,
+            values=json.dumps(form.cleaned_data, cls=DjangoJSONEncoder))
+        finalize_attempts(form.survey.pk, [form.user.pk])
+        transaction.on_commit(partial(_accept, form.user.pk, form.survey.pk))
+    return pending
+
+
+def flush_batch(batch_size=500):
+    """
+    Save a batch of pending submissions as responses, oldest first, and
+    delete them, in one transaction.
+
+    :rtype: tuple (number of pending submissions flushed, number of
+        responses created)
+    """
+    with transaction.atomic():
+        pending = PendingSubmission.objects.order_by("pk")
+        if connection.features.has_select_for_update_skip_locked:
+            # Let concurrent flushers work on other submissions
+            pending = pending.select_for_update(skip_locked=True)
+        pending = list(pending[:batch_size])
+        if not pending:
+            return 0, 0
+
+        by_survey = defaultdict(list)
+        for submission in pending:
+            by_survey[submission.survey_id].append(submission)
+        created = 0
+        for survey_id, submissions in by_survey.items():
+            questions = get_compiled_survey(survey_id).questions_by_id
+            # Users with a response already, e.g. saved by another path,
+            # are skipped
+            responses = persist_responses(survey_id, [
+                Submission(
+                    submission.user_id, submission.response_type,
+                    clean_values(questions, json.loads(submission.values)))
+                for submission in submissions
+            ])
+            created += len(responses)
+        PendingSubmission.objects.filter(
+            pk__in=[submission.pk for submission in pending]).delete()
+    return len(pending), created
+
+
+def flush_submissions(batch_size=500):
+    """
+    Flush all the pending submissions, batch by batch.
+
+    :rtype: tuple (number of pending submissions flushed, number of
+        responses created)
+    """
+    total_flushed = total_created = 0
+    while True:
+        flushed, created = flush_batch(batch_size)
+        if not flushed:
+            break
+        total_flushed += flushed
+        total_created += created
+        LOGGER.info("Flushed %s pending submissions, %s responses created",
+                    flushed, created)
+    return total_flushed, total_created
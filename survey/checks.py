@@ -0,0 +1,36 @@
+"""
+System checks of the deployment, run by "manage.py check --deploy".
+"""
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Backends keeping their data in each process
+LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def is_cache_shared():
+    """
+    Return True if the default cache is shared by the worker processes.
+    """
+    return settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHES
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    The schema versions (survey.schema) and the live dashboard changes
+    (survey.live) are published through the default cache: with a cache per
+    process, the other workers never see them.
+    """
+    if is_cache_shared():
+        return []
+    return [Warning(
+        "The default cache is local to each process, the workers would serve "
+        "stale survey schemas and live dashboards.",
+        hint="Set CACHE_BACKEND and CACHE_LOCATION to a cache shared by "
+             "all the workers, e.g. Memcached or the database cache.",
+        id="survey.W001",
+    )]
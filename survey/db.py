@@ -0,0 +1,164 @@
+"""
+Database connections: read replicas and health checks.
+
+ReplicaRouter sends the reads of the survey models to a replica (one of
+SURVEY_DB_REPLICAS, at random) inside use_replica() blocks or views
+decorated with read_replica, and everything else to the primary. The reads
+stay on the primary:
+
+- outside of these blocks, e.g. for the respondent flow (steps, submit,
+  confirmation),
+- in a transaction on the primary, and after a write in the same request,
+- for the clients who wrote recently: ReplicaPinMiddleware pins them to the
+  primary for SURVEY_REPLICA_PIN_SECONDS with a cookie, so they read their
+  own writes despite the replication lag.
+
+Sessions, users and the other contrib models always use the primary.
+
+check_connections() replaces the persistent connections (CONN_MAX_AGE)
+which stopped working, e.g. after a database restart, before a request uses
+them.
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpRequest
+
+PIN_COOKIE = "survey_primary"
+REPLICA_APPS = ("survey",)
+
+_use_replica = contextvars.ContextVar("survey_use_replica", default=False)
+_request_state = contextvars.ContextVar(
+    "survey_db_request_state", default=None)
+
+
+class RequestState:
+    """
+    Routing state of a request.
+
+    :param bool pinned: The client wrote recently, read from the primary.
+    """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def get_replicas():
+    return getattr(settings, "SURVEY_DB_REPLICAS", [])
+
+
+def start_request(pinned=False):
+    """
+    Set the routing state of a request.
+
+    :rtype: tuple (RequestState, token for end_request)
+    """
+    state = RequestState(pinned)
+    return state, _request_state.set(state)
+
+
+def end_request(token):
+    _request_state.reset(token)
+
+
+@contextmanager
+def use_replica():
+    """
+    Read the survey models from a replica in this block.
+    """
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def _iter_on_replica(iterator):
+    iterator = iter(iterator)
+    try:
+        while True:
+            with use_replica():
+                chunk = next(iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Closed with the response, e.g. when the client disconnects
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def read_replica(view):
+    """
+    Decorate a view (or a view method) reading from a replica on GET and
+    HEAD requests, including the rendering of its template response and the
+    iteration of its streaming response.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, HttpRequest))
+        if request.method not in ("GET", "HEAD"):
+            return view(*args, **kwargs)
+        with use_replica():
+            response = view(*args, **kwargs)
+            if callable(getattr(response, "render", None)):
+                response.render()
+        if response.streaming:
+            response.streaming_content = _iter_on_replica(
+                response.streaming_content)
+        return response
+    return wrapper
+
+
+def _is_routed(model):
+    return model._meta.app_label in REPLICA_APPS
+
+
+class ReplicaRouter:
+    """
+    Route the reads of the read-heavy pages to the replicas, see the module
+    documentation.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = get_replicas()
+        if not replicas or not _use_replica.get() or not _is_routed(model):
+            return DEFAULT_DB_ALIAS
+        state = _request_state.get()
+        if state is not None and (state.pinned or state.wrote):
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and _is_routed(model):
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def check_connections(**kwargs):
+    """
+    Close the persistent connections which don't work anymore, so they are
+    opened again when used. Connected to request_started.
+    """
+    if not getattr(settings, "SURVEY_DB_HEALTH_CHECKS", True):
+        return
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        if not connection.is_usable():
+            connection.close()
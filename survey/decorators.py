@@ -7,37 +7,42 @@ utc=pytz.UTC
 
 from django.shortcuts import Http404, get_object_or_404, redirect, reverse
 
-from survey.models import Survey
+from survey.metrics import timer
+from survey.models import Attempt, Survey
+from survey.participation import has_participated
 
 
 def valid_survey(func):
     """
-    Checks if a survey is valid.
+    Checks if a survey is valid, and passes the survey, the attempt of the
+    user (None if not started) and the status of the user ('participated',
+    'timeout' or '') to the view.
     """
 
     @wraps(func)
     def survey_check(self, request, *args, **kwargs):
-        session_key = 'survey_{}_{}'.format(request.user.id, kwargs['id'])
-        survey_status = ''
-        survey = get_object_or_404(
-            Survey.objects.prefetch_related("questions", "responses"), id=kwargs["id"])
-        
-        if survey.expire_date< utc.localize(datetime.now()):
-            msg = "Survey already expired at: '%s'."
-            raise Http404
-
-        # checking if there any existing response
-        if survey.responses.filter(user=request.user).count() > 0:
-            survey_status = 'participated'
-
-        # Once user start the survey, whether he can submit or not,
-        # he will not able to participate again.
-        if session_key in request.session:
-            session_data = request.session[session_key]
-            # If survey time is up
-            if session_data['remaining'] == 0:
-                survey_status = 'timeout'
+        with timer("valid_survey"):
+            session_key = 'survey_{}_{}'.format(request.user.id, kwargs['id'])
+            survey_status = ''
+            survey = get_object_or_404(Survey, id=kwargs["id"], is_active=True)
+
+            now = utc.localize(datetime.now())
+            if survey.expire_date and survey.expire_date < now:
+                msg = "Survey already expired at: '%s'."
+                raise Http404
+
+            attempt = None
+            # checking if there any existing response
+            if has_participated(request.user, survey.pk):
+                survey_status = 'participated'
+            else:
+                # Once the user starts the survey, whether they can submit
+                # or not, they will not be able to participate again.
+                attempt = Attempt.objects.filter(
+                    survey=survey, user=request.user.pk).first()
+                if attempt is not None and attempt.is_expired():
+                    survey_status = 'timeout'
         return func(self, request, *args, **kwargs, survey=survey, session_key=session_key,\
-                    survey_status=survey_status)
+                    survey_status=survey_status, attempt=attempt)
 
     return survey_check
@@ -0,0 +1,312 @@
+"""
+Import and export of survey definitions.
+
+A definition is a JSON or YAML document like:
+
+    title: Onboarding
+    description: ...
+    duration: 30
+    expire_date: 2030-01-01T00:00:00+00:00
+    is_active: true
+    questions:
+      - id: 12
+        text: Which tools do you use?
+        type: select
+        choices: [Git, Docker, Make]
+
+The whole definition is validated in memory before writing anything, then
+the questions are written in bulk in one transaction. Importing into an
+existing survey only writes the differences: questions are matched by id,
+or by text when the definition has no ids, and the unmatched ones are
+created or deleted. Unmatched questions that were already answered are
+kept, at the end of the survey, unless the import is forced: deleting them
+would delete their answers too. PyYAML is only needed for YAML definitions.
+"""
+import json
+import logging
+import time
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from survey.models import (
+    Answer, Question, QuestionType, Survey, validate_choices)
+from survey.schema import bump_schema_version
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+LOGGER = logging.getLogger(__name__)
+
+FORMATS = ("json", "yaml")
+BATCH_SIZE = 500
+
+ImportResult = namedtuple(
+    "ImportResult", ["survey", "created", "updated", "deleted", "kept",
+                     "unchanged", "timings"])
+
+
+def get_format(path, default="json"):
+    """
+    Return the format of a definition file from its extension.
+    """
+    if path.endswith((".yaml", ".yml")):
+        return "yaml"
+    if path.endswith(".json"):
+        return "json"
+    return default
+
+
+def loads(content, definition_format="json"):
+    """
+    Parse a definition.
+    """
+    if definition_format == "yaml":
+        if yaml is None:
+            raise ValidationError(
+                "PyYAML is required to read YAML definitions.")
+        try:
+            return yaml.safe_load(content)
+        except yaml.YAMLError as error:
+            raise ValidationError(f"Invalid YAML: {error}")
+    try:
+        return json.loads(content)
+    except ValueError as error:
+        raise ValidationError(f"Invalid JSON: {error}")
+
+
+def dumps(definition, definition_format="json"):
+    if definition_format == "yaml":
+        if yaml is None:
+            raise ValidationError(
+                "PyYAML is required to write YAML definitions.")
+        return yaml.safe_dump(definition, sort_keys=False, allow_unicode=True)
+    return json.dumps(definition, indent=2, ensure_ascii=False)
+
+
+def export_definition(survey):
+    """
+    Return the definition of a survey.
+
+    :rtype: dict
+    """
+    expire_date = survey.expire_date
+    return {
+        "title": survey.title,
+        "description": survey.description,
+        "duration": survey.duration,
+        "expire_date": expire_date.isoformat() if expire_date else None,
+        "is_active": survey.is_active,
+        "questions": [
+            {
+                "id": question.pk,
+                "text": question.text,
+                "type": question.question_type,
+                "choices": question.get_clean_choices(),
+            }
+            for question in survey.questions.order_by("position", "pk")
+        ],
+    }
+
+
+def _clean_question(index, data, errors):
+    if not isinstance(data, dict):
+        errors.append(f"Question {index}: expected a mapping.")
+        return None
+    text = data.get("text")
+    if not isinstance(text, str) or not text.strip():
+        errors.append(f"Question {index}: missing text.")
+    question_type = data.get("type", QuestionType.TEXT)
+    if question_type not in QuestionType.values:
+        errors.append(f"Question {index}: unknown type '{question_type}'.")
+    choices = data.get("choices") or None
+    if isinstance(choices, list):
+        if any("," in str(choice) for choice in choices):
+            errors.append(f"Question {index}: choices can't contain commas.")
+        choices = ", ".join(str(choice).strip() for choice in choices)
+    if question_type in (QuestionType.RADIO, QuestionType.SELECT):
+        try:
+            validate_choices(choices or "")
+        except ValidationError as error:
+            errors.append(f"Question {index}: {' '.join(error.messages)}")
+    else:
+        choices = None
+    question_id = data.get("id")
+    if question_id is not None and not isinstance(question_id, int):
+        errors.append(f"Question {index}: id must be an integer.")
+    return {"id": question_id, "text": text, "question_type": question_type,
+            "choices": choices}
+
+
+def validate_definition(definition):
+    """
+    Validate a definition in memory and return its cleaned values.
+
+    :rtype: tuple (dict of survey fields, list of question dicts)
+    :raises ValidationError: With all the errors found.
+    """
+    if not isinstance(definition, dict):
+        raise ValidationError("A definition must be a mapping.")
+    errors = []
+    fields = {}
+    for name in ("title", "description"):
+        value = definition.get(name)
+        if not isinstance(value, str) or not value.strip():
+            errors.append(f"Missing {name}.")
+        fields[name] = value
+    duration = definition.get("duration")
+    if not isinstance(duration, int) or duration <= 0:
+        errors.append("duration must be a positive number of minutes.")
+    fields["duration"] = duration
+    expire_date = definition.get("expire_date")
+    if expire_date is not None and not hasattr(expire_date, "tzinfo"):
+        # YAML loads timestamps as datetimes already
+        expire_date = parse_datetime(str(expire_date))
+        if expire_date is None:
+            errors.append("expire_date must be an ISO 8601 date time.")
+    fields["expire_date"] = expire_date
+    fields["is_active"] = bool(definition.get("is_active", True))
+
+    questions = definition.get("questions")
+    if not isinstance(questions, list):
+        errors.append("questions must be a list.")
+        questions = []
+    cleaned = [_clean_question(index, data, errors)
+               for index, data in enumerate(questions)]
+    if errors:
+        raise ValidationError(errors)
+    return fields, cleaned
+
+
+def _match_questions(existing, questions):
+    """
+    Pair each question of the definition with an existing question, by id
+    then by text.
+
+    :rtype: list of Question or None, in the order of the definition
+    """
+    by_id = {question.pk: question for question in existing}
+    by_text = {}
+    for question in existing:
+        by_text.setdefault(question.text, []).append(question)
+    matched = set()
+    matches = []
+    for data in questions:
+        question = by_id.get(data["id"])
+        if question is None or question.pk in matched:
+            candidates = [q for q in by_text.get(data["text"], [])
+                          if q.pk not in matched]
+            question = candidates[0] if candidates else None
+        if question is not None:
+            matched.add(question.pk)
+        matches.append(question)
+    return matches
+
+
+def import_definition(definition, user=None, survey=None, force=False):
+    """
+    Create a survey from a definition, or update an existing survey.
+
+    The questions missing from the definition are deleted, except the
+    answered ones: they are moved after the questions of the definition
+    and listed in the 'kept' field of the result.
+
+    :param dict definition: The parsed definition.
+    :param User user: Author of a new survey.
+    :param Survey survey: The survey to update, None to create one.
+    :param bool force: Delete the answered questions missing from the
+        definition too, with their answers.
+    :rtype: ImportResult
+    :raises ValidationError: If the definition is invalid, nothing is
+        written then.
+    """
+    timings = {}
+    start = time.perf_counter()
+    fields, questions = validate_definition(definition)
+    timings["validate"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with transaction.atomic():
+        if survey is None:
+            survey = Survey(created_by=user)
+        for name, value in fields.items():
+            setattr(survey, name, value)
+        survey.save()
+
+        existing = list(survey.questions.all())
+        matches = _match_questions(existing, questions)
+        matched = {question.pk for question in matches
+                   if question is not None}
+        unmatched = [question for question in existing
+                     if question.pk not in matched]
+        answered = set()
+        if unmatched and not force:
+            answered = set(Answer.objects.filter(
+                question__in=unmatched
+            ).values_list("question_id", flat=True).distinct())
+        kept = [question for question in unmatched
+                if question.pk in answered]
+        to_delete = [question.pk for question in unmatched
+                     if question.pk not in answered]
+        if to_delete:
+            Question.objects.filter(pk__in=to_delete).delete()
+            # The delete signals shifted the positions of the next questions
+            positions = dict(survey.questions.values_list("pk", "position"))
+            for question in matches + kept:
+                if question is not None:
+                    question.position = positions[question.pk]
+
+        to_create = []
+        to_update = []
+        unchanged = 0
+        for position, (data, question) in enumerate(zip(questions, matches)):
+            if question is None:
+                to_create.append(Question(
+                    survey=survey, position=position, text=data["text"],
+                    question_type=data["question_type"],
+                    choices=data["choices"]))
+                continue
+            new_values = {
+                "position": position, "text": data["text"],
+                "question_type": data["question_type"],
+                "choices": data["choices"],
+            }
+            if all(getattr(question, name) == value
+                   for name, value in new_values.items()):
+                unchanged += 1
+                continue
+            for name, value in new_values.items():
+                setattr(question, name, value)
+            to_update.append(question)
+        updated = len(to_update)
+        for position, question in enumerate(kept, start=len(questions)):
+            if question.position != position:
+                question.position = position
+                to_update.append(question)
+        if kept:
+            LOGGER.warning(
+                "Kept %s answered questions missing from the definition of "
+                "survey %s", len(kept), survey.pk)
+
+        Question.objects.bulk_update(
+            to_update, ["position", "text", "question_type", "choices"],
+            batch_size=BATCH_SIZE)
+        Question.objects.bulk_create(to_create, batch_size=BATCH_SIZE)
+        # bulk_create and bulk_update don't send the signals
+        transaction.on_commit(lambda: bump_schema_version(survey.pk))
+    timings["write"] = time.perf_counter() - start
+
+    result = ImportResult(
+        survey=survey, created=len(to_create), updated=updated,
+        deleted=len(to_delete), kept=kept, unchanged=unchanged,
+        timings=timings)
+    LOGGER.info(
+        "Imported survey %s: %s created, %s updated, %s deleted, %s kept, "
+        "%s unchanged in %.2fs",
+        survey.pk, result.created, result.updated, result.deleted,
+        len(result.kept), result.unchanged, sum(timings.values()))
+    return result
@@ -0,0 +1,207 @@
+"""
+Draft answers of surveys in progress.
+
+Answers are saved at each step with one row (or cache key) per (user,
+survey, question), so a step only writes its own answer instead of the
+whole session, and the final submit reads the whole draft at once.
+
+The store is chosen with the SURVEY_DRAFT_STORE setting:
+
+- 'survey.drafts.DatabaseDraftStore' (default) uses the DraftAnswer table.
+- 'survey.drafts.CacheDraftStore' uses the cache named by
+  SURVEY_DRAFT_CACHE ('default' by default).
+"""
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from survey.models import DraftAnswer
+from survey.schema import get_compiled_survey, get_question_id
+
+DEFAULT_DRAFT_STORE = "survey.drafts.DatabaseDraftStore"
+
+
+class BaseDraftStore:
+    """
+    Interface of the draft stores. Values are form values keyed by field
+    name ('question_<id>').
+    """
+
+    def load(self, user_id, survey_id, question_ids):
+        """
+        Return the draft answers of a user to some questions of a survey.
+
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def save(self, user_id, survey_id, values):
+        """
+        Save draft answers, replacing the previous answers to the same
+        questions.
+        """
+        raise NotImplementedError
+
+    def clear(self, user_id, survey_id, question_ids):
+        """
+        Delete the draft answers of a user to a survey.
+        """
+        raise NotImplementedError
+
+    def load_all(self, user_id, survey_id):
+        """
+        Return the draft answers of a user to all the questions of a survey.
+        """
+        return self.load(user_id, survey_id, _get_question_ids(survey_id))
+
+    def clear_all(self, user_id, survey_id):
+        self.clear(user_id, survey_id, _get_question_ids(survey_id))
+
+    def load_many(self, survey_id, user_ids):
+        """
+        Return the draft answers of many users to all the questions of a
+        survey.
+
+        :rtype: dict of draft answers keyed by user id
+        """
+        question_ids = _get_question_ids(survey_id)
+        return {
+            user_id: self.load(user_id, survey_id, question_ids)
+            for user_id in user_ids
+        }
+
+    def clear_many(self, survey_id, user_ids):
+        question_ids = _get_question_ids(survey_id)
+        for user_id in user_ids:
+            self.clear(user_id, survey_id, question_ids)
+
+
+def _get_question_ids(survey_id):
+    return [
+        question.pk for question in get_compiled_survey(survey_id).questions]
+
+
+def _get_values(values):
+    """
+    Yield the question ids and the values of form values.
+    """
+    for field_name, value in values.items():
+        question_id = get_question_id(field_name)
+        if question_id is not None:
+            yield question_id, value
+
+
+class DatabaseDraftStore(BaseDraftStore):
+    """
+    Store the drafts in the DraftAnswer table.
+    """
+
+    def load(self, user_id, survey_id, question_ids):
+        drafts = DraftAnswer.objects.filter(
+            user_id=user_id, survey_id=survey_id,
+            question_id__in=list(question_ids)
+        ).values_list("question_id", "value")
+        return {
+            "question_%d" % question_id: json.loads(value)
+            for question_id, value in drafts
+        }
+
+    def save(self, user_id, survey_id, values):
+        for question_id, value in _get_values(values):
+            DraftAnswer.objects.update_or_create(
+                user_id=user_id, survey_id=survey_id, question_id=question_id,
+                defaults={"value": json.dumps(value)})
+
+    def clear(self, user_id, survey_id, question_ids):
+        DraftAnswer.objects.filter(
+            user_id=user_id, survey_id=survey_id).delete()
+
+    def load_many(self, survey_id, user_ids):
+        drafts = {user_id: {} for user_id in user_ids}
+        rows = DraftAnswer.objects.filter(
+            survey_id=survey_id, user_id__in=list(user_ids)
+        ).values_list("user_id", "question_id", "value")
+        for user_id, question_id, value in rows:
+            drafts[user_id]["question_%d" % question_id] = json.loads(value)
+        return drafts
+
+    def clear_many(self, survey_id, user_ids):
+        DraftAnswer.objects.filter(
+            survey_id=survey_id, user_id__in=list(user_ids)).delete()
+
+
+class CacheDraftStore(BaseDraftStore):
+    """
+    Store the drafts in a cache, one key per question.
+    """
+    KEY = "survey:draft:{survey_id}:{user_id}:{question_id}"
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, "SURVEY_DRAFT_CACHE", "default")]
+        self.timeout = getattr(settings, "SURVEY_DRAFT_TIMEOUT", 24 * 60 * 60)
+
+    def get_key(self, user_id, survey_id, question_id):
+        return self.KEY.format(
+            survey_id=survey_id, user_id=user_id, question_id=question_id)
+
+    def load(self, user_id, survey_id, question_ids):
+        keys = {
+            self.get_key(user_id, survey_id, question_id):
+                "question_%d" % question_id
+            for question_id in question_ids
+        }
+        return {
+            keys[key]: value
+            for key, value in self.cache.get_many(list(keys)).items()
+        }
+
+    def save(self, user_id, survey_id, values):
+        self.cache.set_many({
+            self.get_key(user_id, survey_id, question_id): value
+            for question_id, value in _get_values(values)
+        }, self.timeout)
+
+    def clear(self, user_id, survey_id, question_ids):
+        self.cache.delete_many([
+            self.get_key(user_id, survey_id, question_id)
+            for question_id in question_ids
+        ])
+
+    def load_many(self, survey_id, user_ids):
+        question_ids = _get_question_ids(survey_id)
+        keys = {
+            self.get_key(user_id, survey_id, question_id):
+                (user_id, question_id)
+            for user_id in user_ids
+            for question_id in question_ids
+        }
+        drafts = {user_id: {} for user_id in user_ids}
+        for key, value in self.cache.get_many(list(keys)).items():
+            user_id, question_id = keys[key]
+            drafts[user_id]["question_%d" % question_id] = value
+        return drafts
+
+    def clear_many(self, survey_id, user_ids):
+        question_ids = _get_question_ids(survey_id)
+        self.cache.delete_many([
+            self.get_key(user_id, survey_id, question_id)
+            for user_id in user_ids
+            for question_id in question_ids
+        ])
+
+
+_stores = {}
+
+
+def get_draft_store():
+    """
+    Return the draft store configured by the SURVEY_DRAFT_STORE setting.
+
+    :rtype: BaseDraftStore
+    """
+    path = getattr(settings, "SURVEY_DRAFT_STORE", DEFAULT_DRAFT_STORE)
+    if path not in _stores:
+        _stores[path] = import_string(path)()
+    return _stores[path]
@@ -0,0 +1,222 @@
+"""
+Streaming export of survey responses.
+
+Responses and answers are read in chunks (server-side cursors where the
+database supports them) as two streams ordered by response, merged into one
+row per response and written incrementally as CSV or JSON lines, optionally
+gzip compressed. Memory use doesn't depend on the number of responses.
+The responses of archived surveys are read from their archive file.
+"""
+import csv
+import json
+import logging
+import time
+import zlib
+
+from survey.archive import open_archive
+from survey.models import Answer, QuestionType, Response, parse_select_body
+from survey.schema import get_compiled_survey
+
+LOGGER = logging.getLogger(__name__)
+
+FORMATS = ("csv", "jsonl")
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+BASE_COLUMNS = ["response_id", "user", "response_type", "created_at"]
+
+
+class ExportStats:
+    """
+    Count the exported rows and the throughput.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.start = time.perf_counter()
+        self.end = None
+
+    def stop(self):
+        self.end = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"{self.rows} rows in {self.elapsed:.2f}s "
+                f"({self.rows_per_second:.0f} rows/s)")
+
+
+def get_columns(schema):
+    return BASE_COLUMNS + [
+        question.field_name for question in schema.questions]
+
+
+def iter_response_rows(survey, chunk_size=2000, stats=None):
+    """
+    Yield one dict by response of a survey with its answers keyed by field
+    name ('question_<id>').
+
+    :param survey: A Survey or a survey id.
+    :param int chunk_size: Number of rows fetched from the database at once.
+    :param ExportStats stats: Updated with the number of rows.
+    """
+    survey_id = getattr(survey, "pk", survey)
+    schema = get_compiled_survey(survey_id)
+    archive = open_archive(survey_id)
+    if archive is not None:
+        yield from iter_archived_rows(archive, schema, stats)
+        return
+    responses = Response.objects.filter(
+        survey_id=survey_id).order_by("pk").values_list(
+        "pk", "user__username", "response_type", "created_at"
+    ).iterator(chunk_size=chunk_size)
+    answers = Answer.objects.filter(response__survey_id=survey_id).order_by(
+        "response_id", "question_id").values_list(
+        "response_id", "question_id", "body"
+    ).iterator(chunk_size=chunk_size)
+
+    answer = next(answers, None)
+    for response_id, username, response_type, created_at in responses:
+        row = {
+            "response_id": response_id,
+            "user": username,
+            "response_type": response_type,
+            "created_at": created_at.isoformat() if created_at else None,
+        }
+        # Skip answers of responses missing from the response stream
+        while answer is not None and answer[0] < response_id:
+            answer = next(answers, None)
+        while answer is not None and answer[0] == response_id:
+            question = schema.get_question(answer[1])
+            if question is not None:
+                row[question.field_name] = format_value(question, answer[2])
+            answer = next(answers, None)
+        if stats is not None:
+            stats.rows += 1
+        yield row
+
+
+def iter_archived_rows(archive, schema, stats=None):
+    """
+    Yield the rows of the responses of a survey archive, like
+    iter_response_rows.
+
+    :param survey.archive.ArchiveReader archive: The archive.
+    """
+    for record in archive:
+        row = {
+            "response_id": record["id"],
+            "user": record["user"],
+            "response_type": record["response_type"],
+            "created_at": record["created_at"],
+        }
+        for answer in record["answers"]:
+            question = schema.get_question(answer["question_id"])
+            if question is not None:
+                row[question.field_name] = format_value(
+                    question, answer["body"])
+        if stats is not None:
+            stats.rows += 1
+        yield row
+
+
+def format_value(question, body):
+    """
+    Return the exported value of an answer, multiple select answers are
+    exported as lists.
+    """
+    if question.question_type == QuestionType.SELECT:
+        return parse_select_body(body)
+    return body
+
+
+class _Echo:
+    """
+    File-like object returning what is written, to use csv.writer on a
+    stream.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows, columns):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        values = []
+        for column in columns:
+            value = row.get(column)
+            if isinstance(value, list):
+                value = "; ".join(value)
+            values.append(value)
+        yield writer.writerow(values)
+
+
+def iter_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def iter_gzip(chunks):
+    """
+    Gzip compress a stream of bytes.
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_export(survey, export_format="csv", compress=False, chunk_size=2000,
+                stats=None):
+    """
+    Yield the export of the responses of a survey as chunks of bytes.
+
+    :param survey: A Survey or a survey id.
+    :param str export_format: 'csv' or 'jsonl'.
+    :param bool compress: True to gzip the export.
+    :param int chunk_size: Number of rows fetched from the database at once.
+    :param ExportStats stats: Updated with the number of rows and the time.
+    """
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}'")
+    survey_id = getattr(survey, "pk", survey)
+    stats = stats or ExportStats()
+    rows = iter_response_rows(survey_id, chunk_size=chunk_size, stats=stats)
+    if export_format == "csv":
+        lines = iter_csv(rows, get_columns(get_compiled_survey(survey_id)))
+    else:
+        lines = iter_jsonl(rows)
+    chunks = _buffer((line.encode("utf-8") for line in lines), 64 * 1024)
+    if compress:
+        chunks = iter_gzip(chunks)
+    yield from chunks
+    stats.stop()
+    LOGGER.info("Exported survey %s: %s", survey_id, stats)
+
+
+def _buffer(chunks, size):
+    """
+    Group small chunks of bytes into chunks of about size bytes.
+    """
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b"".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b"".join(buffer)
@@ -0,0 +1,87 @@
+"""
+Server-side finalization of expired attempts.
+
+Attempts whose deadline passed without a response (closed tab, lost
+connection...) are saved as 'Time Up' responses from their draft answers,
+in batches, so the timeout endpoint called by the browser is optional.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from survey.drafts import get_draft_store
+from survey.models import Attempt, ResponseType
+from survey.persistence import Submission, clean_values, persist_responses
+from survey.schema import get_compiled_survey
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_expired_attempts(now=None, grace=timedelta(seconds=30)):
+    """
+    Return the attempts not finalized past their deadline plus a grace
+    delay, leaving the browsers some time to call the timeout endpoint.
+    """
+    now = now or timezone.now()
+    return Attempt.objects.past_deadline(now - grace).order_by("deadline")
+
+
+def finalize_batch(batch_size=500, now=None, grace=timedelta(seconds=30)):
+    """
+    Finalize a batch of expired attempts.
+
+    :rtype: tuple (number of attempts finalized, number of responses created)
+    """
+    draft_store = get_draft_store()
+    with transaction.atomic():
+        attempts = get_expired_attempts(now, grace)
+        if connection.features.has_select_for_update_skip_locked:
+            # Let concurrent finalizers work on other attempts
+            attempts = attempts.select_for_update(skip_locked=True)
+        attempts = list(attempts.values_list(
+            "pk", "survey_id", "user_id")[:batch_size])
+        if not attempts:
+            return 0, 0
+
+        users_by_survey = defaultdict(list)
+        for _, survey_id, user_id in attempts:
+            users_by_survey[survey_id].append(user_id)
+
+        created = 0
+        for survey_id, user_ids in users_by_survey.items():
+            questions = get_compiled_survey(survey_id).questions_by_id
+            drafts = draft_store.load_many(survey_id, user_ids)
+            responses = persist_responses(survey_id, [
+                Submission(user_id, ResponseType.TIMEUP,
+                           clean_values(questions, drafts[user_id]))
+                for user_id in user_ids
+            ])
+            created += len(responses)
+            draft_store.clear_many(survey_id, user_ids)
+
+        # Including the attempts of users who already responded
+        Attempt.objects.filter(pk__in=[pk for pk, _, _ in attempts]).update(
+            finalized_at=timezone.now())
+    return len(attempts), created
+
+
+def finalize_expired_attempts(batch_size=500, now=None,
+                              grace=timedelta(seconds=30)):
+    """
+    Finalize all the expired attempts, batch by batch.
+
+    :rtype: tuple (number of attempts finalized, number of responses created)
+    """
+    total_attempts = total_created = 0
+    while True:
+        attempts, created = finalize_batch(batch_size, now, grace)
+        if not attempts:
+            break
+        total_attempts += attempts
+        total_created += created
+        LOGGER.info("Finalized %s expired attempts, %s responses created",
+                    attempts, created)
+    return total_attempts, total_created
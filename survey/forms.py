@@ -7,7 +7,13 @@ from django.forms import models
 from django.urls import reverse
 from django.utils.text import slugify
 
-from survey.models import Answer, QuestionType, Question, Response
+from survey.drafts import get_draft_store
+from survey.models import Answer, QuestionType, Response, parse_select_body
+from survey.participation import has_participated
+from survey.persistence import finalize_attempts, save_answers
+from survey.schema import (
+    get_compiled_survey, get_step_question, get_steps_count)
+from survey.tallies import record_response
 
 LOGGER = logging.getLogger(__name__)
 
@@ -34,18 +40,20 @@ class ResponseForm(models.ModelForm):
 
     def __init__(self, *args, **kwargs):
         """
-        Expects a survey object to be passed in initially
+        Expects a survey object to be passed in initially. The draft
+        answers are loaded from the draft store unless draft_data is given.
         """
         self.survey = kwargs.pop("survey")
         self.user = kwargs.pop("user")
         self.session_data = kwargs.pop('session_data')
+        self.draft_data = kwargs.pop('draft_data', None)
         try:
             self.step = int(kwargs.pop("step"))
         except KeyError:
             self.step = None
         super().__init__(*args, **kwargs)
 
-        self.steps_count = len(self.survey.questions.all())
+        self.steps_count = get_steps_count(self.survey)
         self.response = False
         self.answers = False
 
@@ -63,10 +71,22 @@ class ResponseForm(models.ModelForm):
         type as appropriate.
         """
 
-        for i, question in enumerate(self.survey.questions.all()):
-            not_to_keep = i != self.step and self.step is not None
-            if not_to_keep:
-                continue
+        if self.step is None:
+            questions = get_compiled_survey(self.survey).questions
+        else:
+            # Only the question of the current step is needed
+            question = get_step_question(self.survey, self.step)
+            questions = [question] if question is not None else []
+
+        if self.draft_data is None:
+            # Load the draft answers of the displayed questions only
+            self.draft_data = get_draft_store().load(
+                self.user.id, self.survey.pk,
+                [question.pk for question in questions])
+
+        self.questions = {}
+        for question in questions:
+            self.questions[question.pk] = question
             self.add_question(question, data)
 
     def _get_preexisting_response(self):
@@ -79,7 +99,7 @@ class ResponseForm(models.ModelForm):
         if self.response:
             return self.response
 
-        if not self.user.is_authenticated:
+        if not has_participated(self.user, self.survey.pk):
             self.response = None
         else:
             try:
@@ -100,17 +120,18 @@ class ResponseForm(models.ModelForm):
         multiple db calls.
 
         :rtype: dict of Answer or None"""
-        if self.answers:
+        if self.answers is not False:
             return self.answers
 
         response = self._get_preexisting_response()
         if response is None:
-            self.answers = None
+            # Nothing to query, and cached even though empty
+            self.answers = {}
+            return self.answers
         try:
-            answers = Answer.objects.filter(response=response
-                                            ).prefetch_related("question")
+            answers = Answer.objects.filter(response=response)
             self.answers = {
-                answer.question.id: answer for answer in answers.all()}
+                answer.question_id: answer for answer in answers.all()}
         except Answer.DoesNotExist:
             self.answers = None
 
@@ -131,11 +152,11 @@ class ResponseForm(models.ModelForm):
         if answer:
             return answer
         else:
-            # Try to get answer from session data
+            # Try to get answer from the draft
             try:
                 question_id = 'question_'+str(question.id)
                 answer = argparse.Namespace()
-                answer.body = self.session_data[question_id]
+                answer.body = self.draft_data[question_id]
                 return answer
             except KeyError:
                 return None
@@ -151,20 +172,8 @@ class ResponseForm(models.ModelForm):
         if answer:
             # Initialize the field with values from the database if any
             if question.question_type == QuestionType.SELECT:
-                initial = []
-                if answer.body == "[]":
-                    pass
-                elif "[" in answer.body and "]" in answer.body:
-                    initial = []
-                    unformated_choices = answer.body[1:-1].strip()
-                    for unformated_choice in unformated_choices.split(","):
-                        choice = unformated_choice.split("'")[1]
-                        initial.append(slugify(choice))
-                elif isinstance(answer.body, list):
-                    initial = answer.body
-                else:
-                    # Only one element
-                    initial.append(slugify(answer.body))
+                initial = [slugify(choice, allow_unicode=True)
+                           for choice in parse_select_body(answer.body)]
             else:
                 initial = answer.body
         if data:
@@ -265,11 +274,16 @@ class ResponseForm(models.ModelForm):
         Save the response object.
         Recover an existing response from the database if any.
         There is only one response by logged user.
+
+        The answers are validated in memory against the questions loaded by
+        the form and written in bulk, so the number of queries does not
+        depend on the number of questions.
         """
-        while transaction.atomic():
+        with transaction.atomic():
             response = self._get_preexisting_response()
+            created = response is None
 
-            if response is None:
+            if created:
                 response = super().save(commit=False)
             if 'response_type' in self.session_data:
                 response.response_type = self.session_data['response_type']
@@ -277,14 +291,9 @@ class ResponseForm(models.ModelForm):
             response.user = self.user
             response.save()
 
-            # create an answer object for each question and associate it 
-            # with this response.
-            for field_name, field_value in list(self.cleaned_data.items()):
-                if field_name.startswith("question_"):
-                    q_id = int(field_name.split("_")[1])
-                    question = Question.objects.get(pk=q_id)
-                    answer = Answer(question=question)
-                    answer.body = field_value
-                    answer.response = response
-                    answer.save()
+            save_answers(response, self.questions, self.cleaned_data,
+                         created=created)
+            if created:
+                record_response(response, self.questions, self.cleaned_data)
+                finalize_attempts(self.survey.pk, [self.user.pk])
             return response
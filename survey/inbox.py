@@ -0,0 +1,134 @@
+"""
+Per-user inbox of available surveys.
+
+Instead of excluding the answered surveys from the whole survey table on
+every page hit, an InboxEntry row is kept for each (user, survey) pair the
+user can still take. Entries are added when a survey is published or a
+staff user is created, and removed when the user responds. Expired entries
+are filtered when reading and deleted by the prune_inbox command.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils import timezone
+
+from survey.models import InboxEntry, Response, Survey
+
+BATCH_SIZE = 1000
+
+
+def get_page_size():
+    return getattr(settings, "SURVEY_INBOX_PAGE_SIZE", 20)
+
+
+def get_inbox_page(user, before=None, size=None):
+    """
+    Return a page of the surveys available to a user, newest first, using
+    keyset pagination on the survey id.
+
+    :param User user: The user.
+    :param int before: Only return surveys with an id lower than this one.
+    :param int size: Number of surveys by page.
+    :rtype: tuple (list of Survey, next cursor or None)
+    """
+    size = size or get_page_size()
+    entries = InboxEntry.objects.filter(user=user).filter(
+        Q(expire_date__isnull=True) | Q(expire_date__gt=timezone.now()))
+    if before is not None:
+        entries = entries.filter(survey_id__lt=before)
+    entries = entries.select_related("survey").order_by("-survey_id")
+    entries = list(entries[:size + 1])
+
+    surveys = [entry.survey for entry in entries[:size]]
+    next_cursor = None
+    if len(entries) > size:
+        next_cursor = surveys[-1].pk
+    return surveys, next_cursor
+
+
+def _is_open(survey):
+    return survey.is_active and (
+        survey.expire_date is None or survey.expire_date > timezone.now())
+
+
+def _bulk_add(entries):
+    InboxEntry.objects.bulk_create(
+        entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def publish_survey(survey):
+    """
+    Add a survey to the inbox of every staff user who didn't respond yet,
+    or remove it from all the inboxes if it is not open anymore.
+    """
+    if not _is_open(survey):
+        InboxEntry.objects.filter(survey=survey).delete()
+        return
+    InboxEntry.objects.filter(survey=survey).update(
+        expire_date=survey.expire_date)
+    users = User.objects.filter(is_staff=True, is_active=True).exclude(
+        pk__in=Response.objects.filter(survey=survey, user__isnull=False
+                                       ).values("user_id"))
+    entries = []
+    for user_id in users.values_list("pk", flat=True).iterator():
+        entries.append(InboxEntry(
+            user_id=user_id, survey=survey, expire_date=survey.expire_date))
+        if len(entries) >= BATCH_SIZE:
+            _bulk_add(entries)
+            entries = []
+    _bulk_add(entries)
+
+
+def add_user(user):
+    """
+    Fill the inbox of a staff user with the open surveys the user didn't
+    respond to, or empty it if the user can't take surveys.
+    """
+    if not (user.is_staff and user.is_active):
+        InboxEntry.objects.filter(user=user).delete()
+        return
+    surveys = Survey.objects.filter(is_active=True).filter(
+        Q(expire_date__isnull=True) | Q(expire_date__gt=timezone.now())
+    ).exclude(responses__user=user)
+    _bulk_add([
+        InboxEntry(user=user, survey_id=survey_id, expire_date=expire_date)
+        for survey_id, expire_date in surveys.values_list("pk", "expire_date")
+    ])
+
+
+def add_entry(user_id, survey_id):
+    """
+    Give back a survey to a user, e.g. when the user's response is
+    deleted.
+    """
+    survey = Survey.objects.filter(pk=survey_id).first()
+    if survey is not None and user_id is not None and _is_open(survey):
+        _bulk_add([InboxEntry(
+            user_id=user_id, survey=survey, expire_date=survey.expire_date)])
+
+
+def remove_entry(user_id, survey_id):
+    """
+    Remove a survey from the inbox of a user, e.g. after responding.
+    """
+    InboxEntry.objects.filter(user_id=user_id, survey_id=survey_id).delete()
+
+
+def prune_expired():
+    """
+    Delete the entries of expired surveys.
+
+    :rtype: int number of deleted entries
+    """
+    deleted, _ = InboxEntry.objects.filter(
+        expire_date__lte=timezone.now()).delete()
+    return deleted
+
+
+def rebuild():
+    """
+    Rebuild all the inboxes from scratch.
+    """
+    InboxEntry.objects.all().delete()
+    for survey in Survey.objects.iterator():
+        publish_survey(survey)
@@ -0,0 +1,260 @@
+"""
+Ingestion of responses collected offline.
+
+A response file has one JSON object per line:
+
+    {"user": "jdoe", "answers": {"question_12": "Yes", "13": ["option-a"]}}
+
+"user" is a username, leave it out for anonymous responses.
+"response_type" is "submitted" (the default) or "timeup". Answers are
+keyed by question id or field name and validated like the form answers
+(Answer.check_answer_body). Valid lines are saved in batches with
+persist_responses, the invalid ones are appended with the reason to a
+rejects file.
+
+The file is streamed and an IngestionCheckpoint row, saved in the
+transaction of each batch, keeps the offset of the last saved batch, so an
+interrupted ingestion resumes where it stopped. The rejects of the batch
+being saved are written before its commit, so they may appear twice after
+a crash but are never lost.
+
+Validation can run in worker processes, they get the compiled questions
+and never use the database.
+"""
+import json
+import logging
+import multiprocessing
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from survey.models import (
+    Answer, IngestionCheckpoint, QuestionType, Response, ResponseType)
+from survey.persistence import Submission, persist_responses
+from survey.schema import get_compiled_survey, get_question_id
+
+LOGGER = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+
+
+class Rejected(Exception):
+    pass
+
+
+def validate_record(record, survey_id, questions):
+    """
+    Validate a parsed line.
+
+    :param dict questions: Compiled questions of the survey keyed by id.
+    :rtype: tuple (username or None, response type, values keyed by field
+        name)
+    :raises Rejected: If the line is invalid.
+    """
+    if not isinstance(record, dict):
+        raise Rejected("Expected a JSON object")
+    if record.get("survey", survey_id) != survey_id:
+        raise Rejected(f"Response to another survey ({record['survey']})")
+    username = record.get("user")
+    if username is not None and not isinstance(username, str):
+        raise Rejected("user must be a username")
+    response_type = record.get("response_type", ResponseType.SUBMITTED)
+    if response_type not in ResponseType.values:
+        raise Rejected(f"Unknown response type '{response_type}'")
+    answers = record.get("answers")
+    if not isinstance(answers, dict):
+        raise Rejected("answers must be an object")
+
+    values = {}
+    for key, value in answers.items():
+        question_id = None
+        if key.startswith("question_"):
+            question_id = get_question_id(key)
+        if question_id is None and key.isdigit():
+            question_id = int(key)
+        question = questions.get(question_id)
+        if question is None:
+            raise Rejected(f"Unknown question '{key}'")
+        if question.question_type == QuestionType.SELECT:
+            if not isinstance(value, list) or not all(
+                    isinstance(v, str) for v in value):
+                raise Rejected(f"{key}: expected a list of choices")
+        elif not isinstance(value, str):
+            raise Rejected(f"{key}: expected a string")
+        try:
+            Answer().check_answer_body(question, value)
+        except ValidationError as error:
+            raise Rejected(f"{key}: {' '.join(error.messages)}")
+        values[question.field_name] = value
+    return username, response_type, values
+
+
+def validate_line(line, survey_id, questions):
+    """
+    Parse and validate a line.
+
+    :rtype: tuple (True, validated values) or (False, reason)
+    """
+    try:
+        record = json.loads(line)
+    except ValueError as error:
+        return False, f"Invalid JSON: {error}"
+    try:
+        return True, validate_record(record, survey_id, questions)
+    except Rejected as error:
+        return False, str(error)
+
+
+# Schema of the worker processes, set by their initializer
+_worker_schema = None
+
+
+def _init_worker(survey_id, questions):
+    global _worker_schema
+    _worker_schema = (survey_id, questions)
+
+
+def _validate_in_worker(line):
+    return validate_line(line, *_worker_schema)
+
+
+class Ingestion:
+    """
+    Ingest a response file into a survey.
+
+    :param Survey survey: The survey the responses answer.
+    :param str path: The JSONL file.
+    :param str rejects_path: Where to append the invalid lines.
+    :param int batch_size: Number of lines saved by transaction.
+    :param int workers: Number of validation processes, 0 to validate in
+        the current process.
+    :param str source: Name of the checkpoint, the path by default.
+    """
+
+    def __init__(self, survey, path, rejects_path=None, batch_size=BATCH_SIZE,
+                 workers=0, source=None):
+        self.survey = survey
+        self.path = path
+        self.rejects_path = rejects_path or path + ".rejects.jsonl"
+        self.batch_size = batch_size
+        self.workers = workers
+        self.source = source or path
+        self.questions = get_compiled_survey(survey).questions_by_id
+        self.pool = None
+
+    def get_checkpoint(self, restart=False):
+        checkpoint, _ = IngestionCheckpoint.objects.get_or_create(
+            source=self.source, defaults={"survey": self.survey})
+        if checkpoint.survey_id != self.survey.pk:
+            raise ValueError(
+                f"{self.source} was ingested into survey "
+                f"{checkpoint.survey_id}")
+        if restart:
+            checkpoint.offset = checkpoint.lines = 0
+            checkpoint.accepted = checkpoint.rejected = 0
+            checkpoint.save()
+        return checkpoint
+
+    def validate(self, lines):
+        if self.pool is not None:
+            chunksize = max(len(lines) // (self.workers * 4), 1)
+            return self.pool.map(
+                _validate_in_worker, lines, chunksize=chunksize)
+        return [validate_line(line, self.survey.pk, self.questions)
+                for line in lines]
+
+    def run(self, restart=False, progress=None):
+        """
+        Ingest the file from the last checkpoint.
+
+        :param callable progress: Called with the checkpoint after each batch.
+        :rtype: IngestionCheckpoint
+        """
+        checkpoint = self.get_checkpoint(restart)
+        if self.workers:
+            self.pool = multiprocessing.Pool(
+                self.workers, initializer=_init_worker,
+                initargs=(self.survey.pk, self.questions))
+        try:
+            with open(self.path, "rb") as file, \
+                    open(self.rejects_path, "a", encoding="utf-8") as rejects:
+                file.seek(checkpoint.offset)
+                offset = checkpoint.offset
+                batch = []
+                for line in file:
+                    offset += len(line)
+                    batch.append(line)
+                    if len(batch) >= self.batch_size:
+                        self.save_batch(checkpoint, batch, offset, rejects)
+                        batch = []
+                        if progress:
+                            progress(checkpoint)
+                if batch:
+                    self.save_batch(checkpoint, batch, offset, rejects)
+                    if progress:
+                        progress(checkpoint)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        return checkpoint
+
+    def save_batch(self, checkpoint, lines, offset, rejects):
+        start = time.perf_counter()
+        first_line = checkpoint.lines + 1
+        results = self.validate(
+            [line.decode("utf-8", "replace") for line in lines])
+
+        rejected = []
+        valid = []
+        numbers = range(first_line, first_line + len(lines))
+        for number, line, (ok, result) in zip(numbers, lines, results):
+            if not line.strip():
+                continue
+            if ok:
+                valid.append((number, line, result))
+            else:
+                rejected.append((number, line, result))
+
+        usernames = {result[0] for _, _, result in valid
+                     if result[0] is not None}
+        user_ids = dict(User.objects.filter(
+            username__in=usernames).values_list("username", "pk"))
+        responded = set(Response.objects.filter(
+            survey=self.survey, user_id__in=list(user_ids.values())
+        ).values_list("user_id", flat=True))
+        submissions = []
+        for number, line, (username, response_type, values) in valid:
+            user_id = user_ids.get(username)
+            if username is not None and user_id is None:
+                rejected.append((number, line, f"Unknown user '{username}'"))
+            elif user_id is not None and user_id in responded:
+                rejected.append(
+                    (number, line, f"'{username}' already responded"))
+            else:
+                if user_id is not None:
+                    responded.add(user_id)
+                submissions.append(Submission(user_id, response_type, values))
+
+        rejected.sort(key=lambda reject: reject[0])
+        for number, line, reason in rejected:
+            rejects.write(json.dumps({
+                "line": number, "error": reason,
+                "record": line.decode("utf-8", "replace").rstrip("\n"),
+            }) + "\n")
+        rejects.flush()
+
+        with transaction.atomic():
+            persist_responses(self.survey.pk, submissions)
+            checkpoint.offset = offset
+            checkpoint.lines += len(lines)
+            checkpoint.accepted += len(submissions)
+            checkpoint.rejected += len(rejected)
+            checkpoint.save()
+        LOGGER.info(
+            "Ingested lines %s-%s of %s: %s accepted, %s rejected in %.2fs",
+            first_line, checkpoint.lines, self.path, len(submissions),
+            len(rejected), time.perf_counter() - start)
@@ -0,0 +1,247 @@
+"""
+Live dashboard of the responses of a survey, streamed as server-sent
+events.
+
+The feed of changes is a version number per survey in the cache, bumped
+after the commit of each batch of tallies (survey.tallies) and when an
+attempt starts. The dashboard data is a snapshot built from the tallies and
+kept in the cache with the version it was built for:
+
+- in each process, one thread (ChangeFeed) polls the versions of all the
+  watched surveys with a single cache read every SURVEY_LIVE_INTERVAL
+  seconds and wakes the streams up when one changes,
+- the snapshot of a new version is built by the first stream asking for
+  it, at most once per SURVEY_LIVE_INTERVAL across all the processes, the
+  others get the snapshot from the cache. A snapshot is kept for
+  SURVEY_LIVE_SNAPSHOT_SECONDS, then built again.
+
+So the database work doesn't depend on the number of viewers. The
+versions and the snapshots only reach the other processes through a cache
+shared by the workers (see survey.checks): with a per-process cache, the
+viewers served by another worker than the one saving the responses never
+see a change.
+
+By default a stream sends the current snapshot and ends, and the browser
+reconnects after SURVEY_LIVE_INTERVAL: each viewer polls the cache, not
+the database. A stream holds a WSGI worker thread while it lasts, so the
+long streams, lasting SURVEY_LIVE_STREAM_SECONDS with a snapshot at each
+change, are only used with SURVEY_LIVE_LONG_STREAMS on, and never under
+ASGI: Django 3.2 iterates the streaming responses synchronously, blocking
+the event loop.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from survey.models import Attempt, QuestionTally, SurveyTally
+from survey.schema import get_compiled_survey
+
+VERSION_KEY = "survey:live:version:{survey_id}"
+SNAPSHOT_KEY = "survey:live:snapshot:{survey_id}"
+BUILD_LOCK_KEY = "survey:live:build:{survey_id}"
+
+
+def get_interval():
+    return getattr(settings, "SURVEY_LIVE_INTERVAL", 1.0)
+
+
+def long_streams_enabled():
+    return getattr(settings, "SURVEY_LIVE_LONG_STREAMS", False)
+
+
+def get_snapshot_timeout():
+    return getattr(settings, "SURVEY_LIVE_SNAPSHOT_SECONDS", 60)
+
+
+def get_version(survey_id):
+    return cache.get(VERSION_KEY.format(survey_id=survey_id), 0)
+
+
+def notify_change(survey_id):
+    """
+    Bump the version of the live data of a survey.
+    """
+    key = VERSION_KEY.format(survey_id=survey_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Random start, so a version lost from the cache doesn't come back
+        # with the value of an old snapshot
+        if not cache.add(key, random.randrange(1, 2 ** 31), None):
+            cache.incr(key)
+
+
+def build_snapshot(survey_id, version):
+    """
+    Return the dashboard data of a survey from its tallies.
+    """
+    compiled = get_compiled_survey(survey_id)
+    tally = (SurveyTally.objects.filter(survey_id=survey_id).first()
+             or SurveyTally())
+    answered = Counter()
+    for question_id, count in QuestionTally.objects.filter(
+            survey_id=survey_id).values_list("question_id", "answered"):
+        answered[question_id] += count
+    in_progress = Attempt.objects.filter(
+        survey_id=survey_id).in_progress().count()
+    return {
+        "version": version,
+        "survey": survey_id,
+        "updated_at": timezone.now().isoformat(),
+        "total": tally.total,
+        "submitted": tally.submitted,
+        "timeup": tally.timeup,
+        "completion_ratio": (tally.submitted / tally.total
+                             if tally.total else None),
+        "in_progress": in_progress,
+        "questions": [
+            {
+                "id": question.pk,
+                "text": question.text,
+                "answered": answered[question.pk],
+                "progress": (answered[question.pk] / tally.total
+                             if tally.total else None),
+            }
+            for question in compiled.questions
+        ],
+    }
+
+
+def get_snapshot(survey_id, version=None):
+    """
+    Return the dashboard data of a survey, from the cache if it was built
+    for the current version. The data of a previous version is returned
+    while another process builds the new one, and for SURVEY_LIVE_INTERVAL
+    after a build.
+
+    :param int version: The current version, read from the cache if None.
+    """
+    if version is None:
+        version = get_version(survey_id)
+    snapshot = cache.get(SNAPSHOT_KEY.format(survey_id=survey_id))
+    if snapshot is not None and snapshot["version"] == version:
+        return snapshot
+    if snapshot is not None and not cache.add(
+            BUILD_LOCK_KEY.format(survey_id=survey_id), True, get_interval()):
+        return snapshot
+    snapshot = build_snapshot(survey_id, version)
+    cache.set(SNAPSHOT_KEY.format(survey_id=survey_id), snapshot,
+              get_snapshot_timeout())
+    return snapshot
+
+
+class ChangeFeed:
+    """
+    In-process feed of the versions of the watched surveys, polled by one
+    thread while there are watchers.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._watchers = Counter()
+        self._versions = {}
+        self._thread = None
+
+    def subscribe(self, survey_id):
+        with self._condition:
+            self._watchers[survey_id] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="survey-live-feed", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, survey_id):
+        with self._condition:
+            self._watchers[survey_id] -= 1
+            if self._watchers[survey_id] <= 0:
+                del self._watchers[survey_id]
+                self._versions.pop(survey_id, None)
+
+    def wait(self, survey_id, version, timeout):
+        """
+        Wait until the version of a survey is different from version.
+
+        :rtype: The version, unchanged after the timeout.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._versions.get(survey_id, version) != version,
+                timeout)
+            return self._versions.get(survey_id, version)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                survey_ids = list(self._watchers)
+                if not survey_ids:
+                    self._thread = None
+                    return
+            keys = {VERSION_KEY.format(survey_id=survey_id): survey_id
+                    for survey_id in survey_ids}
+            versions = {keys[key]: version
+                        for key, version in cache.get_many(keys).items()}
+            with self._condition:
+                changed = False
+                for survey_id in survey_ids:
+                    version = versions.get(survey_id, 0)
+                    if (survey_id in self._watchers
+                            and self._versions.get(survey_id) != version):
+                        self._versions[survey_id] = version
+                        changed = True
+                if changed:
+                    self._condition.notify_all()
+            time.sleep(get_interval())
+
+
+FEED = ChangeFeed()
+
+
+def format_event(snapshot):
+    return (f"id: {snapshot['version']}\nevent: snapshot\n"
+            f"data: {json.dumps(snapshot)}\n\n")
+
+
+def iter_events(survey_id, last_event_id=None, duration=None):
+    """
+    Yield the server-sent events of the dashboard of a survey: a snapshot
+    at each change, and a comment as keep-alive.
+
+    :param str last_event_id: The Last-Event-ID header of a reconnection,
+        the current snapshot isn't sent again.
+    :param float duration: Seconds before the stream ends,
+        SURVEY_LIVE_STREAM_SECONDS by default.
+    """
+    interval = get_interval()
+    keepalive = getattr(settings, "SURVEY_LIVE_KEEPALIVE", 15)
+    if duration is None:
+        duration = getattr(settings, "SURVEY_LIVE_STREAM_SECONDS", 300)
+    end = time.monotonic() + duration
+    sent = last_event_id
+    yield f"retry: {int(interval * 1000)}\n\n"
+
+    FEED.subscribe(survey_id)
+    try:
+        version = get_version(survey_id)
+        while True:
+            snapshot = get_snapshot(survey_id, version)
+            if str(snapshot["version"]) != sent:
+                sent = str(snapshot["version"])
+                yield format_event(snapshot)
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            # A snapshot of a previous version is asked again after an interval
+            stale = snapshot["version"] != version
+            timeout = min(interval if stale else keepalive, remaining)
+            new_version = FEED.wait(survey_id, version, timeout)
+            if new_version == version and not stale:
+                yield ": keep-alive\n\n"
+            version = new_version
+    finally:
+        FEED.unsubscribe(survey_id)
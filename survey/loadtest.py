@@ -0,0 +1,379 @@
+"""
+Load test of the respondent flow.
+
+Simulated respondents walk a synthetic survey like a browser would:
+instructions, first step, then a GET and a POST for each step until the
+submit, or until they call the timeout API halfway. Requests go through
+Django's test client (in-process, with the database queries and the
+session size of each request) or over HTTP to a running server.
+
+See the loadtest management command.
+"""
+import http.cookiejar
+import logging
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from survey.models import Question, QuestionType, Survey
+
+LOGGER = logging.getLogger(__name__)
+
+# Metrics checked by the budgets, throughput is a minimum, the others are
+# maximums
+BUDGET_METRICS = (
+    "throughput", "p50_ms", "p95_ms", "p99_ms", "error_rate",
+    "queries_per_step", "session_bytes",
+)
+STEP_REQUESTS = ("step_get", "step_post")
+
+# Names of the fixture surveys and users
+FIXTURE_PREFIX = "loadtest-"
+FIXTURE_NAME = re.compile(r"^loadtest-[0-9a-f]{8}(-\d+)?$")
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of a list of numbers (nearest rank).
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(int(round(percent / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Stats:
+    """
+    Latency, queries and session size of the requests, by request name.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.session_bytes = defaultdict(list)
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, latency, status, queries=None, session_bytes=None):
+        with self.lock:
+            self.latencies[name].append(latency)
+            if queries is not None:
+                self.queries[name].append(queries)
+            if session_bytes is not None:
+                self.session_bytes[name].append(session_bytes)
+            if status >= 400:
+                self.errors[name] += 1
+
+    def summary(self, elapsed):
+        """
+        Return the overall metrics and the metrics by request name.
+
+        :param float elapsed: Duration of the run in seconds.
+        :rtype: dict
+        """
+        latencies = [latency for values in self.latencies.values()
+                     for latency in values]
+        step_queries = [
+            count for name in STEP_REQUESTS for count in self.queries[name]]
+        sizes = [
+            size for values in self.session_bytes.values() for size in values]
+        requests = len(latencies)
+        errors = sum(self.errors.values())
+        return {
+            "requests": requests,
+            "errors": errors,
+            "error_rate": errors / requests if requests else 0.0,
+            "throughput": requests / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "queries_per_step": (sum(step_queries) / len(step_queries)
+                                 if step_queries else None),
+            "session_bytes": max(sizes) if sizes else None,
+            "requests_by_name": {
+                name: {
+                    "requests": len(values),
+                    "errors": self.errors[name],
+                    "p50_ms": percentile(values, 50) * 1000,
+                    "p95_ms": percentile(values, 95) * 1000,
+                    "p99_ms": percentile(values, 99) * 1000,
+                    "queries": (
+                        sum(self.queries[name]) / len(self.queries[name])
+                        if self.queries[name] else None),
+                    "session_bytes": (max(self.session_bytes[name])
+                                      if self.session_bytes[name] else None),
+                }
+                for name, values in sorted(self.latencies.items())
+            },
+        }
+
+
+def check_budgets(summary, budgets):
+    """
+    Return the budgets exceeded by a run.
+
+    :param dict summary: As returned by Stats.summary.
+    :param dict budgets: Limits keyed by metric name.
+    :rtype: list of String
+    """
+    failures = []
+    for metric, limit in budgets.items():
+        if metric not in BUDGET_METRICS:
+            raise ValueError(f"Unknown budget '{metric}'")
+        value = summary[metric]
+        if value is None:
+            continue
+        if metric == "throughput":
+            if value < limit:
+                failures.append(f"{metric} {value:.1f} < {limit}")
+        elif value > limit:
+            failures.append(f"{metric} {value:.1f} > {limit}")
+    return failures
+
+
+def create_fixture(respondents, questions, password=None, question_type=None,
+                   choices=("Option A", "Option B", "Option C")):
+    """
+    Create a survey and staff users to respond to it, the first one owns
+    the survey. Also used by the benchmark commands.
+
+    The users are staff because the respondent views are staff only. The
+    survey is only added to the inboxes of the fixture users, the real
+    staff users never see it.
+
+    :param int respondents: Number of users, the owner included.
+    :param int questions: Number of questions.
+    :param str password: Password of the users, unusable by default.
+    :param str question_type: Type of all the questions, by default they
+        cycle over text, radio and select.
+    :param choices: Labels of the choices of the radio and select questions.
+    :rtype: tuple (Survey, list of User)
+    """
+    prefix = FIXTURE_PREFIX + uuid.uuid4().hex[:8]
+    owner = User.objects.create_user(prefix, password=password, is_staff=True)
+    # Created inactive, so survey.signals doesn't publish it to every staff
+    # inbox, and activated without signals
+    survey = Survey.objects.create(
+        title=prefix, description=prefix, duration=60, created_by=owner,
+        expire_date=timezone.now() + timedelta(days=1), is_active=False)
+    Survey.objects.filter(pk=survey.pk).update(is_active=True)
+    survey.is_active = True
+    types = [question_type] if question_type else [
+        QuestionType.TEXT, QuestionType.RADIO, QuestionType.SELECT]
+    for i in range(questions):
+        question_type = types[i % len(types)]
+        Question.objects.create(
+            survey=survey, text=f"Question {i}", question_type=question_type,
+            choices=(None if question_type == QuestionType.TEXT
+                     else ", ".join(choices)))
+    users = [owner] + [
+        User.objects.create_user(
+            f"{prefix}-{i}", password=password, is_staff=True)
+        for i in range(respondents - 1)
+    ]
+    return survey, users
+
+
+def delete_fixture(survey, users):
+    """
+    Delete a survey created by create_fixture, with its responses, and its
+    users.
+    """
+    survey.delete()
+    User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+
+def delete_leftover_fixtures():
+    """
+    Delete the surveys and users created by create_fixture in runs which
+    were killed before cleaning up.
+
+    :rtype: tuple (number of surveys, number of users)
+    """
+    surveys = [
+        survey
+        for survey in Survey.objects.filter(title__startswith=FIXTURE_PREFIX)
+        if FIXTURE_NAME.match(survey.title)
+    ]
+    for survey in surveys:
+        survey.delete()
+    user_ids = [
+        pk for pk, username in User.objects.filter(
+            username__startswith=FIXTURE_PREFIX).values_list("pk", "username")
+        if FIXTURE_NAME.match(username)
+    ]
+    User.objects.filter(pk__in=user_ids).delete()
+    return len(surveys), len(user_ids)
+
+
+def get_answer(question):
+    if question.question_type == QuestionType.TEXT:
+        return "Some text"
+    if question.question_type == QuestionType.RADIO:
+        return "option-a"
+    return ["option-a", "option-c"]
+
+
+class InProcessClient:
+    """
+    Send the requests through Django's test client, counting the queries
+    and measuring the session.
+    """
+
+    def __init__(self, user):
+        # Errors are returned as 500 responses, like a server would
+        self.client = Client(raise_request_exception=False)
+        self.client.force_login(user)
+
+    def request(self, method, url, data=None):
+        """
+        :rtype: tuple (status code, number of queries, session size)
+        """
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            if method == "post":
+                response = self.client.post(url, data)
+            else:
+                response = self.client.get(url)
+        session = self.client.session
+        session_bytes = len(session.encode(dict(session.items())))
+        return response.status_code, len(queries), session_bytes
+
+
+class HttpClient:
+    """
+    Send the requests to a running server, logging in with the admin login
+    form. Queries and session sizes are not measured.
+    """
+
+    def __init__(self, base_url, user, password):
+        self.base_url = base_url.rstrip("/")
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirect())
+        login_url = reverse("admin:login")
+        self.request("get", login_url)
+        status, _, _ = self.request("post", login_url, {
+            "username": user.username, "password": password, "next": "/"})
+        if status != 302:
+            raise RuntimeError(f"Login of {user.username} failed ({status})")
+
+    def get_csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == "csrftoken":
+                return cookie.value
+        return ""
+
+    def request(self, method, url, data=None):
+        body = None
+        headers = {}
+        if method == "post":
+            data = dict(data or {}, csrfmiddlewaretoken=self.get_csrf_token())
+            body = urllib.parse.urlencode(data, doseq=True).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["X-CSRFToken"] = self.get_csrf_token()
+            headers["Referer"] = self.base_url + url
+        request = urllib.request.Request(
+            self.base_url + url, data=body, headers=headers,
+            method=method.upper())
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, None, None
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, None, None
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """
+    Return redirects as they are, each request is measured on its own.
+    """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def walk(client, survey_id, questions, stats, timeout=False):
+    """
+    Take the survey as a respondent.
+
+    :param client: An InProcessClient or an HttpClient.
+    :param list questions: The questions of the survey, in step order.
+    :param Stats stats: Collects the measures.
+    :param bool timeout: True to stop halfway and call the timeout API.
+    """
+
+    def send(name, method, url, data=None):
+        start = time.perf_counter()
+        status, queries, session_bytes = client.request(method, url, data)
+        stats.add(name, time.perf_counter() - start, status, queries,
+                  session_bytes)
+
+    kwargs = {"id": survey_id}
+    send("instructions", "get", reverse("survey-instructions", kwargs=kwargs))
+    send("detail", "get", reverse("survey-detail", kwargs=kwargs))
+    for step, question in enumerate(questions):
+        url = reverse(
+            "survey-detail-step", kwargs={"id": survey_id, "step": step})
+        if step:
+            send("step_get", "get", url)
+        if timeout and step == len(questions) // 2:
+            send("timeout", "get",
+                 reverse("api-survey-timeout", kwargs=kwargs))
+            return
+        last = step == len(questions) - 1
+        send("submit" if last else "step_post", "post", url, {
+            "question_%d" % question.pk: get_answer(question),
+            "step_type": "Submit" if last else "Next!",
+        })
+
+
+def run(survey, users, make_client, concurrency=10, timeout_ratio=0.0):
+    """
+    Make every user take the survey, concurrency users at once.
+
+    :param Survey survey: The survey to take.
+    :param list users: The respondents.
+    :param make_client: Callable returning a client for a user.
+    :param int concurrency: Number of respondents at once, 1 to run in the
+        current thread.
+    :param float timeout_ratio: Part of the respondents calling the timeout
+        API instead of submitting.
+    :rtype: dict, see Stats.summary
+    """
+    questions = list(survey.questions.order_by("position", "pk"))
+    stats = Stats()
+    timeouts = int(len(users) * timeout_ratio)
+
+    def respond(index):
+        walk(make_client(users[index]), survey.pk, questions, stats,
+             timeout=index < timeouts)
+
+    start = time.perf_counter()
+    if concurrency <= 1:
+        for index in range(len(users)):
+            respond(index)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(respond, range(len(users))))
+    return stats.summary(time.perf_counter() - start)
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.archive import (
+    ArchiveError, archive_survey, get_archivable_surveys, get_retention)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the responses of the surveys expired for longer than "
+        "SURVEY_ARCHIVE_AFTER_DAYS days to gzip archive files.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--survey", type=int, action="append", dest="surveys",
+            help="Only archive this survey, repeatable.")
+        parser.add_argument(
+            "--days", type=int, help="Retention in days after the expiry.")
+        parser.add_argument(
+            "--directory", help="SURVEY_ARCHIVE_DIR by default.")
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only list the surveys to archive.")
+
+    def handle(self, *args, **options):
+        retention = get_retention()
+        if options["days"] is not None:
+            retention = timedelta(days=options["days"])
+        surveys = get_archivable_surveys(retention)
+        if options["surveys"]:
+            surveys = surveys.filter(pk__in=options["surveys"])
+            missing = set(options["surveys"]) - {s.pk for s in surveys}
+            if missing:
+                missing = ", ".join(map(str, sorted(missing)))
+                raise CommandError(
+                    f"Not archivable (unknown, not expired for "
+                    f"{retention.days} days, archived or without "
+                    f"responses): {missing}")
+
+        responses = size = 0
+        for survey in surveys:
+            if options["dry_run"]:
+                self.stdout.write(
+                    f"Survey {survey.pk} '{survey.title}', expired on "
+                    f"{survey.expire_date:%Y-%m-%d}")
+                continue
+            try:
+                archive = archive_survey(
+                    survey, directory=options["directory"])
+            except ArchiveError as error:
+                self.stderr.write(f"Survey {survey.pk}: {error}")
+                continue
+            responses += archive.responses
+            size += archive.size
+            self.stdout.write(
+                f"Survey {survey.pk}: {archive.responses} responses, "
+                f"{archive.answers} answers -> {archive.path} "
+                f"({archive.size} bytes)")
+        if not options["dry_run"]:
+            self.stdout.write(f"Archived {responses} responses ({size} bytes)")
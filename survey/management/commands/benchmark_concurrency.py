@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from survey.loadtest import create_fixture, delete_fixture, percentile
+from survey.models import QuestionType
+
+MODES = ("wsgi", "asgi")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the throughput and the latency of the survey steps served by "
+        "the sync views through the WSGI handler and by the async views "
+        "through the ASGI handler, with many respondents at once. Uses "
+        "throwaway users and survey created in the configured database, "
+        "which should be the production engine: SQLite serializes the writes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mode", choices=MODES + ("both",), default="both")
+        parser.add_argument(
+            "--users", type=int, default=50,
+            help="Number of concurrent respondents.")
+        parser.add_argument("--questions", type=int, default=5)
+        parser.add_argument(
+            "--wsgi-threads", type=int, default=8,
+            help="Requests served at once by the simulated WSGI server.")
+        parser.add_argument(
+            "--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        if options["mode"] == "both":
+            # Each mode runs in its own process, the URLconf depends on
+            # SURVEY_ASYNC_VIEWS
+            results = [self.run_subprocess(mode, options) for mode in MODES]
+        else:
+            results = [self.run(options["mode"], options)]
+
+        if options["json"]:
+            for result in results:
+                self.stdout.write(json.dumps(result))
+            return
+        self.stdout.write(
+            f"{'mode':<6}{'requests':>10}{'errors':>8}{'req/s':>10}"
+            f"{'p50 ms':>10}{'p99 ms':>10}")
+        for result in results:
+            self.stdout.write(
+                f"{result['mode']:<6}{result['requests']:>10}"
+                f"{result['errors']:>8}{result['throughput']:>10.1f}"
+                f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+
+    def run_subprocess(self, mode, options):
+        env = dict(os.environ,
+                   SURVEY_ASYNC_VIEWS="True" if mode == "asgi" else "False")
+        command = [
+            sys.executable, sys.argv[0], "benchmark_concurrency",
+            "--mode", mode, "--json",
+            "--users", str(options["users"]),
+            "--questions", str(options["questions"]),
+            "--wsgi-threads", str(options["wsgi_threads"]),
+        ]
+        output = subprocess.run(
+            command, env=env, check=True, capture_output=True, text=True)
+        return json.loads(output.stdout.strip().splitlines()[-1])
+
+    def run(self, mode, options):
+        async_views = getattr(settings, "SURVEY_ASYNC_VIEWS", False)
+        if mode == "asgi" and not async_views:
+            raise CommandError(
+                "Set SURVEY_ASYNC_VIEWS=True to benchmark the async views.")
+        survey, users = create_fixture(
+            options["users"], options["questions"],
+            question_type=QuestionType.TEXT)
+        try:
+            urls = [
+                reverse("survey-detail-step",
+                        kwargs={"id": survey.pk, "step": step})
+                for step in range(options["questions"])
+            ]
+            field_names = [
+                "question_%d" % pk
+                for pk in survey.questions.values_list("pk", flat=True)]
+            start = time.perf_counter()
+            # The test clients use the 'testserver' host
+            allowed_hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+            with override_settings(ALLOWED_HOSTS=allowed_hosts):
+                if mode == "wsgi":
+                    latencies, errors = self.run_wsgi(
+                        users, urls, field_names, options["wsgi_threads"])
+                else:
+                    latencies, errors = asyncio.run(
+                        self.run_asgi(users, urls, field_names))
+            elapsed = time.perf_counter() - start
+        finally:
+            delete_fixture(survey, users)
+        return {
+            "mode": mode,
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+
+    @staticmethod
+    def get_steps(urls, field_names):
+        """
+        Yield the requests of a respondent: a GET and a POST by step.
+        """
+        for step, (url, field_name) in enumerate(zip(urls, field_names)):
+            last = step == len(urls) - 1
+            yield "get", url, {}
+            # Form encoded like a browser would
+            yield "post", url, {
+                "data": urlencode({
+                    field_name: "Some text",
+                    "step_type": "Submit" if last else "Next!",
+                }),
+                "content_type": "application/x-www-form-urlencoded",
+            }
+
+    def run_wsgi(self, users, urls, field_names, threads):
+        server = threading.Semaphore(threads)
+        latencies = []
+        errors = []
+
+        clients = []
+        for user in users:
+            # Errors are counted as 500 responses, like a server would
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            clients.append(client)
+
+        def respond(client):
+            for method, url, kwargs in self.get_steps(urls, field_names):
+                start = time.perf_counter()
+                # Waiting for a free server thread counts in the latency
+                with server:
+                    response = getattr(client, method)(url, **kwargs)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+        with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+            list(executor.map(respond, clients))
+        return latencies, len(errors)
+
+    async def run_asgi(self, users, urls, field_names):
+        latencies = []
+        errors = []
+        clients = []
+        for user in users:
+            client = AsyncClient(raise_request_exception=False)
+            await asyncio.get_running_loop().run_in_executor(
+                None, client.force_login, user)
+            clients.append(client)
+
+        async def respond(client):
+            for method, url, kwargs in self.get_steps(urls, field_names):
+                start = time.perf_counter()
+                response = await getattr(client, method)(url, **kwargs)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+        await asyncio.gather(*[respond(client) for client in clients])
+        return latencies, len(errors)
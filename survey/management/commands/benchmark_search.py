@@ -0,0 +1,137 @@
+import itertools
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from survey.loadtest import create_fixture, delete_fixture
+from survey.models import Answer, QuestionType, Response
+from survey.search import get_backend, search_answers
+
+BATCH_SIZE = 5000
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa", "do",
+             "fi", "gu", "ha", "je"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the full-text search in the answers of a survey with the "
+        "database index (FTS5 on SQLite, GIN on PostgreSQL) against a scan "
+        "with icontains, for common, medium, rare, two-word and prefix "
+        "queries. Uses a throwaway survey with generated answers created in "
+        "the configured database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--answers", type=int, default=200000)
+        parser.add_argument(
+            "--questions", type=int, default=4, help="Text questions.")
+        parser.add_argument(
+            "--words", type=int, default=20000,
+            help="Size of the vocabulary.")
+        parser.add_argument(
+            "--repeat", type=int, default=5,
+            help="Searches by query and mode.")
+        parser.add_argument(
+            "--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        words = self.get_vocabulary(options["words"])
+        repeat = options["repeat"]
+        start = time.perf_counter()
+        survey, users = self.create_data(
+            options["answers"], options["questions"], words)
+        load_seconds = time.perf_counter() - start
+        queries = {
+            "common": words[5],
+            "medium": words[len(words) // 20],
+            "rare": words[-1],
+            "two words": f"{words[5]} {words[len(words) // 20]}",
+            "prefix": words[len(words) // 20][:4] + "*",
+        }
+        try:
+            results = {
+                "backend": get_backend(Answer.objects.db),
+                "answers": options["answers"],
+                "load_seconds": load_seconds,
+                "queries": {
+                    name: {
+                        "query": query,
+                        "hits": len(search_answers(
+                            query, survey_id=survey.pk).hits),
+                        "index_ms": self.measure(query, survey, repeat, True),
+                        "scan_ms": self.measure(query, survey, repeat, False),
+                    }
+                    for name, query in queries.items()
+                },
+            }
+        finally:
+            delete_fixture(survey, users)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write(
+            f"{results['answers']} answers loaded in {load_seconds:.1f}s, "
+            f"index: {results['backend'] or 'none'}")
+        self.stdout.write(
+            f"{'query':<12}{'text':<24}{'hits':>6}{'index ms':>10}"
+            f"{'scan ms':>10}")
+        for name, result in results["queries"].items():
+            self.stdout.write(
+                f"{name:<12}{result['query']:<24}{result['hits']:>6}"
+                f"{result['index_ms']:>10.1f}{result['scan_ms']:>10.1f}")
+
+    @staticmethod
+    def measure(query, survey, repeat, indexed):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            search_answers(query, survey_id=survey.pk, indexed=indexed)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
+
+    @staticmethod
+    def get_vocabulary(count):
+        generator = random.Random(0)
+        words = set()
+        while len(words) < count:
+            words.add("".join(
+                generator.choices(SYLLABLES, k=generator.randint(2, 5))))
+        return sorted(words, key=lambda word: (len(word), word))
+
+    @staticmethod
+    def create_data(answers_count, questions_count, words):
+        # The answers are anonymous, the only user owns the survey
+        survey, users = create_fixture(
+            1, questions_count, question_type=QuestionType.TEXT)
+        questions = list(survey.questions.order_by("pk"))
+        # Zipf-like frequencies, the first words are the most common
+        weights = list(itertools.accumulate(
+            1 / rank for rank in range(1, len(words) + 1)))
+        generator = random.Random(1)
+        responses_count = -(-answers_count // questions_count)
+        for offset in range(0, responses_count, BATCH_SIZE):
+            Response.objects.bulk_create([
+                Response(survey=survey)
+                for _ in range(min(BATCH_SIZE, responses_count - offset))
+            ])
+        answers = []
+        created = 0
+        response_ids = Response.objects.filter(
+            survey=survey).values_list("pk", flat=True)
+        for response_id in response_ids:
+            for question in questions[:answers_count - created - len(answers)]:
+                answers.append(Answer(
+                    question_id=question.pk, response_id=response_id,
+                    body=" ".join(generator.choices(
+                        words, cum_weights=weights,
+                        k=generator.randint(8, 30)))))
+            if len(answers) >= BATCH_SIZE:
+                Answer.objects.bulk_create(answers)
+                created += len(answers)
+                answers = []
+        Answer.objects.bulk_create(answers)
+        return survey, users
@@ -0,0 +1,220 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from survey.loadtest import create_fixture, delete_fixture
+from survey.models import QuestionType
+
+# Printed to stderr by the worker between the startup and the first request,
+# to split the -X importtime output
+STARTUP_MARKER = "@@survey-startup-done"
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+# Runs in a fresh interpreter like a new web worker: loads the WSGI
+# application, then serves the same survey step to different respondents.
+WORKER = f"""
+import json, sys, time
+start = time.perf_counter()
+from impelsurvey.wsgi import application
+startup = time.perf_counter() - start
+print({STARTUP_MARKER!r}, file=sys.stderr, flush=True)
+
+from io import BytesIO
+from django.conf import settings
+from survey import warmup
+
+params = json.loads(sys.argv[1])
+settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+
+def get(cookie):
+    environ = {{
+        "REQUEST_METHOD": "GET", "PATH_INFO": params["url"],
+        "QUERY_STRING": "", "SERVER_NAME": "testserver", "SERVER_PORT": "80",
+        "HTTP_HOST": "testserver", "HTTP_COOKIE": cookie,
+        "wsgi.url_scheme": "http", "wsgi.input": BytesIO(),
+        "wsgi.errors": sys.stderr,
+    }}
+    statuses = []
+    start = time.perf_counter()
+    response = application(
+        environ, lambda status, headers: statuses.append(status))
+    b"".join(response)
+    response.close()
+    return time.perf_counter() - start, int(statuses[0].split()[0])
+
+requests = [get(cookie) for cookie in params["cookies"]]
+report = warmup.last_report or {{}}
+print(json.dumps({{
+    "startup": startup,
+    "requests": [seconds for seconds, _ in requests],
+    "statuses": [status for _, status in requests],
+    "warmup": {{name: seconds for name, (seconds, _) in report.items()}},
+}}))
+"""
+
+
+def parse_import_times(stderr):
+    """
+    Sum the self import times of -X importtime output by top-level package,
+    split at STARTUP_MARKER.
+
+    :rtype: tuple (startup imports, first request imports), dicts of
+        package -> seconds
+    """
+    startup, request = defaultdict(float), defaultdict(float)
+    current = startup
+    for line in stderr.splitlines():
+        if line.startswith(STARTUP_MARKER):
+            current = request
+            continue
+        match = IMPORT_TIME.match(line)
+        if match:
+            current[match.group(4).split(".")[0]] += int(match.group(1)) / 1e6
+    return startup, request
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the startup of a web worker and its first request against "
+        "the next ones, with and without SURVEY_WARMUP. Each worker is a new "
+        "interpreter loading impelsurvey.wsgi and serving a survey step to "
+        "respondents who haven't started the survey, through the WSGI "
+        "handler. Uses a throwaway survey and users created in the "
+        "configured database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rounds", type=int, default=5, help="Workers started by mode.")
+        parser.add_argument(
+            "--requests", type=int, default=5,
+            help="Requests served by each worker.")
+        parser.add_argument("--questions", type=int, default=20)
+        parser.add_argument(
+            "--choices", type=int, default=50, help="Choices by question.")
+        parser.add_argument(
+            "--imports", type=int, default=10,
+            help="Number of top-level packages listed by import time.")
+        parser.add_argument(
+            "--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        if options["requests"] < 2:
+            raise CommandError("--requests must be at least 2.")
+        # The first user owns the survey
+        requests = options["requests"]
+        survey, users = create_fixture(
+            options["rounds"] * 2 * requests + 1, options["questions"],
+            question_type=QuestionType.RADIO,
+            choices=[f"Choice {i}" for i in range(options["choices"])])
+        try:
+            cookies = self.log_in(users)
+            url = reverse(
+                "survey-detail-step", kwargs={"id": survey.pk, "step": 0})
+            results = {}
+            for warm in (False, True):
+                runs = []
+                for _ in range(options["rounds"]):
+                    batch, cookies = cookies[:requests], cookies[requests:]
+                    runs.append(self.run_worker(url, batch, warm))
+                results["warm" if warm else "cold"] = self.summarize(
+                    runs, options["imports"])
+        finally:
+            delete_fixture(survey, users)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write(
+            f"{'SURVEY_WARMUP':<14}{'startup ms':>12}{'first ms':>10}"
+            f"{'next ms':>10}{'first req. imports':>20}")
+        for mode, result in results.items():
+            self.stdout.write(
+                f"{'on' if mode == 'warm' else 'off':<14}"
+                f"{result['startup_ms']:>12.1f}"
+                f"{result['first_request_ms']:>10.1f}"
+                f"{result['next_requests_ms']:>10.1f}"
+                f"{result['request_imports_ms']:>17.1f} ms")
+        for mode, result in results.items():
+            if result["warmup_ms"]:
+                self.stdout.write("\nWarm-up stages (ms): " + ", ".join(
+                    f"{name} {ms:.1f}"
+                    for name, ms in result["warmup_ms"].items()))
+            self.stdout.write(
+                f"\nImport time by package with SURVEY_WARMUP "
+                f"{'on' if mode == 'warm' else 'off'} "
+                f"(ms, startup / first request):")
+            for package, (startup, request) in result["imports_ms"].items():
+                self.stdout.write(
+                    f"  {package:<30}{startup:>10.1f}{request:>10.1f}")
+
+    @staticmethod
+    def log_in(users):
+        cookies = []
+        allowed_hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+        with override_settings(ALLOWED_HOSTS=allowed_hosts):
+            for user in users[1:]:
+                client = Client()
+                client.force_login(user)
+                cookies.append(
+                    f"{settings.SESSION_COOKIE_NAME}="
+                    f"{client.cookies[settings.SESSION_COOKIE_NAME].value}")
+        return cookies
+
+    @staticmethod
+    def run_worker(url, cookies, warm):
+        env = dict(os.environ, SURVEY_WARMUP="True" if warm else "False")
+        env.setdefault("DJANGO_SETTINGS_MODULE", "impelsurvey.settings")
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", WORKER,
+             json.dumps({"url": url, "cookies": cookies})],
+            env=env, cwd=settings.BASE_DIR, check=True, capture_output=True,
+            text=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        if any(status != 200 for status in result["statuses"]):
+            raise CommandError(f"Unexpected statuses {result['statuses']}")
+        result["imports"] = parse_import_times(output.stderr)
+        return result
+
+    @staticmethod
+    def summarize(runs, imports_count):
+        def median_ms(values):
+            return statistics.median(values) * 1000
+
+        def total(run, package):
+            return sum(imports.get(package, 0.0) for imports in run["imports"])
+
+        packages = sorted(
+            {package for run in runs for imports in run["imports"]
+             for package in imports},
+            key=lambda package: -statistics.median(
+                total(run, package) for run in runs))
+        return {
+            "startup_ms": median_ms([run["startup"] for run in runs]),
+            "first_request_ms": median_ms(
+                [run["requests"][0] for run in runs]),
+            "next_requests_ms": median_ms(
+                [seconds for run in runs for seconds in run["requests"][1:]]),
+            "request_imports_ms": median_ms(
+                [sum(run["imports"][1].values()) for run in runs]),
+            "warmup_ms": {
+                name: median_ms([run["warmup"][name] for run in runs])
+                for name in runs[0]["warmup"]
+            },
+            "imports_ms": {
+                package: tuple(
+                    median_ms([run["imports"][index].get(package, 0.0)
+                               for run in runs])
+                    for index in (0, 1))
+                for package in packages[:imports_count]
+            },
+        }
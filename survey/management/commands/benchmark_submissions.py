@@ -0,0 +1,126 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from survey.buffer import flush_submissions
+from survey.loadtest import create_fixture, delete_fixture, percentile
+from survey.models import QuestionType, Response
+from survey.schema import get_compiled_survey
+
+MODES = ("direct", "buffered")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the sustained rate of final submissions when many "
+        "respondents submit at once, saving each response in its own "
+        "transaction against accepting it into the write-behind buffer "
+        "(SURVEY_WRITE_BEHIND), and the rate of the flush of the buffer. Uses "
+        "throwaway users and survey created in the configured database, "
+        "which should be the production engine: SQLite serializes the writes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users", type=int, default=200,
+            help="Number of respondents by mode.")
+        parser.add_argument("--questions", type=int, default=20)
+        parser.add_argument(
+            "--threads", type=int, default=8, help="Submissions sent at once.")
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Submissions saved by flush transaction.")
+        parser.add_argument(
+            "--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        count = options["users"]
+        survey, users = create_fixture(
+            count * len(MODES) + 1, options["questions"],
+            question_type=QuestionType.TEXT)
+        try:
+            results = []
+            for index, mode in enumerate(MODES):
+                # The first user owns the survey
+                batch = users[1 + index * count:1 + (index + 1) * count]
+                results.append(self.run(mode, survey, batch, options))
+        finally:
+            delete_fixture(survey, users)
+
+        if options["json"]:
+            for result in results:
+                self.stdout.write(json.dumps(result))
+            return
+        self.stdout.write(
+            f"{'mode':<10}{'submits':>9}{'errors':>8}{'submits/s':>11}"
+            f"{'p50 ms':>9}{'p99 ms':>9}{'flush/s':>10}{'saved/s':>10}")
+        for result in results:
+            flush_rate = f"{'-':>10}"
+            if result["flush_rate"]:
+                flush_rate = f"{result['flush_rate']:>10.1f}"
+            self.stdout.write(
+                f"{result['mode']:<10}{result['submits']:>9}"
+                f"{result['errors']:>8}{result['throughput']:>11.1f}"
+                f"{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+                f"{flush_rate}{result['saved_rate']:>10.1f}")
+
+    def run(self, mode, survey, users, options):
+        url = reverse("api-survey-submit", kwargs={"id": survey.pk})
+        schema = get_compiled_survey(survey)
+        payload = json.dumps({
+            "version": schema.digest,
+            "answers": {question.field_name: "Some text"
+                        for question in schema.questions},
+        })
+        latencies = []
+        errors = []
+
+        # The test clients use the 'testserver' host
+        with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+                SURVEY_WRITE_BEHIND=mode == "buffered"):
+            clients = []
+            for user in users:
+                # Errors are counted as 500 responses, like a server would
+                client = Client(raise_request_exception=False)
+                client.force_login(user)
+                clients.append(client)
+
+            def submit(client):
+                start = time.perf_counter()
+                response = client.post(
+                    url, data=payload, content_type="application/json")
+                latencies.append(time.perf_counter() - start)
+                if response.status_code not in (201, 202):
+                    errors.append(response.status_code)
+
+            start = time.perf_counter()
+            threads = options["threads"]
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(submit, clients))
+            elapsed = time.perf_counter() - start
+
+        flush_elapsed = 0.0
+        if mode == "buffered":
+            start = time.perf_counter()
+            flush_submissions(batch_size=options["batch_size"])
+            flush_elapsed = time.perf_counter() - start
+        saved = Response.objects.filter(
+            survey=survey, user__in=[user.pk for user in users]).count()
+        return {
+            "mode": mode,
+            "submits": len(latencies),
+            "errors": len(errors),
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "flush_rate": saved / flush_elapsed if flush_elapsed else None,
+            # Responses saved by second, submission and flush included
+            "saved_rate": (saved / (elapsed + flush_elapsed)
+                           if elapsed else 0.0),
+        }
@@ -0,0 +1,51 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.db import use_replica
+from survey.export import FORMATS, ExportStats, iter_export
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = ("Export the responses of a survey as CSV or JSON lines, one row "
+            "by response.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("survey_id", type=int)
+        parser.add_argument("--format", choices=FORMATS, default="csv")
+        parser.add_argument(
+            "--gzip", action="store_true", help="Gzip the export.")
+        parser.add_argument(
+            "--output", "-o", default="-",
+            help="Output file, the standard output by default.")
+        parser.add_argument(
+            "--chunk-size", type=int, default=2000,
+            help="Number of rows fetched from the database at once.")
+
+    def handle(self, *args, **options):
+        if not Survey.objects.filter(pk=options["survey_id"]).exists():
+            raise CommandError(
+                f"Survey {options['survey_id']} does not exist.")
+
+        stats = ExportStats()
+        chunks = iter_export(
+            options["survey_id"], export_format=options["format"],
+            compress=options["gzip"], chunk_size=options["chunk_size"],
+            stats=stats)
+        with use_replica():
+            if options["output"] == "-":
+                output = getattr(self.stdout, "_out", sys.stdout)
+                output = getattr(output, "buffer", output)
+                self.write_chunks(output, chunks)
+            else:
+                with open(options["output"], "wb") as output:
+                    self.write_chunks(output, chunks)
+        # The export may go to the standard output, report on stderr
+        self.stderr.write(f"Exported {stats}")
+
+    @staticmethod
+    def write_chunks(output, chunks):
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.definitions import FORMATS, dumps, export_definition, get_format
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = "Write the definition of a survey as JSON or YAML."
+
+    def add_arguments(self, parser):
+        parser.add_argument("survey_id", type=int)
+        parser.add_argument(
+            "--output", help="File to write, stdout by default.")
+        parser.add_argument(
+            "--format", choices=FORMATS,
+            help="Guessed from the extension by default.")
+
+    def handle(self, *args, **options):
+        survey = Survey.objects.filter(pk=options["survey_id"]).first()
+        if survey is None:
+            raise CommandError(f"Survey {options['survey_id']} doesn't exist.")
+        definition_format = (
+            options["format"] or get_format(options["output"] or ""))
+        content = dumps(export_definition(survey), definition_format)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                file.write(content)
+        else:
+            self.stdout.write(content)
@@ -0,0 +1,38 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from survey.finalizer import finalize_expired_attempts
+
+
+class Command(BaseCommand):
+    help = "Save the attempts past their deadline as 'Time Up' responses."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of attempts finalized by transaction.")
+        parser.add_argument(
+            "--grace", type=int, default=30,
+            help="Seconds left after the deadline for the browser to call "
+                 "the timeout endpoint.")
+        parser.add_argument(
+            "--loop", action="store_true",
+            help="Run forever, sweeping every --interval seconds.")
+        parser.add_argument("--interval", type=int, default=15)
+
+    def handle(self, *args, **options):
+        grace = timedelta(seconds=options["grace"])
+        while True:
+            start = time.perf_counter()
+            attempts, created = finalize_expired_attempts(
+                batch_size=options["batch_size"], grace=grace)
+            if attempts or not options["loop"]:
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f"{attempts} attempts finalized, {created} responses "
+                    f"created in {elapsed:.2f}s")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from survey.buffer import flush_submissions
+
+
+class Command(BaseCommand):
+    help = (
+        "Save the submissions pending in the write-behind buffer as "
+        "responses.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of submissions saved by transaction.")
+        parser.add_argument(
+            "--loop", action="store_true",
+            help="Run forever, flushing every --interval seconds.")
+        parser.add_argument("--interval", type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.perf_counter()
+            flushed, created = flush_submissions(
+                batch_size=options["batch_size"])
+            if flushed or not options["loop"]:
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f"{flushed} submissions flushed, {created} responses "
+                    f"created in {elapsed:.2f}s")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,72 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.definitions import FORMATS, get_format, import_definition, loads
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = "Create or update a survey from a JSON or YAML definition."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format", choices=FORMATS,
+            help="Guessed from the extension by default.")
+        parser.add_argument(
+            "--survey", type=int, help="Id of the survey to update.")
+        parser.add_argument(
+            "--user",
+            help="Username of the author of a new survey, the first "
+                 "superuser by default.")
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Delete the answered questions missing from the "
+                 "definition, with their answers.")
+
+    def handle(self, *args, **options):
+        survey = None
+        user = None
+        if options["survey"]:
+            survey = Survey.objects.filter(pk=options["survey"]).first()
+            if survey is None:
+                raise CommandError(
+                    f"Survey {options['survey']} doesn't exist.")
+        elif options["user"]:
+            user = User.objects.filter(username=options["user"]).first()
+            if user is None:
+                raise CommandError(f"User {options['user']} doesn't exist.")
+        else:
+            user = User.objects.filter(
+                is_superuser=True).order_by("pk").first()
+            if user is None:
+                raise CommandError("No superuser, use --user.")
+
+        start = time.perf_counter()
+        with open(options["path"], encoding="utf-8") as file:
+            content = file.read()
+        try:
+            definition = loads(
+                content, options["format"] or get_format(options["path"]))
+            parse_time = time.perf_counter() - start
+            result = import_definition(
+                definition, user=user, survey=survey, force=options["force"])
+        except ValidationError as error:
+            raise CommandError(
+                "Invalid definition:\n" + "\n".join(error.messages))
+
+        self.stdout.write(
+            f"Survey {result.survey.pk}: {result.created} questions created, "
+            f"{result.updated} updated, {result.deleted} deleted, "
+            f"{len(result.kept)} kept, {result.unchanged} unchanged")
+        for question in result.kept:
+            self.stdout.write(self.style.WARNING(
+                f"Question {question.pk} '{question.text}' has answers and "
+                "was kept, use --force to delete it."))
+        self.stdout.write(
+            f"parse {parse_time:.2f}s, "
+            f"validate {result.timings['validate']:.2f}s, "
+            f"write {result.timings['write']:.2f}s")
@@ -0,0 +1,73 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.ingest import BATCH_SIZE, Ingestion
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingest a JSONL file of responses collected offline, in batches. An "
+        "interrupted ingestion resumes from its last saved batch when run "
+        "again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--survey", type=int, required=True, help="Id of the survey.")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            "--workers", type=int, default=0,
+            help="Number of validation processes, 0 to validate in this "
+                 "process.")
+        parser.add_argument(
+            "--rejects",
+            help="File of the invalid lines, <path>.rejects.jsonl by default.")
+        parser.add_argument(
+            "--source",
+            help="Name of the checkpoint, the absolute path by default.")
+        parser.add_argument(
+            "--restart", action="store_true", help="Ignore the checkpoint.")
+
+    def handle(self, *args, **options):
+        survey = Survey.objects.filter(pk=options["survey"]).first()
+        if survey is None:
+            raise CommandError(f"Survey {options['survey']} doesn't exist.")
+        if options["batch_size"] < 1 or options["workers"] < 0:
+            raise CommandError(
+                "--batch-size must be positive and --workers can't be "
+                "negative.")
+        path = options["path"]
+        if not os.path.isfile(path):
+            raise CommandError(f"{path} doesn't exist.")
+
+        ingestion = Ingestion(
+            survey, path, rejects_path=options["rejects"],
+            batch_size=options["batch_size"], workers=options["workers"],
+            source=options["source"] or os.path.abspath(path))
+        start = time.perf_counter()
+        try:
+            checkpoint = ingestion.get_checkpoint(options["restart"])
+        except ValueError as error:
+            raise CommandError(str(error))
+        lines = checkpoint.lines
+        if lines:
+            self.stdout.write(f"Resuming after line {lines}")
+
+        def progress(checkpoint):
+            self.stdout.write(
+                f"{checkpoint.lines} lines: {checkpoint.accepted} accepted, "
+                f"{checkpoint.rejected} rejected")
+
+        checkpoint = ingestion.run(
+            progress=progress if options["verbosity"] > 1 else None)
+        elapsed = time.perf_counter() - start
+        ingested = checkpoint.lines - lines
+        rate = ingested / elapsed if elapsed else 0
+        self.stdout.write(
+            f"{checkpoint.lines} lines: {checkpoint.accepted} accepted, "
+            f"{checkpoint.rejected} rejected (see {ingestion.rejects_path})")
+        self.stdout.write(
+            f"{ingested} lines in {elapsed:.2f}s ({rate:.0f} lines/s)")
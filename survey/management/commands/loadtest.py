@@ -0,0 +1,110 @@
+import json
+import secrets
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from survey.loadtest import (BUDGET_METRICS, HttpClient, InProcessClient,
+                             check_budgets, create_fixture, delete_fixture,
+                             delete_leftover_fixtures, run)
+
+
+def parse_budget(value):
+    try:
+        metric, limit = value.split("=")
+        limit = float(limit)
+    except ValueError:
+        raise CommandError(f"Invalid budget '{value}', expected metric=value")
+    if metric not in BUDGET_METRICS:
+        raise CommandError(
+            f"Unknown budget '{metric}', expected one of "
+            f"{', '.join(BUDGET_METRICS)}")
+    return metric, limit
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate respondents taking a synthetic survey and report "
+        "throughput, latency percentiles, queries and session size by step. "
+        "Fails when a budget (SURVEY_LOADTEST_BUDGETS setting or --budget) "
+        "is exceeded."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--respondents", type=int, default=20)
+        parser.add_argument("--concurrency", type=int, default=10)
+        parser.add_argument("--questions", type=int, default=10)
+        parser.add_argument(
+            "--timeout-ratio", type=float, default=0.0,
+            help="Part of the respondents calling the timeout API halfway.")
+        parser.add_argument(
+            "--url",
+            help="Base URL of a running server, e.g. http://localhost:8000. "
+                 "In-process by default.")
+        parser.add_argument(
+            "--budget", action="append", default=[], type=parse_budget,
+            help=f"metric=value, repeatable. "
+                 f"Metrics: {', '.join(BUDGET_METRICS)}.")
+        parser.add_argument(
+            "--json", action="store_true", help="Print the results as JSON.")
+        parser.add_argument(
+            "--cleanup", action="store_true",
+            help="Only delete the surveys and users left by interrupted runs.")
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            surveys, users = delete_leftover_fixtures()
+            self.stdout.write(f"{surveys} surveys and {users} users deleted")
+            return
+        budgets = dict(getattr(settings, "SURVEY_LOADTEST_BUDGETS", {}))
+        budgets.update(options["budget"])
+
+        # Only logged in with a password over HTTP, a new one by run
+        password = secrets.token_urlsafe() if options["url"] else None
+        survey, users = create_fixture(
+            options["respondents"], options["questions"], password=password)
+        try:
+            if options["url"]:
+                summary = run(
+                    survey, users,
+                    lambda user: HttpClient(options["url"], user, password),
+                    options["concurrency"], options["timeout_ratio"])
+            else:
+                # The test client uses the 'testserver' host
+                allowed_hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+                with override_settings(ALLOWED_HOSTS=allowed_hosts):
+                    summary = run(
+                        survey, users, InProcessClient,
+                        options["concurrency"], options["timeout_ratio"])
+        finally:
+            delete_fixture(survey, users)
+
+        failures = check_budgets(summary, budgets)
+        if options["json"]:
+            self.stdout.write(json.dumps(dict(summary, failures=failures)))
+        else:
+            self.write_report(summary)
+        if failures:
+            raise CommandError("Budgets exceeded: " + "; ".join(failures))
+
+    def write_report(self, summary):
+        self.stdout.write(
+            f"{summary['requests']} requests, {summary['errors']} errors, "
+            f"{summary['throughput']:.1f} req/s, "
+            f"p50 {summary['p50_ms']:.1f} ms, "
+            f"p95 {summary['p95_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms")
+        self.stdout.write(
+            f"{'request':<14}{'count':>7}{'errors':>8}{'p50 ms':>9}"
+            f"{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'session B':>11}")
+        for name, row in summary["requests_by_name"].items():
+            queries = "-"
+            if row["queries"] is not None:
+                queries = f"{row['queries']:.1f}"
+            session = "-"
+            if row["session_bytes"] is not None:
+                session = str(row["session_bytes"])
+            self.stdout.write(
+                f"{name:<14}{row['requests']:>7}{row['errors']:>8}"
+                f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+                f"{row['p99_ms']:>9.1f}{queries:>9}{session:>11}")
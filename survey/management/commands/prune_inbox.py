@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from survey import inbox
+
+
+class Command(BaseCommand):
+    help = "Delete the expired surveys from the user inboxes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild", action="store_true",
+            help="Rebuild all the inboxes from scratch instead.")
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            inbox.rebuild()
+            self.stdout.write(self.style.SUCCESS("Inboxes rebuilt."))
+            return
+        deleted = inbox.prune_expired()
+        self.stdout.write(
+            self.style.SUCCESS(f"{deleted} expired entries deleted."))
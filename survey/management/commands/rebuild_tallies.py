@@ -0,0 +1,82 @@
+import time
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+
+from survey.live import notify_change
+from survey.models import (Answer, AnswerChoice, ChoiceTally, QuestionTally,
+                           Response, Survey, SurveyArchive, SurveyTally)
+from survey.tallies import RESPONSE_TYPE_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the result tallies of surveys from their answers. The "
+        "archived surveys are skipped: their answers are no longer in the "
+        "database, their tallies are kept as they were when archived."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "survey_ids", nargs="*", type=int,
+            help="Surveys to rebuild, all the surveys by default.")
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.order_by("pk")
+        if options["survey_ids"]:
+            surveys = surveys.filter(pk__in=options["survey_ids"])
+        archived = set(
+            SurveyArchive.objects.values_list("survey_id", flat=True))
+        for survey_id in surveys.values_list("pk", flat=True):
+            if survey_id in archived:
+                self.stdout.write(f"Survey {survey_id}: archived, skipped")
+                continue
+            start = time.perf_counter()
+            count = self.rebuild(survey_id)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f"Survey {survey_id}: {count} responses in {elapsed:.2f}s")
+
+    @transaction.atomic
+    def rebuild(self, survey_id):
+        """
+        Recompute the tallies of a survey with one aggregate query by table.
+        """
+        for model in [SurveyTally, QuestionTally, ChoiceTally]:
+            model.objects.filter(survey_id=survey_id).delete()
+
+        tally = SurveyTally(survey_id=survey_id)
+        for row in Response.objects.filter(survey_id=survey_id).values(
+                "response_type").annotate(count=Count("pk")).order_by():
+            setattr(tally, RESPONSE_TYPE_FIELDS[row["response_type"]],
+                    row["count"])
+        tally.save()
+
+        answered = Answer.objects.filter(
+            response__survey_id=survey_id).exclude(
+            Q(body__isnull=True) | Q(body__in=["", "[]"]))
+        answered = answered.values(
+            "question_id", "response__response_type").annotate(
+            count=Count("pk")).order_by()
+        QuestionTally.objects.bulk_create([
+            QuestionTally(survey_id=survey_id, question_id=row["question_id"],
+                          response_type=row["response__response_type"],
+                          answered=row["count"])
+            for row in answered
+        ], batch_size=1000)
+
+        choices = AnswerChoice.objects.filter(
+            response__survey_id=survey_id).values(
+            "question_id", "choice", "response__response_type").annotate(
+            count=Count("pk")).order_by()
+        ChoiceTally.objects.bulk_create([
+            ChoiceTally(survey_id=survey_id, question_id=row["question_id"],
+                        choice=row["choice"],
+                        response_type=row["response__response_type"],
+                        count=row["count"])
+            for row in choices
+        ], batch_size=1000)
+        transaction.on_commit(partial(notify_change, survey_id))
+        return tally.total
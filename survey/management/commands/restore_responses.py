@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.archive import ArchiveError, restore_survey
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = "Move the archived responses of a survey back to the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("survey_id", type=int)
+
+    def handle(self, *args, **options):
+        survey = Survey.objects.filter(pk=options["survey_id"]).first()
+        if survey is None:
+            raise CommandError(f"Survey {options['survey_id']} doesn't exist.")
+        try:
+            responses, answers = restore_survey(survey)
+        except ArchiveError as error:
+            raise CommandError(str(error))
+        self.stdout.write(
+            f"Restored {responses} responses and {answers} answers of "
+            f"survey {survey.pk}")
@@ -0,0 +1,307 @@
+"""
+Per-request performance metrics.
+
+survey.middleware.PerformanceMiddleware measures each request (database
+queries and their time, template rendering, session and response sizes,
+and the timer() blocks of the views), sends them back in a Server-Timing
+header and adds them to histograms labelled by URL name.
+
+Each process keeps its histograms in memory and, when SURVEY_METRICS_DIR is
+set, writes them at most every SURVEY_METRICS_FLUSH_INTERVAL seconds to its
+own file in that directory. The /metrics view adds up the files of all the
+worker processes and renders them in the Prometheus text format. Empty the
+directory when deploying, like the counters of a restarted service.
+"""
+import contextvars
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from django.template.exceptions import TemplateDoesNotExist
+
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# name: (help, buckets)
+HISTOGRAMS = {
+    "survey_request_duration_seconds": (
+        "Duration of the requests.", SECONDS_BUCKETS),
+    "survey_request_db_queries": (
+        "Database queries by request.", COUNT_BUCKETS),
+    "survey_request_db_seconds": (
+        "Time spent in database queries by request.", SECONDS_BUCKETS),
+    "survey_request_template_seconds": (
+        "Template rendering time by request.", SECONDS_BUCKETS),
+    "survey_request_session_bytes": (
+        "Size of the session data by request.", BYTES_BUCKETS),
+    "survey_response_bytes": (
+        "Size of the responses.", BYTES_BUCKETS),
+    "survey_timer_seconds": (
+        "Duration of the timed blocks of the views.", SECONDS_BUCKETS),
+}
+
+_current = contextvars.ContextVar("survey_request_metrics", default=None)
+
+
+class RequestMetrics:
+    """
+    Measures of the request being served.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        # Accumulated duration of the timers, in order of first use
+        self.timers = {}
+
+    def add_timer(self, name, duration):
+        self.timers[name] = self.timers.get(name, 0.0) + duration
+
+    @property
+    def duration(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """
+        Return the value of the Server-Timing header.
+        """
+        entries = [
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"']
+        entries += [
+            f"{name};dur={duration * 1000:.1f}"
+            for name, duration in self.timers.items()]
+        entries.append(f"total;dur={self.duration * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def start_request():
+    """
+    Start measuring a request in the current context.
+
+    :rtype: tuple (RequestMetrics, token to give to end_request)
+    """
+    metrics = RequestMetrics()
+    return metrics, _current.set(metrics)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def get_current():
+    return _current.get()
+
+
+@contextmanager
+def timer(name):
+    """
+    Time a block of code of the current request, does nothing outside a
+    measured request.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_timer(name, time.perf_counter() - start)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting the queries of the current request.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - start
+
+
+def install_query_recorder(connection, **kwargs):
+    """
+    Add record_query to a connection, connected to connection_created.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class TimedTemplate(Template):
+
+    def render(self, context=None, request=None):
+        with timer("template"):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    Django template backend adding the rendering time of the templates to
+    the request metrics.
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class Registry:
+    """
+    Histograms of a process. Values are kept as counts by bucket (the last
+    one being +Inf), then the sum and the count.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+        self.last_flush = 0.0
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, tuple(sorted(labels.items())))
+        index = next(
+            (i for i, bound in enumerate(buckets) if value <= bound),
+            len(buckets))
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def dump(self):
+        with self.lock:
+            return [
+                [name, list(labels), list(values)]
+                for (name, labels), values in self.values.items()
+            ]
+
+    def flush(self, force=False):
+        """
+        Write the histograms to the file of the process.
+        """
+        directory = get_metrics_dir()
+        interval = getattr(settings, "SURVEY_METRICS_FLUSH_INTERVAL", 1.0)
+        now = time.monotonic()
+        if not directory or (not force and now - self.last_flush < interval):
+            return
+        self.last_flush = now
+        fd, path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(self.dump(), file)
+        os.replace(
+            path, os.path.join(directory, f"metrics-{os.getpid()}.json"))
+
+
+registry = Registry()
+
+
+def get_metrics_dir():
+    return getattr(settings, "SURVEY_METRICS_DIR", None)
+
+
+def observe_request(request, response, metrics):
+    """
+    Add the measures of a request to the histograms.
+    """
+    match = getattr(request, "resolver_match", None)
+    view = (match.url_name or match.view_name) if match else "unresolved"
+    labels = {"view": view}
+    registry.observe(
+        "survey_request_duration_seconds", labels, metrics.duration)
+    registry.observe("survey_request_db_queries", labels, metrics.queries)
+    registry.observe("survey_request_db_seconds", labels, metrics.db_time)
+    registry.observe(
+        "survey_request_template_seconds", labels,
+        metrics.timers.get("template", 0.0))
+    session = getattr(request, "session", None)
+    if session is not None and session.accessed:
+        size = len(session.encode(dict(session.items())))
+        registry.observe("survey_request_session_bytes", labels, size)
+    if not response.streaming:
+        registry.observe(
+            "survey_response_bytes", labels, len(response.content))
+    for name, duration in metrics.timers.items():
+        if name != "template":
+            registry.observe(
+                "survey_timer_seconds", dict(labels, timer=name), duration)
+    registry.flush()
+
+
+def collect():
+    """
+    Return the histograms of all the processes added up.
+
+    :rtype: dict of values keyed by (name, labels)
+    """
+    directory = get_metrics_dir()
+    if not directory:
+        dumps = [registry.dump()]
+    else:
+        registry.flush(force=True)
+        dumps = []
+        for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+            try:
+                with open(path) as file:
+                    dumps.append(json.load(file))
+            except (OSError, ValueError):
+                # Being replaced, counted at the next scrape
+                continue
+    totals = {}
+    for dump in dumps:
+        for name, labels, values in dump:
+            if name not in HISTOGRAMS:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            total = totals.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+    return totals
+
+
+def _format_labels(labels):
+    return ",".join(
+        '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+        for key, value in labels)
+
+
+def render_prometheus(totals):
+    """
+    Render histograms in the Prometheus text format.
+    """
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), values in sorted(totals.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], values):
+                cumulative += count
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+            label_text = _format_labels(labels)
+            lines.append(f"{name}_sum{{{label_text}}} {values[-2]}")
+            lines.append(f"{name}_count{{{label_text}}} {values[-1]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,96 @@
+import asyncio
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from survey import db
+from survey.metrics import (
+    end_request, install_query_recorder, observe_request, start_request)
+
+
+class PerformanceMiddleware:
+    """
+    Measure each request, add a Server-Timing header and record the
+    measures in the histograms of survey.metrics. Should be the first
+    middleware, so its time includes the other ones.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Mark the middleware as async, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        connection_created.connect(install_query_recorder)
+        for connection in connections.all():
+            install_query_recorder(connection)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics, token = start_request()
+        try:
+            response = self.get_response(request)
+            self.process_response(request, response, metrics)
+        finally:
+            end_request(token)
+        return response
+
+    async def __acall__(self, request):
+        metrics, token = start_request()
+        try:
+            response = await self.get_response(request)
+            self.process_response(request, response, metrics)
+        finally:
+            end_request(token)
+        return response
+
+    @staticmethod
+    def process_response(request, response, metrics):
+        response["Server-Timing"] = metrics.server_timing()
+        observe_request(request, response, metrics)
+
+
+class ReplicaPinMiddleware:
+    """
+    Keep the reads of a client on the primary database for
+    SURVEY_REPLICA_PIN_SECONDS after a request which wrote, see survey.db.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state, token = db.start_request(
+            pinned=db.PIN_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+        finally:
+            db.end_request(token)
+        return self.process_response(state, response)
+
+    async def __acall__(self, request):
+        state, token = db.start_request(
+            pinned=db.PIN_COOKIE in request.COOKIES)
+        try:
+            response = await self.get_response(request)
+        finally:
+            db.end_request(token)
+        return self.process_response(state, response)
+
+    @staticmethod
+    def process_response(state, response):
+        if state.wrote and db.get_replicas():
+            response.set_cookie(
+                db.PIN_COOKIE, "1",
+                max_age=getattr(settings, "SURVEY_REPLICA_PIN_SECONDS", 10),
+                httponly=True, samesite="Lax")
+        return response
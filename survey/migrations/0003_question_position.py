@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 00:31
+
+from django.db import migrations, models
+
+
+def number_questions(apps, schema_editor):
+    """
+    Number the existing questions of every survey in their current order.
+    """
+    Question = apps.get_model('survey', 'Question')
+    changed = []
+    survey_id = None
+    position = 0
+    for question in Question.objects.order_by('survey_id', 'pk').iterator():
+        if question.survey_id != survey_id:
+            survey_id = question.survey_id
+            position = 0
+        question.position = position
+        position += 1
+        changed.append(question)
+    Question.objects.bulk_update(changed, ['position'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0002_auto_20210805_0528'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='question',
+            options={'ordering': ('position', 'pk'), 'verbose_name': 'question', 'verbose_name_plural': 'questions'},
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='position',
+            field=models.PositiveIntegerField(blank=True, help_text='Step of the question in the survey, starting from 0. Leave empty to add the question at the end.', null=True),
+        ),
+        migrations.RunPython(number_questions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['survey', 'position'], name='question_survey_position'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 00:32
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_responses(apps, schema_editor):
+    """
+    Keep only the most recent response of a user to a survey, older
+    duplicates would violate the new constraint.
+    """
+    Response = apps.get_model('survey', 'Response')
+    duplicates = (
+        Response.objects.filter(user__isnull=False)
+        .values('survey_id', 'user_id')
+        .annotate(count=Count('id'), last_id=Max('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        Response.objects.filter(
+            survey_id=duplicate['survey_id'], user_id=duplicate['user_id']
+        ).exclude(id=duplicate['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0003_question_position'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_responses, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='response',
+            constraint=models.UniqueConstraint(fields=('survey', 'user'), name='unique_survey_user_response'),
+        ),
+    ]
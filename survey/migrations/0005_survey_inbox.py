@@ -0,0 +1,61 @@
+# Generated by Django 3.2.25 on 2026-10-18 00:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Q
+from django.utils import timezone
+
+
+def fill_inboxes(apps, schema_editor):
+    """
+    Add the open surveys to the inbox of the staff users who didn't
+    respond to them.
+    """
+    InboxEntry = apps.get_model('survey', 'InboxEntry')
+    Response = apps.get_model('survey', 'Response')
+    Survey = apps.get_model('survey', 'Survey')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    staff = list(User.objects.filter(is_staff=True, is_active=True).values_list('pk', flat=True))
+    surveys = Survey.objects.filter(
+        Q(expire_date__isnull=True) | Q(expire_date__gt=timezone.now()))
+    for survey in surveys.iterator():
+        responded = set(Response.objects.filter(survey=survey).values_list('user_id', flat=True))
+        InboxEntry.objects.bulk_create([
+            InboxEntry(user_id=user_id, survey=survey, expire_date=survey.expire_date)
+            for user_id in staff if user_id not in responded
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('survey', '0004_response_unique_participation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='survey',
+            name='is_active',
+            field=models.BooleanField(default=True, help_text='Only active surveys are published to the users'),
+        ),
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expire_date', models.DateTimeField(null=True)),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='survey.survey')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='survey_inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['expire_date'], name='inbox_expire_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='inboxentry',
+            constraint=models.UniqueConstraint(fields=('user', 'survey'), name='unique_inbox_user_survey'),
+        ),
+        migrations.RunPython(fill_inboxes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-18 00:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0005_survey_inbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyTally',
+            fields=[
+                ('survey', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='tally', serialize=False, to='survey.survey')),
+                ('submitted', models.PositiveIntegerField(default=0)),
+                ('timeup', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QuestionTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('response_type', models.CharField(choices=[('submitted', 'Submitted'), ('timeup', 'Time Up')], max_length=20)),
+                ('answered', models.PositiveIntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tallies', to='survey.question')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='question_tallies', to='survey.survey')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChoiceTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('choice', models.CharField(max_length=400)),
+                ('response_type', models.CharField(choices=[('submitted', 'Submitted'), ('timeup', 'Time Up')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='choice_tallies', to='survey.question')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='choice_tallies', to='survey.survey')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='questiontally',
+            constraint=models.UniqueConstraint(fields=('question', 'response_type'), name='unique_question_tally'),
+        ),
+        migrations.AddConstraint(
+            model_name='choicetally',
+            constraint=models.UniqueConstraint(fields=('question', 'choice', 'response_type'), name='unique_choice_tally'),
+        ),
+    ]
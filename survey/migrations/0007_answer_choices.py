@@ -0,0 +1,95 @@
+# Generated by Django 3.2.25 on 2026-10-18 00:36
+
+import ast
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils.text import slugify
+
+
+def parse_body(body):
+    """
+    Parse a multiple select answer stored as the string of a Python list.
+    """
+    if not body:
+        return []
+    try:
+        values = json.loads(body)
+    except ValueError:
+        try:
+            values = ast.literal_eval(body)
+        except (ValueError, SyntaxError):
+            return [body]
+    if isinstance(values, (list, tuple)):
+        return [str(value) for value in values]
+    return [str(values)]
+
+
+def convert_answers(apps, schema_editor):
+    """
+    Store multiple select answers as JSON arrays and index the picked
+    choices of radio and multiple select answers.
+    """
+    Answer = apps.get_model('survey', 'Answer')
+    AnswerChoice = apps.get_model('survey', 'AnswerChoice')
+    Question = apps.get_model('survey', 'Question')
+
+    questions = {}
+    for question in Question.objects.filter(question_type__in=['radio', 'select']):
+        slugs = {}
+        for choice in (question.choices or '').split(','):
+            choice = choice.strip()
+            if choice:
+                slug = slugify(choice, allow_unicode=True)
+                slugs[choice] = slug
+                slugs[slug] = slug
+        questions[question.pk] = (question.question_type, slugs)
+
+    answers = Answer.objects.filter(question_id__in=list(questions)).order_by('pk')
+    changed = []
+    choices = []
+    for answer in answers.iterator(chunk_size=2000):
+        question_type, slugs = questions[answer.question_id]
+        if question_type == 'select':
+            values = parse_body(answer.body)
+            answer.body = json.dumps(values)
+            changed.append(answer)
+        else:
+            values = [answer.body] if answer.body else []
+        for value in dict.fromkeys(values):
+            if value in slugs:
+                choices.append(AnswerChoice(
+                    response_id=answer.response_id, question_id=answer.question_id,
+                    choice=slugs[value]))
+        if len(changed) >= 2000 or len(choices) >= 2000:
+            Answer.objects.bulk_update(changed, ['body'])
+            AnswerChoice.objects.bulk_create(choices)
+            changed = []
+            choices = []
+    Answer.objects.bulk_update(changed, ['body'])
+    AnswerChoice.objects.bulk_create(choices)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0006_tallies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerChoice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('choice', models.CharField(max_length=400)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_choices', to='survey.question')),
+                ('response', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_choices', to='survey.response')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='answerchoice',
+            index=models.Index(fields=['question', 'choice'], name='answer_choice_question'),
+        ),
+        migrations.RunPython(convert_answers, migrations.RunPython.noop),
+    ]
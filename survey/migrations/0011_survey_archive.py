@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 00:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0010_ingestion_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyArchive',
+            fields=[
+                ('survey', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='survey.survey')),
+                ('path', models.CharField(max_length=500)),
+                ('responses', models.PositiveIntegerField(default=0)),
+                ('answers', models.PositiveIntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0, help_text='Size of the file in bytes')),
+                ('sha256', models.CharField(max_length=64)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
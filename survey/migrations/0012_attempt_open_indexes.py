@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0011_survey_archive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attempt',
+            name='deadline',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='attempt',
+            index=models.Index(condition=models.Q(('finalized_at__isnull', True)), fields=['deadline'], name='attempt_open_deadline'),
+        ),
+        migrations.AddIndex(
+            model_name='attempt',
+            index=models.Index(condition=models.Q(('finalized_at__isnull', True)), fields=['survey', 'deadline'], name='attempt_open_survey_deadline'),
+        ),
+    ]
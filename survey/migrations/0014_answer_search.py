@@ -0,0 +1,65 @@
+from django.db import OperationalError, migrations
+
+# The names are used by survey.search
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE survey_answer_fts USING fts5("
+    "body, content='survey_answer', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER survey_answer_fts_insert AFTER INSERT ON survey_answer BEGIN "
+    "INSERT INTO survey_answer_fts(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER survey_answer_fts_delete AFTER DELETE ON survey_answer BEGIN "
+    "INSERT INTO survey_answer_fts(survey_answer_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER survey_answer_fts_update AFTER UPDATE OF body ON survey_answer BEGIN "
+    "INSERT INTO survey_answer_fts(survey_answer_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO survey_answer_fts(rowid, body) VALUES (new.id, new.body); END",
+    "INSERT INTO survey_answer_fts(survey_answer_fts) VALUES ('rebuild')",
+]
+SQLITE_REMOVE = [
+    "DROP TRIGGER IF EXISTS survey_answer_fts_insert",
+    "DROP TRIGGER IF EXISTS survey_answer_fts_delete",
+    "DROP TRIGGER IF EXISTS survey_answer_fts_update",
+    "DROP TABLE IF EXISTS survey_answer_fts",
+]
+POSTGRESQL_INDEX = [
+    "CREATE INDEX survey_answer_body_search ON survey_answer "
+    "USING gin (to_tsvector('simple', coalesce(body, '')))",
+]
+POSTGRESQL_REMOVE = [
+    "DROP INDEX IF EXISTS survey_answer_body_search",
+]
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Index the answer bodies for full-text search, kept up to date by the
+    database itself: FTS5 table and triggers on SQLite, GIN expression index
+    on PostgreSQL. Other databases search with a scan.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite":
+        try:
+            schema_editor.execute(SQLITE_INDEX[0])
+        except OperationalError:
+            # SQLite built without FTS5
+            return
+        for statement in SQLITE_INDEX[1:]:
+            schema_editor.execute(statement)
+    elif connection.vendor == "postgresql":
+        for statement in POSTGRESQL_INDEX:
+            schema_editor.execute(statement)
+
+
+def remove_search_index(apps, schema_editor):
+    statements = {"sqlite": SQLITE_REMOVE, "postgresql": POSTGRESQL_REMOVE}
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('survey', '0013_pending_submissions'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, remove_search_index),
+    ]
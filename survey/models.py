@@ -1,7 +1,12 @@
+import ast
+import json
+from datetime import timedelta
+
 from django.contrib.auth.models import User
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 
@@ -27,6 +32,30 @@ def validate_choices(choices):
         raise ValidationError("Choices must contain more than one item.")
 
 
+def parse_select_body(body):
+    """
+    Return the list of values of a multiple select answer.
+
+    :param body: A list, or the body of an answer: a JSON array, or the
+        string of a Python list for answers saved before it was JSON.
+    :rtype: List of String
+    """
+    if body is None:
+        return []
+    if isinstance(body, (list, tuple)):
+        return [str(value) for value in body]
+    try:
+        values = json.loads(body)
+    except ValueError:
+        try:
+            values = ast.literal_eval(body)
+        except (ValueError, SyntaxError):
+            return [body] if body else []
+    if isinstance(values, (list, tuple)):
+        return [str(value) for value in values]
+    return [str(values)]
+
+
 class QuestionType(models.TextChoices):
     TEXT = 'text', 'Text Input'
     RADIO = 'radio', 'Radio'
@@ -42,6 +71,9 @@ class Survey(models.Model):
     description = models.TextField()
     duration = models.IntegerField(help_text="Survey duration in minutes")
     expire_date = models.DateTimeField(null=True)
+    is_active = models.BooleanField(
+        default=True,
+        help_text="Only active surveys are published to the users")
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name="surveys")
@@ -51,7 +83,28 @@ class Survey(models.Model):
         verbose_name_plural = _("Surveys")
 
     def total_responses(self):
-        return self.responses.count()
+        try:
+            return self.tally.total
+        except ObjectDoesNotExist:
+            return 0
+
+    def renumber_questions(self):
+        """
+        Make the question positions contiguous (0, 1, 2...) keeping their
+        current order, so the position of a question is its step.
+        """
+        questions = list(self.questions.order_by("position", "pk"))
+        changed = []
+        for position, question in enumerate(questions):
+            if question.position != position:
+                question.position = position
+                changed.append(question)
+        if changed:
+            Question.objects.bulk_update(changed, ["position"])
+            # bulk_update doesn't send post_save
+            from survey.schema import bump_schema_version
+            bump_schema_version(self.pk)
+        return len(changed)
     
     def get_instruction_url(self):
         return reverse("survey-instructions", kwargs={"id": self.pk})
@@ -78,14 +131,26 @@ class Question(models.Model):
     )
     choices = models.TextField(
         help_text=QUESTION_CHOICE_HELP_TEXT, blank=True, null=True)
+    position = models.PositiveIntegerField(
+        blank=True, null=True,
+        help_text="Step of the question in the survey, starting from 0. "
+                  "Leave empty to add the question at the end.")
 
     class Meta:
         verbose_name = _("question")
         verbose_name_plural = _("questions")
+        ordering = ("position", "pk")
+        indexes = [
+            models.Index(fields=["survey", "position"],
+                         name="question_survey_position"),
+        ]
 
     def save(self, *args, **kwargs):
         if self.question_type in [QuestionType.RADIO, QuestionType.SELECT]:
             validate_choices(self.choices)
+        if self.position is None:
+            self.position = Question.objects.filter(
+                survey_id=self.survey_id).count()
         super().save(*args, **kwargs)
 
     def get_clean_choices(self):
@@ -111,6 +176,13 @@ class Question(models.Model):
         choices_tuple = tuple(choices_list)
         return choices_tuple
 
+    def is_valid_choice(self, value):
+        """
+        Return True if value is one of the choice labels or slugs.
+        """
+        return value in self.get_clean_choices() or \
+            value in [slug for slug, _ in self.get_choices()]
+
     def __str__(self):
         return f"Question {self.text}"
 
@@ -135,10 +207,44 @@ class Response(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            # A user can participate only once in a survey, this also
+            # indexes the participation lookups.
+            models.UniqueConstraint(
+                fields=["survey", "user"], name="unique_survey_user_response"),
+        ]
+
     def __str__(self):
         return f"Response to {self.survey} by {self.user}"
 
 
+class InboxEntry(models.Model):
+    """
+    A survey available to a user: active, not answered yet and not expired
+    when the entry was written. Maintained incrementally by survey.inbox.
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="survey_inbox")
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="inbox_entries")
+    # Copied from the survey so expired entries are filtered without a join
+    expire_date = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "survey"], name="unique_inbox_user_survey"),
+        ]
+        indexes = [
+            models.Index(fields=["expire_date"], name="inbox_expire_date"),
+        ]
+
+    def __str__(self):
+        return f"{self.survey} for {self.user}"
+
+
 class Answer(models.Model):
     """
     Answer is represented as user input of a survey
@@ -153,10 +259,9 @@ class Answer(models.Model):
     body = models.TextField(_("Content"), blank=True, null=True)
 
     def __init__(self, *args, **kwargs):
-        try:
-            question = Question.objects.get(pk=kwargs["question_id"])
-        except KeyError:
-            question = kwargs.get("question")
+        # Only validate when a question object is given, looking it up from
+        # 'question_id' would cost a query for every answer.
+        question = kwargs.get("question")
         body = kwargs.get("body")
         if question and body:
             self.check_answer_body(question, body)
@@ -165,17 +270,296 @@ class Answer(models.Model):
     def check_answer_body(self, question, body):
         """
         Check if the answer body is in question choices if the question is
-        in Radio or Select type
+        in Radio or Select type. Both the choice labels and their slugs
+        (as posted by the form) are accepted. The question can be a Question
+        or a survey.schema.CompiledQuestion.
         """
         if question.question_type in [QuestionType.RADIO, QuestionType.SELECT]:
-            choices = question.get_clean_choices()
-            if body:
+            answers = []
+            if question.question_type == QuestionType.SELECT:
+                answers = parse_select_body(body)
+            elif body:
                 answers = [body]
             for answer in answers:
-                if answer not in choices:
+                if not question.is_valid_choice(answer):
+                    choices = question.get_clean_choices()
                     msg = f"Answer '{body}' should be in {choices} "
                     raise ValidationError(msg)
 
+    @staticmethod
+    def serialize_body(question, value):
+        """
+        Return the body to store for a value of a form field, multiple
+        select answers are stored as a JSON array.
+        """
+        if question.question_type == QuestionType.SELECT:
+            return json.dumps(parse_select_body(value))
+        return value
+
     def __str__(self):
         return f"{self.__class__.__name__} to \
             '{self.question}' : '{self.body}'"
+
+
+class AttemptQuerySet(models.QuerySet):
+
+    def in_progress(self, now=None):
+        """
+        Attempts not finalized and still in time.
+        """
+        return self.filter(
+            finalized_at__isnull=True, deadline__gt=now or timezone.now())
+
+    def past_deadline(self, now=None):
+        """
+        Attempts not finalized whose time is up.
+        """
+        return self.filter(
+            finalized_at__isnull=True, deadline__lte=now or timezone.now())
+
+
+class Attempt(models.Model):
+    """
+    A user taking a survey, from the first step until the response is saved
+    by the user, the timeout view or the finalize_expired_attempts command.
+    The remaining time of the steps is computed from its deadline.
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="survey_attempts")
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="attempts")
+    started_at = models.DateTimeField(auto_now_add=True)
+    deadline = models.DateTimeField()
+    finalized_at = models.DateTimeField(null=True, blank=True)
+
+    objects = AttemptQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["survey", "user"], name="unique_survey_user_attempt"),
+        ]
+        # Only the open attempts are looked up by deadline: in progress or
+        # past the deadline, in a survey or in all of them (finalizer)
+        indexes = [
+            models.Index(
+                fields=["deadline"], name="attempt_open_deadline",
+                condition=models.Q(finalized_at__isnull=True)),
+            models.Index(
+                fields=["survey", "deadline"],
+                name="attempt_open_survey_deadline",
+                condition=models.Q(finalized_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"Attempt of {self.user_id} to {self.survey_id}"
+
+    @classmethod
+    def start(cls, user, survey):
+        """
+        Return the attempt of a user to a survey, starting it if needed.
+        """
+        deadline = timezone.now() + timedelta(minutes=survey.duration)
+        attempt, _ = cls.objects.get_or_create(
+            user=user, survey=survey, defaults={"deadline": deadline})
+        return attempt
+
+    def get_remaining(self, now=None):
+        """
+        Return the seconds left before the deadline, 0 when the time is up.
+        """
+        remaining = self.deadline - (now or timezone.now())
+        return max(remaining.total_seconds(), 0)
+
+    def is_expired(self, now=None):
+        return self.get_remaining(now) == 0
+
+
+class DraftAnswer(models.Model):
+    """
+    Answer to a question of a survey in progress, saved at each step by
+    survey.drafts.DatabaseDraftStore.
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="draft_answers")
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="draft_answers")
+    question = models.ForeignKey(
+        Question, on_delete=models.CASCADE, related_name="draft_answers")
+    # JSON encoded form value
+    value = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "survey", "question"],
+                name="unique_draft_answer"),
+        ]
+
+    def __str__(self):
+        return f"Draft of {self.user_id} to {self.question_id}"
+
+
+class AnswerChoice(models.Model):
+    """
+    A choice picked in the answer to a radio or multiple select question,
+    so choices can be counted and filtered with an index.
+    """
+
+    response = models.ForeignKey(
+        Response, on_delete=models.CASCADE, related_name="answer_choices")
+    question = models.ForeignKey(
+        Question, on_delete=models.CASCADE, related_name="answer_choices")
+    choice = models.CharField(max_length=400)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["question", "choice"], name="answer_choice_question"),
+        ]
+
+    def __str__(self):
+        return f"{self.choice} to {self.question_id}"
+
+
+class SurveyTally(models.Model):
+    """
+    Number of responses of a survey by response type.
+    Maintained by survey.tallies.
+    """
+
+    survey = models.OneToOneField(
+        Survey, on_delete=models.CASCADE, primary_key=True,
+        related_name="tally")
+    submitted = models.PositiveIntegerField(default=0)
+    timeup = models.PositiveIntegerField(default=0)
+
+    @property
+    def total(self):
+        return self.submitted + self.timeup
+
+    def __str__(self):
+        return f"Tally of {self.survey_id}: {self.total}"
+
+
+class QuestionTally(models.Model):
+    """
+    Number of responses which answered a question, by response type.
+    Maintained by survey.tallies.
+    """
+
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="question_tallies")
+    question = models.ForeignKey(
+        Question, on_delete=models.CASCADE, related_name="tallies")
+    response_type = models.CharField(
+        max_length=20, choices=ResponseType.choices)
+    answered = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["question", "response_type"],
+                name="unique_question_tally"),
+        ]
+
+    def __str__(self):
+        return f"{self.question_id} ({self.response_type}): {self.answered}"
+
+
+class ChoiceTally(models.Model):
+    """
+    Number of times a choice of a question was picked, by response type.
+    Maintained by survey.tallies.
+    """
+
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="choice_tallies")
+    question = models.ForeignKey(
+        Question, on_delete=models.CASCADE, related_name="choice_tallies")
+    choice = models.CharField(max_length=400)
+    response_type = models.CharField(
+        max_length=20, choices=ResponseType.choices)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["question", "choice", "response_type"],
+                name="unique_choice_tally"),
+        ]
+
+    def __str__(self):
+        return (f"{self.question_id} {self.choice} ({self.response_type}): "
+                f"{self.count}")
+
+
+class IngestionCheckpoint(models.Model):
+    """
+    Progress of the ingestion of a response file by the ingest_responses
+    command, saved in the transaction of each batch so an interrupted
+    ingestion resumes after the last saved batch.
+    """
+
+    source = models.CharField(max_length=500, unique=True)
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="ingestion_checkpoints")
+    offset = models.BigIntegerField(
+        default=0, help_text="Bytes of the file already ingested")
+    lines = models.PositiveIntegerField(default=0)
+    accepted = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Ingestion of {self.source}"
+
+
+class SurveyArchive(models.Model):
+    """
+    Responses of a survey moved out of the database into a gzip JSON lines
+    file by survey.archive.
+    """
+
+    survey = models.OneToOneField(
+        Survey, on_delete=models.CASCADE, primary_key=True,
+        related_name="archive")
+    path = models.CharField(max_length=500)
+    responses = models.PositiveIntegerField(default=0)
+    answers = models.PositiveIntegerField(default=0)
+    size = models.BigIntegerField(
+        default=0, help_text="Size of the file in bytes")
+    sha256 = models.CharField(max_length=64)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archive of {self.survey_id} ({self.responses} responses)"
+
+
+class PendingSubmission(models.Model):
+    """
+    Final answers of a user accepted by the write-behind buffer
+    (survey.buffer) and not saved as a response yet.
+    """
+
+    survey = models.ForeignKey(
+        Survey, on_delete=models.CASCADE, related_name="pending_submissions")
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="pending_submissions")
+    response_type = models.CharField(
+        max_length=20, choices=ResponseType.choices)
+    # JSON of the form values keyed by field name
+    values = models.TextField()
+    submitted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["survey", "user"], name="unique_pending_submission"),
+        ]
+
+    def __str__(self):
+        return f"Pending submission of {self.user_id} to {self.survey_id}"
@@ -0,0 +1,67 @@
+"""
+Cached participation status of users in surveys.
+
+Only participations are cached, per (survey, user), and updated by
+survey.signals when a Response is created or deleted, and by survey.buffer
+when a submission is accepted by the write-behind buffer. "Not participated"
+is never cached: a worker whose cache missed the response of a user would
+let them take the survey again.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from survey.models import PendingSubmission, Response
+
+PARTICIPATION_KEY = "survey:participated:{survey_id}:{user_id}"
+
+
+def _get_key(survey_id, user_id):
+    return PARTICIPATION_KEY.format(survey_id=survey_id, user_id=user_id)
+
+
+def _get_timeout():
+    return getattr(settings, "SURVEY_PARTICIPATION_CACHE_TIMEOUT", 60 * 60)
+
+
+def has_participated(user, survey_id):
+    """
+    Return True if the user already responded to the survey, including a
+    submission pending in the write-behind buffer.
+
+    :param User user: The user.
+    :param survey_id: The survey id.
+    :rtype: bool
+    """
+    if not user.is_authenticated:
+        return False
+    key = _get_key(survey_id, user.pk)
+    participated = cache.get(key)
+    if participated is None:
+        participated = (
+            Response.objects.filter(
+                survey_id=survey_id, user_id=user.pk).exists()
+            or PendingSubmission.objects.filter(
+                survey_id=survey_id, user_id=user.pk).exists())
+        if participated:
+            cache.set(key, True, _get_timeout())
+    return participated
+
+
+def get_cached_participation(user_id, survey_id):
+    """
+    Return True if the participation of a user in a survey is cached, or
+    None. Never queries the database.
+    """
+    return cache.get(_get_key(survey_id, user_id))
+
+
+def set_participated(user_id, survey_id, participated=True):
+    """
+    Update the cached participation status of a user in a survey.
+    """
+    if user_id is None:
+        return
+    if participated:
+        cache.set(_get_key(survey_id, user_id), True, _get_timeout())
+    else:
+        cache.delete(_get_key(survey_id, user_id))
@@ -0,0 +1,255 @@
+import logging
+from collections import namedtuple
+from functools import partial
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from survey.models import Answer, AnswerChoice, Attempt, InboxEntry, Response
+from survey.participation import set_participated
+from survey.schema import get_compiled_survey, get_question_id
+from survey.tallies import TallyBatch
+
+BATCH_SIZE = 1000
+# Times a batch is saved again after a conflicting response
+CONFLICT_RETRIES = 3
+
+# A new response to save in bulk, values are keyed by field name
+Submission = namedtuple("Submission", ["user_id", "response_type", "values"])
+
+LOGGER = logging.getLogger(__name__)
+
+
+def build_answers(response, questions, values):
+    """
+    Build (unsaved) answer objects for a response, validating every value
+    in memory against its question.
+
+    :param Response response: The response the answers belong to.
+    :param dict questions: Compiled questions of the survey keyed by their id.
+    :param dict values: Form values keyed by field name ('question_<id>').
+    :rtype: dict of Answer keyed by question id
+    """
+    answers = {}
+    for field_name, field_value in values.items():
+        q_id = get_question_id(field_name)
+        if q_id is None:
+            continue
+        question = questions.get(q_id)
+        if question is None:
+            LOGGER.warning("Ignoring answer to unknown question %s", q_id)
+            continue
+        answer = Answer(question_id=q_id, response=response,
+                        body=Answer.serialize_body(question, field_value))
+        answer.check_answer_body(question, field_value)
+        answers[q_id] = answer
+    return answers
+
+
+def save_answers(response, questions, values, created=True):
+    """
+    Insert or update all the answers of a response in bulk.
+
+    The choices picked in radio and multiple select answers are also saved
+    as AnswerChoice rows.
+
+    Must be called inside a transaction. The number of queries does not
+    depend on the number of questions.
+
+    :param Response response: A saved response.
+    :param dict questions: Compiled questions of the survey keyed by their id.
+    :param dict values: Form values keyed by field name ('question_<id>').
+    :param bool created: True if the response was just created, so there
+        can't be any existing answers to update.
+    :rtype: list of Answer
+    """
+    answers = build_answers(response, questions, values)
+    existing = {}
+    if not created:
+        existing = {
+            answer.question_id: answer
+            for answer in Answer.objects.filter(
+                response=response, question_id__in=list(answers))
+        }
+
+    to_create = []
+    to_update = []
+    now = timezone.now()
+    for q_id, answer in answers.items():
+        current = existing.get(q_id)
+        if current is None:
+            to_create.append(answer)
+        else:
+            current.body = answer.body
+            current.updated = now
+            to_update.append(current)
+
+    if to_create:
+        Answer.objects.bulk_create(to_create)
+    if to_update:
+        Answer.objects.bulk_update(to_update, ["body", "updated"])
+        AnswerChoice.objects.filter(
+            response=response,
+            question_id__in=[a.question_id for a in to_update]
+        ).delete()
+    AnswerChoice.objects.bulk_create(
+        build_answer_choices(response, questions, values))
+    return to_create + to_update
+
+
+def build_answer_choices(response, questions, values):
+    """
+    Build (unsaved) AnswerChoice objects for the choices picked in the
+    answers of a response.
+
+    :rtype: list of AnswerChoice
+    """
+    choices = []
+    for field_name, field_value in values.items():
+        question = questions.get(get_question_id(field_name))
+        if question is None:
+            continue
+        for choice in question.get_answer_choices(field_value):
+            choices.append(AnswerChoice(
+                response=response, question_id=question.pk, choice=choice))
+    return choices
+
+
+def clean_values(questions, values):
+    """
+    Return the values answering known questions with a valid body, the
+    invalid answers are logged and dropped.
+
+    :param dict questions: Compiled questions of the survey keyed by their id.
+    :param dict values: Form values keyed by field name ('question_<id>').
+    :rtype: dict
+    """
+    cleaned = {}
+    for field_name, value in values.items():
+        question = questions.get(get_question_id(field_name))
+        if question is None:
+            continue
+        try:
+            Answer().check_answer_body(question, value)
+        except ValidationError as error:
+            LOGGER.warning(
+                "Dropping invalid answer to %s: %s", field_name, error)
+            continue
+        cleaned[field_name] = value
+    return cleaned
+
+
+def finalize_attempts(survey_id, user_ids):
+    """
+    Mark the attempts of users to a survey as finalized.
+    """
+    Attempt.objects.filter(
+        survey_id=survey_id, user_id__in=list(user_ids),
+        finalized_at__isnull=True
+    ).update(finalized_at=timezone.now())
+
+
+def persist_responses(survey_id, submissions):
+    """
+    Save new responses of a survey with their answers, picked choices and
+    tallies in bulk, in one transaction.
+
+    Users who already responded are skipped, so saving the same submissions
+    twice is harmless. Anonymous submissions (user_id None) are all saved.
+    The values must be valid (see clean_values).
+
+    A response saved meanwhile by another path (the timeout endpoint, a
+    submit) makes the insert fail on the unique user constraint: the batch
+    is rolled back to a savepoint and saved again without its user.
+
+    :param int survey_id: The survey.
+    :param list submissions: Submission tuples, one by user.
+    :rtype: list of the created Response
+    """
+    questions = get_compiled_survey(survey_id).questions_by_id
+    user_ids = [submission.user_id for submission in submissions
+                if submission.user_id is not None]
+    for attempt in range(1, CONFLICT_RETRIES + 1):
+        existing = _get_responded(survey_id, user_ids)
+        try:
+            with transaction.atomic():
+                return _insert_responses(
+                    survey_id, questions, submissions, existing)
+        except IntegrityError:
+            if attempt == CONFLICT_RETRIES:
+                raise
+            LOGGER.info(
+                "Responses to survey %s saved meanwhile, retrying without "
+                "them", survey_id)
+
+
+def _get_responded(survey_id, user_ids):
+    return set(Response.objects.filter(
+        survey_id=survey_id, user_id__in=user_ids
+    ).values_list("user_id", flat=True))
+
+
+def _insert_responses(survey_id, questions, submissions, existing):
+    pending = {}
+    anonymous = []
+    for submission in submissions:
+        if submission.user_id is None:
+            anonymous.append(submission)
+        elif submission.user_id not in existing:
+            pending.setdefault(submission.user_id, submission)
+    if not pending and not anonymous:
+        return []
+
+    responses = [
+        Response(survey_id=survey_id, user_id=user_id,
+                 response_type=submission.response_type)
+        for user_id, submission in pending.items()
+    ]
+    anonymous_responses = [
+        Response(survey_id=survey_id, response_type=submission.response_type)
+        for submission in anonymous
+    ]
+    Response.objects.bulk_create(responses, batch_size=BATCH_SIZE)
+    if not connection.features.can_return_rows_from_bulk_insert:
+        pks = dict(Response.objects.filter(
+            survey_id=survey_id, user_id__in=list(pending)
+        ).values_list("user_id", "pk"))
+        for response in responses:
+            response.pk = pks[response.user_id]
+        # Nothing to find the pks of anonymous responses by, insert
+        # them one by one
+        for response in anonymous_responses:
+            response.save(force_insert=True)
+    else:
+        Response.objects.bulk_create(
+            anonymous_responses, batch_size=BATCH_SIZE)
+
+    answers = []
+    choices = []
+    tallies = TallyBatch(survey_id)
+    values_by_response = [
+        (response, pending[response.user_id].values) for response in responses
+    ] + [
+        (response, submission.values)
+        for response, submission in zip(anonymous_responses, anonymous)
+    ]
+    for response, values in values_by_response:
+        answers.extend(build_answers(response, questions, values).values())
+        choices.extend(build_answer_choices(response, questions, values))
+        tallies.add(response.response_type, questions, values)
+    Answer.objects.bulk_create(answers, batch_size=BATCH_SIZE)
+    AnswerChoice.objects.bulk_create(choices, batch_size=BATCH_SIZE)
+    tallies.save()
+
+    # bulk_create doesn't send post_save, update what the signals would
+    finalize_attempts(survey_id, pending)
+    InboxEntry.objects.filter(
+        survey_id=survey_id, user_id__in=list(pending)).delete()
+    transaction.on_commit(partial(_set_participated, survey_id, list(pending)))
+    return responses + anonymous_responses
+
+
+def _set_participated(survey_id, user_ids):
+    for user_id in user_ids:
+        set_participated(user_id, survey_id)
@@ -0,0 +1,177 @@
+"""
+Cached rendering of the question rows of the survey steps.
+
+The markup of a question row (label, widget and choice list) only changes
+with the survey schema, so it is rendered once per schema version with the
+survey/question_row.html template and kept split around the per-request
+parts: each choice is stored checked and unchecked, and the text of a
+textarea is inserted, escaped, between its opening and closing tags.
+Rendering a step then joins strings instead of rendering a widget template
+by choice.
+
+Rows with errors or disabled fields are rendered with the template as
+before.
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django import forms
+from django.conf import settings
+from django.core.cache import cache
+from django.forms.boundfield import BoundWidget
+from django.template.loader import render_to_string
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from survey.schema import get_question_id, get_schema_version
+
+QUESTION_MARKUP_KEY = "survey:markup:{survey_id}:{version}:{question_id}"
+ROW_TEMPLATE = "survey/question_row.html"
+# Stands for the text of a textarea while rendering the markup
+VALUE_PLACEHOLDER = "__survey_question_value__"
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class QuestionMarkup:
+    """
+    Markup of a question row split around its per-request parts.
+
+    parts has one more item than choices, or two items for a question
+    without choices, whose value goes in between.
+    """
+    parts: tuple
+    choices: tuple = None  # (value, unchecked markup, checked markup)
+
+    def render(self, value):
+        """
+        Return the row with a value checked or filled in.
+
+        :param value: The value of the field, a string or a list of strings.
+        """
+        if self.choices is None:
+            text = conditional_escape(value) if value not in (None, "") else ""
+            return mark_safe(self.parts[0] + text + self.parts[1])
+        if not isinstance(value, (list, tuple)):
+            value = [] if value is None else [value]
+        selected = {str(item) for item in value}
+        html = [self.parts[0]]
+        for (choice, unchecked, checked), part in zip(
+                self.choices, self.parts[1:]):
+            html.append(checked if choice in selected else unchecked)
+            html.append(part)
+        return mark_safe("".join(html))
+
+
+def _bind(field, name, initial):
+    form = forms.Form(initial={name: initial})
+    form.fields[name] = field
+    return form[name]
+
+
+def _check(option):
+    # Same option checked, as ChoiceWidget.create_option() does
+    data = dict(option.data, selected=True)
+    data["attrs"] = dict(
+        data["attrs"], **option.parent_widget.checked_attribute)
+    return BoundWidget(option.parent_widget, data, option.renderer)
+
+
+def _split(html, fragments):
+    """
+    Split html around fragments appearing in order, None if one is missing.
+    """
+    parts = []
+    start = 0
+    for fragment in fragments:
+        index = html.find(fragment, start)
+        if index == -1:
+            return None
+        parts.append(html[start:index])
+        start = index + len(fragment)
+    parts.append(html[start:])
+    return tuple(parts)
+
+
+def build_question_markup(bound_field):
+    """
+    Render the static markup of the row of a question field.
+
+    :param BoundField bound_field: A question field of a ResponseForm.
+    :rtype: QuestionMarkup or None if the row can't be split.
+    """
+    field, name = bound_field.field, bound_field.name
+    if getattr(field, "choices", None):
+        unchecked = _bind(field, name, None)
+        choices = tuple(
+            (str(option.data["value"]), str(option), str(_check(option)))
+            for option in unchecked
+        )
+        parts = _split(
+            render_to_string(ROW_TEMPLATE, {"form": unchecked}),
+            [markup for _, markup, _ in choices])
+        return QuestionMarkup(parts, choices) if parts else None
+    bound = _bind(field, name, VALUE_PLACEHOLDER)
+    parts = _split(render_to_string(ROW_TEMPLATE, {"form": bound}),
+                   [VALUE_PLACEHOLDER])
+    return QuestionMarkup(parts) if parts else None
+
+
+def get_question_markup(bound_field):
+    """
+    Return the markup of the row of a question field, from the
+    per-process LRU, the cache, or rendered.
+
+    :param BoundField bound_field: A question field of a ResponseForm.
+    :rtype: QuestionMarkup or None
+    """
+    survey_id = bound_field.form.survey.pk
+    question_id = get_question_id(bound_field.name)
+    version = get_schema_version(survey_id)
+    lru_key = (survey_id, version, question_id)
+    with _lru_lock:
+        markup = _lru.get(lru_key)
+        if markup is not None:
+            _lru.move_to_end(lru_key)
+            return markup
+
+    cache_key = QUESTION_MARKUP_KEY.format(
+        survey_id=survey_id, version=version, question_id=question_id)
+    markup = cache.get(cache_key)
+    if markup is None:
+        markup = build_question_markup(bound_field)
+        if markup is None:
+            return None
+        cache.set(cache_key, markup)
+
+    with _lru_lock:
+        _lru[lru_key] = markup
+        while len(_lru) > getattr(settings, "SURVEY_MARKUP_LRU_SIZE", 1024):
+            _lru.popitem(last=False)
+    return markup
+
+
+def clear_local_cache():
+    """
+    Empty the per-process LRU.
+    """
+    with _lru_lock:
+        _lru.clear()
+
+
+def render_question(bound_field):
+    """
+    Render the row of a question field.
+
+    :param BoundField bound_field: A question field of a ResponseForm.
+    :rtype: SafeString
+    """
+    disabled = bound_field.field.widget.attrs.get("disabled")
+    if not bound_field.errors and not disabled:
+        markup = get_question_markup(bound_field)
+        if markup is not None:
+            return markup.render(bound_field.value())
+    return render_to_string(ROW_TEMPLATE, {"form": bound_field})
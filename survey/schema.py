@@ -0,0 +1,303 @@
+"""
+Compiled survey schema.
+
+A compiled survey is an immutable snapshot of a survey and its questions
+with the choices already parsed. It is built once per schema version and
+kept in a per-process LRU, backed by Django's cache framework, so forms and
+answer validation don't have to query and parse the questions again.
+
+The schema version of a survey is bumped (see survey.signals) whenever the
+survey or one of its questions is saved or deleted.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+from survey.models import Question, QuestionType, parse_select_body
+
+SCHEMA_VERSION_KEY = "survey:schema:version:{survey_id}"
+COMPILED_SURVEY_KEY = "survey:schema:{survey_id}:{version}"
+STEP_QUESTION_KEY = "survey:schema:{survey_id}:{version}:step:{step}"
+STEPS_COUNT_KEY = "survey:schema:{survey_id}:{version}:steps"
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class CompiledQuestion:
+    """
+    Immutable version of a Question with parsed choices.
+    """
+    pk: int
+    survey_id: int
+    text: str
+    question_type: str
+    choices: tuple
+    slug_to_label: dict
+    label_to_slug: dict
+    choice_set: frozenset
+
+    @property
+    def id(self):
+        return self.pk
+
+    @property
+    def field_name(self):
+        return "question_%d" % self.pk
+
+    def get_clean_choices(self):
+        """
+        Return the list of choice labels, see Question.get_clean_choices.
+        """
+        return [label for _, label in self.choices]
+
+    def get_choices(self):
+        """
+        Return a tuple for the 'choices' argument of a form widget.
+        """
+        return self.choices
+
+    def is_valid_choice(self, value):
+        """
+        Return True if value is one of the choice labels or slugs.
+        """
+        return value in self.choice_set
+
+    def get_answer_choices(self, value):
+        """
+        Return the slugs of the choices picked in an answer.
+
+        :param value: A form value or an Answer.body.
+        :rtype: list of String
+        """
+        if self.question_type == QuestionType.RADIO:
+            values = [value] if value else []
+        elif self.question_type == QuestionType.SELECT:
+            values = parse_select_body(value)
+        else:
+            return []
+        slugs = []
+        for value in values:
+            slug = self.label_to_slug.get(value, value)
+            if slug in self.slug_to_label and slug not in slugs:
+                slugs.append(slug)
+        return slugs
+
+    @classmethod
+    def from_question(cls, question):
+        choices = question.get_choices()
+        return cls(
+            pk=question.pk,
+            survey_id=question.survey_id,
+            text=question.text,
+            question_type=question.question_type,
+            choices=choices,
+            slug_to_label=dict(choices),
+            label_to_slug={label: slug for slug, label in choices},
+            choice_set=frozenset(
+                [slug for slug, _ in choices]
+                + [label for _, label in choices]),
+        )
+
+
+@dataclass(frozen=True)
+class CompiledSurvey:
+    """
+    Immutable, ordered collection of the compiled questions of a survey.
+    """
+    pk: int
+    version: int
+    questions: tuple
+    questions_by_id: dict
+
+    @property
+    def steps_count(self):
+        return len(self.questions)
+
+    def get_question(self, question_id):
+        return self.questions_by_id.get(question_id)
+
+    @property
+    def digest(self):
+        """
+        Hash of the questions and their choices, which changes only when
+        the content shown to the respondents changes.
+        """
+        content = [
+            [question.pk, question.text, question.question_type,
+             question.choices]
+            for question in self.questions
+        ]
+        content = json.dumps(content).encode("utf-8")
+        return hashlib.sha256(content).hexdigest()[:16]
+
+
+def get_question_id(field_name):
+    """
+    Return the question id encoded in a form field name like 'question_12',
+    or None if the field is not a question field.
+    """
+    if not field_name.startswith("question_"):
+        return None
+    try:
+        return int(field_name.split("_")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _new_version():
+    # Time based so a version key evicted from the cache never comes back
+    # with a value used before.
+    return time.time_ns()
+
+
+def get_schema_version(survey_id):
+    """
+    Return the current schema version of a survey.
+    """
+    key = SCHEMA_VERSION_KEY.format(survey_id=survey_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_schema_version(survey_id):
+    """
+    Invalidate the compiled schema of a survey.
+    """
+    key = SCHEMA_VERSION_KEY.format(survey_id=survey_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+def compile_survey(survey_id, version):
+    """
+    Build the compiled schema of a survey from the database.
+    """
+    questions = tuple(
+        CompiledQuestion.from_question(question)
+        for question in Question.objects.filter(
+            survey_id=survey_id).order_by("position", "pk")
+    )
+    return CompiledSurvey(
+        pk=survey_id,
+        version=version,
+        questions=questions,
+        questions_by_id={question.pk: question for question in questions},
+    )
+
+
+def _get_local(lru_key):
+    with _lru_lock:
+        compiled = _lru.get(lru_key)
+        if compiled is not None:
+            _lru.move_to_end(lru_key)
+        return compiled
+
+
+def get_compiled_survey(survey):
+    """
+    Return the compiled schema of a survey, from the per-process LRU, the
+    cache or the database.
+
+    :param survey: A Survey or a survey id.
+    :rtype: CompiledSurvey
+    """
+    survey_id = int(getattr(survey, "pk", survey))
+    version = get_schema_version(survey_id)
+    lru_key = (survey_id, version)
+    compiled = _get_local(lru_key)
+    if compiled is not None:
+        return compiled
+
+    cache_key = COMPILED_SURVEY_KEY.format(
+        survey_id=survey_id, version=version)
+    compiled = cache.get(cache_key)
+    if compiled is None:
+        compiled = compile_survey(survey_id, version)
+        cache.set(cache_key, compiled)
+
+    with _lru_lock:
+        _lru[lru_key] = compiled
+        while len(_lru) > getattr(settings, "SURVEY_SCHEMA_LRU_SIZE", 128):
+            _lru.popitem(last=False)
+    return compiled
+
+
+def clear_local_cache():
+    """
+    Empty the per-process LRU.
+    """
+    with _lru_lock:
+        _lru.clear()
+
+
+def get_step_question(survey, step):
+    """
+    Return the compiled question displayed at a step of a survey, or None.
+
+    Only the requested question is loaded (through the (survey, position)
+    index) when the whole survey is not compiled yet, so the cost doesn't
+    depend on the number of questions. A step is the rank of the question
+    in the position order, like in the compiled survey: a gap or a
+    duplicate in the positions (a position edited outside of the admin)
+    doesn't lose a step.
+
+    :param survey: A Survey or a survey id.
+    :param int step: The step, starting from 0.
+    :rtype: CompiledQuestion or None
+    """
+    if step < 0:
+        return None
+    survey_id = int(getattr(survey, "pk", survey))
+    version = get_schema_version(survey_id)
+    compiled = _get_local((survey_id, version))
+    if compiled is not None:
+        if step < compiled.steps_count:
+            return compiled.questions[step]
+        return None
+
+    cache_key = STEP_QUESTION_KEY.format(
+        survey_id=survey_id, version=version, step=step)
+    question = cache.get(cache_key)
+    if question is None:
+        questions = Question.objects.filter(
+            survey_id=survey_id).order_by("position", "pk")
+        question = questions[step:step + 1].first()
+        if question is None:
+            return None
+        question = CompiledQuestion.from_question(question)
+        cache.set(cache_key, question)
+    return question
+
+
+def get_steps_count(survey):
+    """
+    Return the number of steps (questions) of a survey.
+
+    :param survey: A Survey or a survey id.
+    :rtype: int
+    """
+    survey_id = int(getattr(survey, "pk", survey))
+    version = get_schema_version(survey_id)
+    compiled = _get_local((survey_id, version))
+    if compiled is not None:
+        return compiled.steps_count
+
+    cache_key = STEPS_COUNT_KEY.format(survey_id=survey_id, version=version)
+    count = cache.get(cache_key)
+    if count is None:
+        count = Question.objects.filter(survey_id=survey_id).count()
+        cache.set(cache_key, count)
+    return count
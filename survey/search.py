@@ -0,0 +1,257 @@
+"""
+Full-text search in the answers to the text questions.
+
+The answer bodies are indexed by the database, which keeps the index up to
+date whatever writes the answers (form, bulk saves, ingestion, restored
+archives), see migration 0014:
+
+- SQLite: the FTS5 table survey_answer_fts over survey_answer, filled by
+  triggers, ranked with bm25,
+- PostgreSQL: a GIN index on to_tsvector('simple', body), ranked with
+  ts_rank.
+
+A query matches the answers containing all of its words, case and accents
+ignored; a word ending with * matches as a prefix. Ranking costs about the
+same for each match, so only the SURVEY_SEARCH_MAX_RANKED (1000) newest
+matches are ranked: a query matching most of the answers stays as fast as
+a selective one. Without an index (other databases, SQLite without FTS5),
+the answers are scanned with icontains and listed newest first.
+
+Note: Django rebuilds a SQLite table to alter it, which drops its triggers.
+A migration altering survey_answer must create them again (see 0014).
+"""
+import re
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections, router
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from survey.models import Answer, QuestionType
+
+FTS_TABLE = "survey_answer_fts"
+SEARCH_CONFIG = "simple"
+
+# Around the matched words in the snippets, see highlight()
+START_MARK = "\x02"
+STOP_MARK = "\x03"
+
+TERM = re.compile(r"(\w+)(\*?)")
+
+SearchHit = namedtuple("SearchHit", [
+    "answer_id", "response_id", "question_id", "survey_id", "user_id", "body",
+    "snippet", "score"])
+SearchPage = namedtuple("SearchPage", ["query", "hits", "page", "has_next"])
+
+# The id of the oldest answer to rank, so the ranked matches are the newest
+SQLITE_OLDEST_RANKED = f"""
+    SELECT a.id
+    FROM {FTS_TABLE}
+    JOIN survey_answer a ON a.id = {FTS_TABLE}.rowid
+    JOIN survey_question q ON q.id = a.question_id
+    WHERE {FTS_TABLE} MATCH %s AND q.question_type = %s {{filters}}
+    ORDER BY {FTS_TABLE}.rowid DESC
+    LIMIT 1 OFFSET %s
+"""
+
+SQLITE_SEARCH = f"""
+    SELECT a.id, a.response_id, a.question_id, q.survey_id, r.user_id, a.body,
+           snippet({FTS_TABLE}, 0, %s, %s, '…', 24), -{FTS_TABLE}.rank
+    FROM {FTS_TABLE}
+    JOIN survey_answer a ON a.id = {FTS_TABLE}.rowid
+    JOIN survey_question q ON q.id = a.question_id
+    JOIN survey_response r ON r.id = a.response_id
+    WHERE {FTS_TABLE} MATCH %s AND q.question_type = %s {{filters}}
+        AND {FTS_TABLE}.rowid >= %s
+    ORDER BY {FTS_TABLE}.rank, a.id
+    LIMIT %s OFFSET %s
+"""
+
+# The newest matches are ranked, and the headlines are only computed for
+# the rows of the page
+POSTGRESQL_SEARCH = f"""
+    SELECT hit.id, hit.response_id, hit.question_id, hit.survey_id,
+           hit.user_id, hit.body,
+           ts_headline(%s, coalesce(hit.body, ''), to_tsquery(%s, %s), %s),
+           hit.score
+    FROM (
+        SELECT newest.*,
+               ts_rank(to_tsvector('{SEARCH_CONFIG}',
+                                   coalesce(newest.body, '')),
+                       to_tsquery(%s, %s)) AS score
+        FROM (
+            SELECT a.id, a.response_id, a.question_id, q.survey_id,
+                   r.user_id, a.body
+            FROM survey_answer a
+            JOIN survey_question q ON q.id = a.question_id
+            JOIN survey_response r ON r.id = a.response_id
+            WHERE to_tsvector('{SEARCH_CONFIG}', coalesce(a.body, ''))
+                    @@ to_tsquery(%s, %s)
+                AND q.question_type = %s {{filters}}
+            ORDER BY a.id DESC
+            LIMIT %s
+        ) newest
+        ORDER BY score DESC, newest.id
+        LIMIT %s OFFSET %s
+    ) hit
+    ORDER BY hit.score DESC, hit.id
+"""
+
+_backends = {}
+
+
+def get_per_page():
+    return getattr(settings, "SURVEY_SEARCH_PER_PAGE", 20)
+
+
+def get_max_ranked():
+    return getattr(settings, "SURVEY_SEARCH_MAX_RANKED", 1000)
+
+
+def get_backend(using):
+    """
+    Return the index available on a database: "sqlite", "postgresql" or
+    None.
+    """
+    if using not in _backends:
+        connection = connections[using]
+        backend = None
+        if connection.vendor == "postgresql":
+            backend = "postgresql"
+        elif connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                if FTS_TABLE in connection.introspection.table_names(cursor):
+                    backend = "sqlite"
+        _backends[using] = backend
+    return _backends[using]
+
+
+def parse_query(query):
+    """
+    Return the words of a query as (word, is_prefix) tuples, the other
+    characters are ignored.
+    """
+    return [(word, bool(star)) for word, star in TERM.findall(query)]
+
+
+def highlight(snippet):
+    """
+    Return the HTML of a snippet, the matched words in <mark> tags.
+    """
+    return mark_safe(
+        escape(snippet).replace(START_MARK, "<mark>")
+        .replace(STOP_MARK, "</mark>"))
+
+
+def search_answers(query, survey_id=None, question_id=None, page=1,
+                   per_page=None, indexed=True):
+    """
+    Return a page of the answers to text questions matching a query, best
+    matches first. The answers are read from the database of Answer reads,
+    a replica in use_replica() blocks.
+
+    :param str query: Words to find, see the module documentation.
+    :param int survey_id: Only search the answers of this survey.
+    :param int question_id: Only search the answers to this question.
+    :param int page: Page number, from 1.
+    :param int per_page: Hits by page, SURVEY_SEARCH_PER_PAGE by default.
+    :param bool indexed: False to scan the answers even with an index,
+        for comparison.
+    :rtype: SearchPage
+    """
+    terms = parse_query(query)
+    page = max(page, 1)
+    per_page = per_page or get_per_page()
+    if not terms:
+        return SearchPage(query, [], page, False)
+
+    using = router.db_for_read(Answer)
+    backend = get_backend(using) if indexed else None
+    # One more row tells if there is a next page, without counting
+    limit, offset = per_page + 1, (page - 1) * per_page
+    if backend is None:
+        hits = _scan(using, terms, survey_id, question_id, limit, offset)
+    else:
+        filters, params = [], []
+        if survey_id is not None:
+            filters.append("AND q.survey_id = %s")
+            params.append(survey_id)
+        if question_id is not None:
+            filters.append("AND a.question_id = %s")
+            params.append(question_id)
+        filters = " ".join(filters)
+        with connections[using].cursor() as cursor:
+            if backend == "sqlite":
+                rows = _search_sqlite(
+                    cursor, _to_fts5(terms), filters, params, limit, offset)
+            else:
+                rows = _search_postgresql(
+                    cursor, _to_tsquery(terms), filters, params, limit,
+                    offset)
+        hits = [SearchHit(*row) for row in rows]
+    return SearchPage(query, hits[:per_page], page, len(hits) > per_page)
+
+
+def _search_sqlite(cursor, match, filters, params, limit, offset):
+    params = [match, QuestionType.TEXT, *params]
+    oldest = 0
+    max_ranked = get_max_ranked()
+    if max_ranked:
+        cursor.execute(SQLITE_OLDEST_RANKED.format(filters=filters),
+                       [*params, max_ranked - 1])
+        row = cursor.fetchone()
+        if row is not None:
+            oldest = row[0]
+    cursor.execute(
+        SQLITE_SEARCH.format(filters=filters),
+        [START_MARK, STOP_MARK, *params, oldest, limit, offset])
+    return cursor.fetchall()
+
+
+def _search_postgresql(cursor, tsquery, filters, params, limit, offset):
+    cursor.execute(POSTGRESQL_SEARCH.format(filters=filters), [
+        SEARCH_CONFIG, SEARCH_CONFIG, tsquery,
+        f"StartSel={START_MARK}, StopSel={STOP_MARK}, "
+        "MaxWords=35, MinWords=15",
+        SEARCH_CONFIG, tsquery, SEARCH_CONFIG, tsquery, QuestionType.TEXT,
+        *params, get_max_ranked() or None, limit, offset,
+    ])
+    return cursor.fetchall()
+
+
+def _to_fts5(terms):
+    # Quoted, so the words are never read as FTS5 operators
+    return " ".join(f'"{word}"' + ("*" if prefix else "")
+                    for word, prefix in terms)
+
+
+def _to_tsquery(terms):
+    return " & ".join(f"'{word}'" + (":*" if prefix else "")
+                      for word, prefix in terms)
+
+
+def _mark(body, terms):
+    pattern = "|".join(
+        re.escape(word) + (r"\w*" if prefix else r"\b")
+        for word, prefix in terms)
+    return re.sub(rf"\b({pattern})", rf"{START_MARK}\1{STOP_MARK}", body,
+                  flags=re.IGNORECASE)
+
+
+def _scan(using, terms, survey_id, question_id, limit, offset):
+    answers = Answer.objects.using(using).filter(
+        question__question_type=QuestionType.TEXT)
+    if survey_id is not None:
+        answers = answers.filter(question__survey_id=survey_id)
+    if question_id is not None:
+        answers = answers.filter(question_id=question_id)
+    for word, _ in terms:
+        answers = answers.filter(body__icontains=word)
+    rows = answers.order_by("-pk").values_list(
+        "pk", "response_id", "question_id", "question__survey_id",
+        "response__user_id", "body")[offset:offset + limit]
+    return [
+        SearchHit(*row, _mark(row[5] or "", terms), None)
+        for row in rows
+    ]
@@ -0,0 +1,82 @@
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from survey import inbox
+from survey.live import notify_change
+from survey.models import Attempt, Question, Response, Survey
+from survey.participation import set_participated
+from survey.schema import bump_schema_version
+
+
+@receiver(post_save, sender=Survey)
+@receiver(post_delete, sender=Survey)
+def invalidate_survey_schema(sender, instance, **kwargs):
+    bump_schema_version(instance.pk)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_question_schema(sender, instance, **kwargs):
+    bump_schema_version(instance.survey_id)
+
+
+@receiver(post_delete, sender=Question)
+def close_position_gap(sender, instance, **kwargs):
+    """
+    Keep the question positions contiguous when a question is deleted.
+    """
+    if instance.position is not None:
+        Question.objects.filter(
+            survey_id=instance.survey_id, position__gt=instance.position
+        ).update(position=F("position") - 1)
+
+
+def _forgotten(user_id, survey_id):
+    set_participated(user_id, survey_id, False)
+    inbox.add_entry(user_id, survey_id)
+
+
+@receiver(post_save, sender=Response)
+def update_participation(sender, instance, created, **kwargs):
+    if created and instance.user_id is not None:
+        # The cache isn't rolled back, a response rolled back must not lock
+        # the user out
+        transaction.on_commit(partial(
+            set_participated, instance.user_id, instance.survey_id))
+        inbox.remove_entry(instance.user_id, instance.survey_id)
+
+
+@receiver(post_delete, sender=Response)
+def forget_participation(sender, instance, **kwargs):
+    if instance.user_id is None:
+        return
+    # Wait for the commit, the survey itself may be being deleted
+    transaction.on_commit(
+        partial(_forgotten, instance.user_id, instance.survey_id))
+
+
+@receiver(post_save, sender=Attempt)
+def notify_attempt_started(sender, instance, created, raw=False, **kwargs):
+    # The live dashboards count the attempts in progress
+    if created and not raw:
+        transaction.on_commit(partial(notify_change, instance.survey_id))
+
+
+@receiver(post_save, sender=Survey)
+def publish_survey(sender, instance, raw=False, **kwargs):
+    if not raw:
+        inbox.publish_survey(instance)
+
+
+@receiver(post_save, sender=User)
+def fill_user_inbox(sender, instance, created, raw=False, update_fields=None,
+                    **kwargs):
+    # Logging in only updates last_login
+    if raw or (update_fields and set(update_fields) == {"last_login"}):
+        return
+    inbox.add_user(instance)
@@ -0,0 +1,159 @@
+"""
+Incremental result tallies.
+
+SurveyTally, QuestionTally and ChoiceTally hold counters updated in the
+submit transaction, so reading the results of a survey never scans the
+answers. The rebuild_tallies command recomputes them from the Answer rows,
+e.g. after responses were deleted.
+"""
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.db import transaction
+from django.db.models import F
+
+from survey.live import notify_change
+from survey.models import ChoiceTally, QuestionTally, ResponseType, SurveyTally
+from survey.schema import get_question_id
+
+RESPONSE_TYPE_FIELDS = {
+    ResponseType.SUBMITTED: "submitted",
+    ResponseType.TIMEUP: "timeup",
+}
+
+
+class TallyBatch:
+    """
+    Accumulate the counters of one or many responses of a survey and write
+    them with a number of queries which doesn't depend on the number of
+    responses, questions or choices.
+    """
+
+    def __init__(self, survey_id):
+        self.survey_id = survey_id
+        self.responses = Counter()
+        self.questions = Counter()
+        self.choices = Counter()
+
+    def add(self, response_type, questions, values, count_response=True):
+        """
+        Count a response.
+
+        :param str response_type: The ResponseType of the response.
+        :param dict questions: Compiled questions keyed by their id.
+        :param dict values: Answers keyed by field name ('question_<id>').
+        :param bool count_response: False to only count the answers.
+        """
+        if count_response:
+            self.responses[response_type] += 1
+        for field_name, value in values.items():
+            question = questions.get(get_question_id(field_name))
+            if question is None or value in (None, "", [], "[]"):
+                continue
+            self.questions[(question.pk, response_type)] += 1
+            for slug in question.get_answer_choices(value):
+                self.choices[(question.pk, slug, response_type)] += 1
+
+    def save(self):
+        """
+        Add the accumulated counters to the tallies. Must be called inside a
+        transaction.
+        """
+        if self.responses or self.questions:
+            transaction.on_commit(partial(notify_change, self.survey_id))
+        if self.responses:
+            SurveyTally.objects.bulk_create(
+                [SurveyTally(survey_id=self.survey_id)], ignore_conflicts=True)
+            SurveyTally.objects.filter(survey_id=self.survey_id).update(**{
+                RESPONSE_TYPE_FIELDS[response_type]:
+                    F(RESPONSE_TYPE_FIELDS[response_type]) + count
+                for response_type, count in self.responses.items()
+            })
+
+        if self.questions:
+            QuestionTally.objects.bulk_create([
+                QuestionTally(survey_id=self.survey_id, question_id=q_id,
+                              response_type=response_type)
+                for q_id, response_type in self.questions
+            ], ignore_conflicts=True)
+            groups = _group(self.questions, lambda key: key[1])
+            for (response_type, count), q_ids in groups.items():
+                QuestionTally.objects.filter(
+                    question_id__in=[key[0] for key in q_ids],
+                    response_type=response_type,
+                ).update(answered=F("answered") + count)
+
+        if self.choices:
+            ChoiceTally.objects.bulk_create([
+                ChoiceTally(survey_id=self.survey_id, question_id=q_id,
+                            choice=choice, response_type=response_type)
+                for q_id, choice, response_type in self.choices
+            ], ignore_conflicts=True)
+            tallies = ChoiceTally.objects.filter(
+                survey_id=self.survey_id,
+                question_id__in={key[0] for key in self.choices},
+            ).values_list("pk", "question_id", "choice", "response_type")
+            pks = {
+                (q_id, choice, response_type): pk
+                for pk, q_id, choice, response_type in tallies
+            }
+            groups = _group(self.choices, lambda key: None)
+            for (_, count), keys in groups.items():
+                ChoiceTally.objects.filter(
+                    pk__in=[pks[key] for key in keys]
+                ).update(count=F("count") + count)
+
+        self.responses.clear()
+        self.questions.clear()
+        self.choices.clear()
+
+
+def _group(counter, get_group):
+    """
+    Group the keys of a counter by (group, count) so keys sharing the same
+    increment are updated by the same query.
+    """
+    groups = defaultdict(list)
+    for key, count in counter.items():
+        groups[(get_group(key), count)].append(key)
+    return groups
+
+
+def record_response(response, questions, values):
+    """
+    Add a new response to the tallies of its survey.
+
+    :param Response response: The response just created.
+    :param dict questions: Compiled questions keyed by their id.
+    :param dict values: Answers keyed by field name ('question_<id>').
+    """
+    batch = TallyBatch(response.survey_id)
+    batch.add(response.response_type, questions, values)
+    batch.save()
+
+
+def get_results(survey):
+    """
+    Return the tallies of a survey.
+
+    :param Survey survey: The survey.
+    :rtype: dict with the SurveyTally, the answered counts keyed by
+        (question id, response type) and the choice counts keyed by
+        (question id, choice slug, response type).
+    """
+    tally = SurveyTally.objects.filter(survey=survey).first()
+    questions = QuestionTally.objects.filter(survey=survey).values_list(
+        "question_id", "response_type", "answered")
+    choices = ChoiceTally.objects.filter(survey=survey).values_list(
+        "question_id", "choice", "response_type", "count")
+    return {
+        "tally": tally or SurveyTally(survey=survey),
+        "questions": {
+            (q_id, response_type): answered
+            for q_id, response_type, answered in questions
+        },
+        "choices": {
+            (q_id, choice, response_type): count
+            for q_id, choice, response_type, count in choices
+        },
+    }
@@ -0,0 +1,13 @@
+from django import template
+
+from survey import rendering
+
+register = template.Library()
+
+
+@register.simple_tag
+def render_question(bound_field):
+    """
+    Render the row of a question field, see survey.rendering.
+    """
+    return rendering.render_question(bound_field)
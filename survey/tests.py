@@ -1,3 +1,1564 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, router, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.test import (
+    AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase,
+    override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from survey import (
+    async_views, live, participation, persistence, rendering, warmup)
+from survey.archive import open_archive
+from survey.checks import check_shared_cache
+from survey.db import PIN_COOKIE, read_replica, use_replica
+from survey.drafts import get_draft_store
+from survey.export import iter_response_rows
+from survey.finalizer import finalize_batch
+from survey.forms import ResponseForm
+from survey.inbox import get_inbox_page, prune_expired
+from survey.loadtest import create_fixture
+from survey.middleware import ReplicaPinMiddleware
+from survey.models import (
+    Answer, AnswerChoice, Attempt, PendingSubmission, Question, QuestionType,
+    Response, ResponseType, Survey)
+from survey.participation import has_participated
+from survey.schema import (
+    clear_local_cache, get_compiled_survey, get_step_question)
+from survey.search import search_answers
+from survey.tallies import get_results
+
+
+def create_survey(user, questions_count, **kwargs):
+    """
+    Create a survey with questions_count questions cycling over the
+    question types.
+    """
+    kwargs.setdefault("title", "Survey")
+    kwargs.setdefault("expire_date", timezone.now() + timedelta(days=1))
+    survey = Survey.objects.create(
+        description="Description", duration=10, created_by=user, **kwargs)
+    types = [QuestionType.TEXT, QuestionType.RADIO, QuestionType.SELECT]
+    for i in range(questions_count):
+        question_type = types[i % len(types)]
+        choices = None
+        if question_type != QuestionType.TEXT:
+            choices = "Option A, Option B, Option C"
+        Question.objects.create(
+            survey=survey, text=f"Question {i}", question_type=question_type,
+            choices=choices)
+    return survey
+
+
+def answer_data(survey):
+    """
+    Return valid POST data answering every question of the survey.
+    """
+    data = {}
+    for question in survey.questions.all():
+        field_name = "question_%d" % question.pk
+        if question.question_type == QuestionType.TEXT:
+            data[field_name] = "Some text"
+        elif question.question_type == QuestionType.RADIO:
+            data[field_name] = "option-a"
+        else:
+            data[field_name] = ["option-a", "option-c"]
+    return data
+
+
+class SurveyTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_local_cache()
+        self.user = User.objects.create_user(
+            "staff", password="password", is_staff=True)
+
+
+class ResponseFormSaveTest(SurveyTestCase):
+
+    def save_response(self, survey, user):
+        form = ResponseForm(
+            answer_data(survey), survey=survey, user=user, session_data={})
+        self.assertTrue(form.is_valid())
+        with self.captureOnCommitCallbacks(execute=True), \
+                CaptureQueriesContext(connection) as context:
+            response = form.save()
+        return response, len(context.captured_queries)
+
+    def test_save_answers(self):
+        survey = create_survey(self.user, 3)
+        response, _ = self.save_response(survey, self.user)
+        answers = {a.question.question_type: a.body
+                   for a in Answer.objects.filter(response=response)}
+        self.assertEqual(answers[QuestionType.TEXT], "Some text")
+        self.assertEqual(answers[QuestionType.RADIO], "option-a")
+        self.assertEqual(
+            answers[QuestionType.SELECT], '["option-a", "option-c"]')
+
+    def test_picked_choices_are_indexed(self):
+        survey = create_survey(self.user, 3)
+        select = survey.questions.get(question_type=QuestionType.SELECT)
+        response, _ = self.save_response(survey, self.user)
+        self.assertEqual(
+            AnswerChoice.objects.filter(
+                question=select, choice="option-c").count(), 1)
+        self.assertEqual(response.answer_choices.count(), 3)
+        self.save_response(survey, self.user)
+        self.assertEqual(response.answer_choices.count(), 3)
+
+    def test_select_initial(self):
+        survey = create_survey(self.user, 3)
+        select = survey.questions.get(question_type=QuestionType.SELECT)
+        response, _ = self.save_response(survey, self.user)
+        for body in ['["option-a", "option-c"]', "['option-a', 'option-c']"]:
+            Answer.objects.filter(question=select).update(body=body)
+            form = ResponseForm(survey=survey, user=self.user, session_data={})
+            self.assertEqual(
+                form.fields["question_%d" % select.pk].initial,
+                ["option-a", "option-c"])
+
+    def test_save_query_count_is_constant(self):
+        counts = []
+        for i, questions_count in enumerate([5, 100]):
+            user = User.objects.create_user(f"user{i}", is_staff=True)
+            survey = create_survey(self.user, questions_count)
+            response, count = self.save_response(survey, user)
+            self.assertEqual(response.answers.count(), questions_count)
+            counts.append(count)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_full_form_query_count_is_constant(self):
+        counts = []
+        for i, questions_count in enumerate([5, 100]):
+            user = User.objects.create_user(f"user{i}", is_staff=True)
+            survey = create_survey(self.user, questions_count)
+            # Without and with a previous response
+            for _ in range(2):
+                with CaptureQueriesContext(connection) as context:
+                    form = ResponseForm(
+                        answer_data(survey), survey=survey, user=user,
+                        session_data={})
+                counts.append(len(context.captured_queries))
+                self.assertEqual(len(form.fields), questions_count)
+                self.save_response(survey, user)
+        self.assertEqual(counts[:2], counts[2:])
+
+    def test_save_updates_existing_answers(self):
+        survey = create_survey(self.user, 3)
+        first, _ = self.save_response(survey, self.user)
+        second, _ = self.save_response(survey, self.user)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(Answer.objects.filter(response=first).count(), 3)
+
+
+class CompiledSurveyTest(SurveyTestCase):
+
+    def test_compiled_questions(self):
+        survey = create_survey(self.user, 3)
+        schema = get_compiled_survey(survey)
+        self.assertEqual(schema.steps_count, 3)
+        radio = schema.questions[1]
+        self.assertEqual(radio.get_choices()[0], ("option-a", "Option A"))
+        self.assertEqual(radio.slug_to_label["option-b"], "Option B")
+        self.assertTrue(radio.is_valid_choice("option-c"))
+        self.assertTrue(radio.is_valid_choice("Option C"))
+        self.assertFalse(radio.is_valid_choice("option-d"))
+
+    def test_warm_cache_has_no_schema_queries(self):
+        survey = create_survey(self.user, 3)
+        data = answer_data(survey)
+        get_compiled_survey(survey)
+        with CaptureQueriesContext(connection) as context:
+            form = ResponseForm(
+                data, survey=survey, user=self.user, session_data={})
+            self.assertTrue(form.is_valid())
+        self.assertEqual(len(form.fields), 3)
+        for query in context.captured_queries:
+            self.assertNotIn("survey_question", query["sql"])
+
+    def test_question_save_invalidates_schema(self):
+        survey = create_survey(self.user, 2)
+        self.assertEqual(get_compiled_survey(survey).steps_count, 2)
+        question = Question.objects.create(survey=survey, text="New")
+        self.assertEqual(get_compiled_survey(survey).steps_count, 3)
+        question.delete()
+        self.assertEqual(get_compiled_survey(survey).steps_count, 2)
+
+    def test_deploy_check_wants_a_shared_cache(self):
+        self.assertEqual(
+            [error.id for error in check_shared_cache(None)], ["survey.W001"])
+        with override_settings(CACHES={"default": {
+                "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                "LOCATION": "cache"}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class StepRenderingTest(SurveyTestCase):
+
+    def get_step_queries(self, survey, step):
+        self.client.force_login(self.user)
+        self.client.get(reverse("survey-detail", kwargs={"id": survey.pk}))
+        url = reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": step})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["response_form"].fields), 1)
+        return context.captured_queries
+
+    def test_step_cost_does_not_depend_on_survey_size(self):
+        small = self.get_step_queries(create_survey(self.user, 5), 2)
+        large = self.get_step_queries(create_survey(self.user, 300), 2)
+        self.assertEqual(len(small), len(large))
+        for query in large:
+            self.assertNotIn("survey_question", query["sql"])
+
+    def test_positions_stay_contiguous(self):
+        survey = create_survey(self.user, 4)
+        survey.questions.get(position=1).delete()
+        self.assertEqual(
+            list(survey.questions.values_list("position", flat=True)),
+            [0, 1, 2])
+        Question.objects.filter(survey=survey, position=2).update(position=7)
+        self.assertEqual(survey.renumber_questions(), 1)
+        self.assertEqual(get_step_question(survey, 2).text, "Question 3")
+
+    def test_steps_follow_the_position_order(self):
+        survey = create_survey(self.user, 4)
+        # A gap and a duplicate, e.g. positions edited in a shell
+        positions = [("Question 1", 0), ("Question 2", 5), ("Question 3", 9)]
+        for text, position in positions:
+            Question.objects.filter(
+                survey=survey, text=text).update(position=position)
+        cache.clear()
+        texts = [get_step_question(survey, step).text for step in range(4)]
+        self.assertEqual(
+            texts, ["Question 0", "Question 1", "Question 2", "Question 3"])
+        self.assertEqual(texts, [
+            question.text
+            for question in get_compiled_survey(survey).questions])
+        self.assertIsNone(get_step_question(survey, 4))
+        self.assertIsNone(get_step_question(survey, -1))
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": 3}))
+        self.assertContains(response, "Question 3")
+
+    def test_cached_markup_matches_template(self):
+        survey = create_survey(self.user, 3)
+        Question.objects.create(
+            survey=survey, text="Many choices",
+            question_type=QuestionType.RADIO,
+            choices=", ".join(f"Choice {i}" for i in range(300)))
+        drafts = [{}, answer_data(survey)]
+        drafts[1]["question_%d" % survey.questions.last().pk] = "choice-250"
+        drafts[1]["question_%d" % survey.questions.first().pk] = (
+            "<b>Bold</b> & text")
+        for draft in drafts:
+            form = ResponseForm(survey=survey, user=self.user,
+                                session_data={}, draft_data=draft)
+            for bound_field in form:
+                self.assertHTMLEqual(
+                    rendering.render_question(bound_field),
+                    render_to_string(rendering.ROW_TEMPLATE,
+                                     {"form": bound_field}))
+        self.assertIs(rendering.get_question_markup(bound_field),
+                      rendering.get_question_markup(bound_field))
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": 3}))
+        self.assertContains(response, 'value="choice-250"', count=1)
+
+    def test_warm_up(self):
+        survey = create_survey(self.user, 3)
+        create_survey(self.user, 1,
+                      expire_date=timezone.now() - timedelta(days=1))
+        report = warmup.warm_up()
+        self.assertEqual(list(report), ["urls", "templates", "surveys"])
+        self.assertIn("survey/survey.html", warmup.get_template_names())
+        self.assertEqual(report["templates"][1],
+                         len(warmup.get_template_names()))
+        self.assertEqual(report["surveys"][1], 1)
+
+        # The first step is served from the warmed caches
+        form = ResponseForm(survey=survey, user=self.user, step=0,
+                            session_data={}, draft_data={})
+        with CaptureQueriesContext(connection) as context:
+            rendering.render_question(next(iter(form)))
+        self.assertEqual(len(context.captured_queries), 0)
+
+
+class ParticipationTest(SurveyTestCase):
+
+    def get_instruction_queries(self, survey):
+        self.client.force_login(self.user)
+        url = reverse("survey-instructions", kwargs={"id": survey.pk})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return context.captured_queries
+
+    def test_check_does_not_load_responses(self):
+        empty = self.get_instruction_queries(create_survey(self.user, 1))
+        survey = create_survey(self.user, 1)
+        Response.objects.bulk_create([
+            Response(survey=survey, user=User.objects.create_user(f"user{i}"))
+            for i in range(50)
+        ])
+        busy = self.get_instruction_queries(survey)
+        self.assertEqual(len(empty), len(busy))
+        for query in busy:
+            if "survey_response" in query["sql"]:
+                self.assertIn("LIMIT 1", query["sql"])
+
+    def test_participation_cache_is_updated(self):
+        survey = create_survey(self.user, 1)
+        self.assertFalse(has_participated(self.user, survey.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = Response.objects.create(survey=survey, user=self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(has_participated(self.user, survey.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            response.delete()
+        self.assertFalse(has_participated(self.user, survey.pk))
+        url = reverse("survey-instructions", kwargs={"id": survey.pk})
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            Response.objects.create(survey=survey, user=self.user)
+        self.assertRedirects(
+            self.client.get(url), reverse("survey-participated"))
+
+    def test_rolled_back_response_is_not_a_participation(self):
+        survey = create_survey(self.user, 1)
+        self.assertFalse(has_participated(self.user, survey.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                Response.objects.create(survey=survey, user=self.user)
+                raise ValueError
+        self.assertFalse(Response.objects.exists())
+        self.assertFalse(has_participated(self.user, survey.pk))
+        self.assertEqual(get_inbox_page(self.user)[0], [survey])
+
+    def test_response_saved_by_another_worker(self):
+        survey = create_survey(self.user, 1)
+        self.assertFalse(has_participated(self.user, survey.pk))
+        # Saved by another worker: the commit callbacks updating the cache
+        # of this one never run
+        Response.objects.create(survey=survey, user=self.user)
+        self.assertTrue(has_participated(self.user, survey.pk))
+        # The entry of this worker is lost, e.g. evicted
+        cache.delete(participation._get_key(survey.pk, self.user.pk))
+        self.client.force_login(self.user)
+        self.assertRedirects(
+            self.client.get(
+                reverse("survey-instructions", kwargs={"id": survey.pk})),
+            reverse("survey-participated"))
+
+
+class InboxTest(SurveyTestCase):
+
+    def get_titles(self, user, **kwargs):
+        surveys, _ = get_inbox_page(user, **kwargs)
+        return [survey.title for survey in surveys]
+
+    def test_inbox_is_updated_incrementally(self):
+        survey = create_survey(self.user, 1, title="First")
+        self.assertEqual(self.get_titles(self.user), ["First"])
+        newcomer = User.objects.create_user("newcomer", is_staff=True)
+        self.assertEqual(self.get_titles(newcomer), ["First"])
+        response = Response.objects.create(survey=survey, user=self.user)
+        self.assertEqual(self.get_titles(self.user), [])
+        self.assertEqual(self.get_titles(newcomer), ["First"])
+        with self.captureOnCommitCallbacks(execute=True):
+            response.delete()
+        self.assertEqual(self.get_titles(self.user), ["First"])
+        survey.is_active = False
+        survey.save()
+        self.assertEqual(self.get_titles(newcomer), [])
+
+    def test_expired_surveys_are_hidden(self):
+        survey = create_survey(self.user, 1)
+        Survey.objects.filter(pk=survey.pk).update(expire_date=timezone.now())
+        survey.inbox_entries.update(expire_date=timezone.now())
+        self.assertEqual(self.get_titles(self.user), [])
+        self.assertEqual(prune_expired(), 1)
+
+    def test_keyset_pagination(self):
+        for i in range(5):
+            create_survey(self.user, 0, title=f"Survey {i}")
+        surveys, cursor = get_inbox_page(self.user, size=3)
+        self.assertEqual(
+            [s.title for s in surveys], ["Survey 4", "Survey 3", "Survey 2"])
+        self.assertEqual(
+            self.get_titles(self.user, before=cursor, size=3),
+            ["Survey 1", "Survey 0"])
+
+    def test_list_query_count_is_constant(self):
+        self.client.force_login(self.user)
+        url = reverse("survey-list")
+        create_survey(self.user, 0)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        for i in range(30):
+            survey = create_survey(self.user, 0)
+            if i % 2:
+                Response.objects.create(survey=survey, user=self.user)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(len(response.context["surveys"]), 16)
+
+
+class TallyTest(SurveyTestCase):
+
+    def submit(self, survey, user, response_type=ResponseType.SUBMITTED):
+        form = ResponseForm(
+            answer_data(survey), survey=survey, user=user,
+            session_data={"response_type": response_type})
+        self.assertTrue(form.is_valid())
+        return form.save()
+
+    def test_tallies_are_updated_on_submit(self):
+        survey = create_survey(self.user, 3)
+        radio, select = survey.questions.all()[1:]
+        self.submit(survey, self.user)
+        self.submit(
+            survey, User.objects.create_user("other"), ResponseType.TIMEUP)
+        results = get_results(survey)
+        questions, choices = results["questions"], results["choices"]
+        self.assertEqual(results["tally"].submitted, 1)
+        self.assertEqual(results["tally"].timeup, 1)
+        self.assertEqual(questions[(radio.pk, ResponseType.TIMEUP)], 1)
+        self.assertEqual(
+            choices[(radio.pk, "option-a", ResponseType.SUBMITTED)], 1)
+        self.assertEqual(
+            choices[(select.pk, "option-c", ResponseType.TIMEUP)], 1)
+        self.assertNotIn(
+            (select.pk, "option-b", ResponseType.TIMEUP), choices)
+        self.assertEqual(survey.total_responses(), 2)
+
+    def test_rebuild_tallies(self):
+        survey = create_survey(self.user, 3)
+        self.submit(survey, self.user)
+        self.submit(
+            survey, User.objects.create_user("other"), ResponseType.TIMEUP)
+        expected = get_results(survey)
+        call_command("rebuild_tallies", survey.pk, stdout=StringIO())
+        results = get_results(survey)
+        self.assertEqual(results["questions"], expected["questions"])
+        self.assertEqual(results["choices"], expected["choices"])
+        self.assertEqual(results["tally"].total, 2)
+
+    def test_results_view(self):
+        survey = create_survey(self.user, 3)
+        self.submit(survey, self.user)
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("survey-results", kwargs={"id": survey.pk}))
+        self.assertContains(response, "1 responses: 1 submitted, 0 time up")
+
+
+class ExportTest(SurveyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.survey = create_survey(self.user, 3)
+        for user in [self.user, User.objects.create_user("other")]:
+            form = ResponseForm(
+                answer_data(self.survey), survey=self.survey, user=user,
+                session_data={})
+            self.assertTrue(form.is_valid())
+            form.save()
+
+    def test_export_command_csv(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "export.csv")
+            stderr = StringIO()
+            call_command(
+                "export_responses", self.survey.pk, output=path, stderr=stderr)
+            with open(path, newline="") as export:
+                rows = list(csv.DictReader(export))
+        self.assertIn("rows/s", stderr.getvalue())
+        self.assertEqual([row["user"] for row in rows], ["staff", "other"])
+        select = self.survey.questions.get(question_type=QuestionType.SELECT)
+        self.assertEqual(
+            rows[0]["question_%d" % select.pk], "option-a; option-c")
+
+    def test_export_endpoint_gzip_jsonl(self):
+        self.client.force_login(
+            User.objects.create_user("admin", is_staff=True))
+        url = reverse("api-survey-export", kwargs={"id": self.survey.pk})
+        response = self.client.get(url, {"format": "jsonl", "gzip": "1"})
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        content = gzip.decompress(b"".join(response.streaming_content))
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(len(rows), 2)
+        select = self.survey.questions.get(question_type=QuestionType.SELECT)
+        self.assertEqual(
+            rows[1]["question_%d" % select.pk], ["option-a", "option-c"])
+
+
+class DraftStoreTest(SurveyTestCase):
+
+    def walk_survey(self, survey):
+        """
+        Answer every step of a survey, return the session sizes after each
+        step and the final response.
+        """
+        self.client.force_login(self.user)
+        data = answer_data(survey)
+        questions = list(survey.questions.all())
+        sizes = []
+        response = None
+        for step, question in enumerate(questions):
+            url = reverse(
+                "survey-detail-step", kwargs={"id": survey.pk, "step": step})
+            field_name = "question_%d" % question.pk
+            last = step == len(questions) - 1
+            response = self.client.post(url, {
+                field_name: data[field_name],
+                "step_type": "Submit" if last else "Next!",
+            })
+            self.assertEqual(response.status_code, 302)
+            sizes.append(len(json.dumps(dict(self.client.session.items()))))
+        return sizes, response
+
+    def check_walk(self):
+        survey = create_survey(self.user, 6)
+        sizes, response = self.walk_survey(survey)
+        self.assertEqual(len(set(sizes[:-1])), 1)
+        saved = Response.objects.get(survey=survey, user=self.user)
+        self.assertRedirects(
+            response,
+            reverse("survey-confirmation", kwargs={"response_id": saved.pk}),
+            fetch_redirect_response=False)
+        self.assertEqual(saved.answers.count(), 6)
+        self.assertEqual(
+            get_draft_store().load_all(self.user.id, survey.pk), {})
+
+    def test_database_store(self):
+        self.check_walk()
+
+    @override_settings(SURVEY_DRAFT_STORE="survey.drafts.CacheDraftStore")
+    def test_cache_store(self):
+        self.check_walk()
+
+    def test_previous_answer_is_restored(self):
+        survey = create_survey(self.user, 3)
+        self.client.force_login(self.user)
+        radio = survey.questions.get(question_type=QuestionType.RADIO)
+        url = reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": 1})
+        self.client.post(url, {
+            "question_%d" % radio.pk: "option-b", "step_type": "Next!"})
+        response = self.client.get(url)
+        fields = response.context["response_form"].fields
+        self.assertEqual(
+            fields["question_%d" % radio.pk].initial, "option-b")
+
+
+class AttemptTest(SurveyTestCase):
+
+    def test_steps_do_not_write_the_session(self):
+        survey = create_survey(self.user, 2)
+        self.client.force_login(self.user)
+        for step in (0, 1, 0):
+            response = self.client.get(reverse(
+                "survey-detail-step", kwargs={"id": survey.pk, "step": step}))
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.wsgi_request.session.modified)
+            self.assertAlmostEqual(
+                response.context["time_remaining"], 600, delta=5)
+        self.assertEqual(
+            Attempt.objects.filter(survey=survey).in_progress().count(), 1)
+
+    def test_time_up(self):
+        survey = create_survey(self.user, 2)
+        self.client.force_login(self.user)
+        step = reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": 0})
+        self.client.get(step)
+        Attempt.objects.update(deadline=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(Attempt.objects.past_deadline().count(), 1)
+        self.assertFalse(Attempt.objects.in_progress().exists())
+        self.assertRedirects(
+            self.client.get(step), reverse("survey-participated"),
+            fetch_redirect_response=False)
+
+        api = self.client.get(
+            reverse("api-survey-timeout", kwargs={"id": survey.pk}))
+        response = Response.objects.get(survey=survey, user=self.user)
+        self.assertEqual(api.json()["response_id"], response.pk)
+        self.assertEqual(response.response_type, ResponseType.TIMEUP)
+        self.assertFalse(Attempt.objects.past_deadline().exists())
+
+    def test_time_up_saved_meanwhile(self):
+        survey = create_survey(self.user, 2)
+        self.client.force_login(self.user)
+        self.client.get(reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": 0}))
+        Attempt.objects.update(deadline=timezone.now() - timedelta(seconds=1))
+        # Saved by the finalizer after the participation check
+        response = Response.objects.create(
+            survey=survey, user=self.user, response_type=ResponseType.TIMEUP)
+        with mock.patch("survey.views.has_participated", return_value=False):
+            api = self.client.get(
+                reverse("api-survey-timeout", kwargs={"id": survey.pk}))
+        self.assertEqual(api.status_code, 200)
+        self.assertEqual(api.json()["response_id"], response.pk)
+        self.assertEqual(Response.objects.filter(survey=survey).count(), 1)
+
+    def test_open_attempts_are_indexed(self):
+        survey = create_survey(self.user, 1)
+        for queryset in (Attempt.objects.filter(survey=survey).in_progress(),
+                         Attempt.objects.past_deadline()):
+            plan = queryset.explain()
+            self.assertIn("attempt_open_", plan)
+
+
+class FinalizerTest(SurveyTestCase):
+
+    def start_attempt(self, survey, user):
+        self.client.force_login(user)
+        radio = survey.questions.get(question_type=QuestionType.RADIO)
+        url = reverse("survey-detail-step",
+                      kwargs={"id": survey.pk, "step": radio.position})
+        self.client.post(url, {
+            "question_%d" % radio.pk: "option-b", "step_type": "Next!"})
+        Attempt.objects.filter(user=user).update(
+            deadline=timezone.now() - timedelta(minutes=1))
+        return radio
+
+    def test_expired_attempts_are_finalized(self):
+        survey = create_survey(self.user, 3)
+        other = User.objects.create_user("other", is_staff=True)
+        radio = self.start_attempt(survey, self.user)
+        self.start_attempt(survey, other)
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("finalize_expired_attempts", grace=0, stdout=stdout)
+        self.assertIn(
+            "2 attempts finalized, 2 responses created", stdout.getvalue())
+
+        response = Response.objects.get(survey=survey, user=self.user)
+        self.assertEqual(response.response_type, ResponseType.TIMEUP)
+        self.assertEqual(response.answers.get().body, "option-b")
+        self.assertEqual(get_results(survey)["choices"][
+            (radio.pk, "option-b", ResponseType.TIMEUP)], 2)
+        self.assertEqual(
+            get_draft_store().load_all(self.user.id, survey.pk), {})
+        self.assertTrue(has_participated(self.user, survey.pk))
+
+        # Idempotent with the command and the timeout endpoint
+        call_command("finalize_expired_attempts", grace=0, stdout=stdout)
+        self.assertEqual(Response.objects.filter(survey=survey).count(), 2)
+        self.client.force_login(self.user)
+        api = self.client.get(
+            reverse("api-survey-timeout", kwargs={"id": survey.pk}))
+        self.assertEqual(api.json()["response_id"], response.pk)
+
+    def test_response_saved_during_finalization(self):
+        survey = create_survey(self.user, 3)
+        other = User.objects.create_user("other", is_staff=True)
+        radio = self.start_attempt(survey, self.user)
+        self.start_attempt(survey, other)
+        get_responded = persistence._get_responded
+
+        def insert_after_select(survey_id, user_ids):
+            responded = get_responded(survey_id, user_ids)
+            # Saved by the timeout endpoint between the select of the
+            # existing responses and the insert
+            if not Response.objects.filter(user=self.user).exists():
+                Response.objects.create(
+                    survey=survey, user=self.user,
+                    response_type=ResponseType.SUBMITTED)
+            return responded
+
+        with mock.patch("survey.persistence._get_responded",
+                        side_effect=insert_after_select), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(finalize_batch(grace=timedelta(0)), (2, 1))
+        self.assertEqual(
+            Response.objects.get(user=self.user).response_type,
+            ResponseType.SUBMITTED)
+        saved = Response.objects.get(user=other)
+        self.assertEqual(saved.response_type, ResponseType.TIMEUP)
+        self.assertEqual(saved.answers.get().body, "option-b")
+        self.assertEqual(get_results(survey)["choices"][
+            (radio.pk, "option-b", ResponseType.TIMEUP)], 1)
+        self.assertFalse(
+            Attempt.objects.filter(finalized_at__isnull=True).exists())
+        self.assertTrue(has_participated(other, survey.pk))
+
+    def test_attempts_in_time_are_kept(self):
+        survey = create_survey(self.user, 3)
+        self.start_attempt(survey, self.user)
+        Attempt.objects.update(deadline=timezone.now() + timedelta(minutes=1))
+        call_command("finalize_expired_attempts", grace=0, stdout=StringIO())
+        self.assertFalse(Response.objects.exists())
+
+    def test_submitted_attempt_is_finalized(self):
+        survey = create_survey(self.user, 1)
+        question = survey.questions.get()
+        self.client.force_login(self.user)
+        self.client.post(reverse("survey-detail", kwargs={"id": survey.pk}), {
+            "question_%d" % question.pk: "text", "step_type": "Submit"})
+        self.assertIsNotNone(Attempt.objects.get().finalized_at)
+
+
+class SubmitApiTest(SurveyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def submit(self, survey, payload):
+        return self.client.post(
+            reverse("api-survey-submit", kwargs={"id": survey.pk}),
+            json.dumps(payload), content_type="application/json")
+
+    def test_manifest_and_submit(self):
+        survey = create_survey(self.user, 6)
+        manifest = self.client.get(
+            reverse("api-survey-manifest", kwargs={"id": survey.pk})).json()
+        self.assertEqual(len(manifest["questions"]), 6)
+        self.assertEqual(manifest["questions"][1]["choices"][0],
+                         {"value": "option-a", "label": "Option A"})
+        self.assertEqual(
+            manifest["deadline"], Attempt.objects.get().deadline.isoformat())
+
+        data = answer_data(survey)
+        payload = {"version": manifest["version"], "answers": data}
+        with CaptureQueriesContext(connection) as context:
+            response = self.submit(survey, payload)
+        self.assertEqual(response.status_code, 201)
+        saved = Response.objects.get(survey=survey, user=self.user)
+        self.assertEqual(response.json()["response_id"], saved.pk)
+        self.assertEqual(saved.response_type, ResponseType.SUBMITTED)
+        self.assertEqual(saved.answers.count(), 6)
+        self.assertIsNotNone(Attempt.objects.get().finalized_at)
+        self.assertLess(len(context.captured_queries), 30)
+
+        response = self.submit(survey, payload)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["response_id"], saved.pk)
+
+    def test_rejected_submissions(self):
+        survey = create_survey(self.user, 3)
+        version = get_compiled_survey(survey).digest
+        data = answer_data(survey)
+
+        self.assertEqual(
+            self.submit(survey, {"version": version}).status_code, 400)
+        stale = self.submit(survey, {"version": "old", "answers": data})
+        self.assertEqual(stale.status_code, 409)
+        self.assertEqual(stale.json()["version"], version)
+
+        radio = survey.questions.get(question_type=QuestionType.RADIO)
+        data["question_%d" % radio.pk] = "option-z"
+        invalid = self.submit(survey, {"version": version, "answers": data})
+        self.assertEqual(invalid.status_code, 400)
+        self.assertIn("question_%d" % radio.pk, invalid.json()["errors"])
+        self.assertFalse(Response.objects.exists())
+
+        # Late submissions are saved as time up
+        Attempt.start(self.user, survey)
+        Attempt.objects.update(deadline=timezone.now() - timedelta(minutes=1))
+        late = self.submit(
+            survey, {"version": version, "answers": answer_data(survey)})
+        self.assertEqual(late.json()["response_type"], ResponseType.TIMEUP)
+
+
+@override_settings(SURVEY_WRITE_BEHIND=True)
+class WriteBehindTest(SurveyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_submit_is_accepted_then_flushed(self):
+        survey = create_survey(self.user, 6)
+        Attempt.start(self.user, survey)
+        url = reverse("api-survey-submit", kwargs={"id": survey.pk})
+        payload = json.dumps({"version": get_compiled_survey(survey).digest,
+                              "answers": answer_data(survey)})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                url, payload, content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(Response.objects.exists())
+        self.assertIsNotNone(Attempt.objects.get().finalized_at)
+        self.assertTrue(has_participated(self.user, survey.pk))
+        cache.clear()
+        self.assertTrue(has_participated(self.user, survey.pk))
+
+        again = self.client.post(url, payload, content_type="application/json")
+        self.assertEqual(again.status_code, 409)
+        self.assertTrue(again.json()["pending"])
+        accepted = self.client.get(response.json()["redirect_url"])
+        self.assertContains(accepted, "Your answers have been received")
+
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("flush_submissions", stdout=stdout)
+        self.assertIn("1 submissions flushed, 1 responses created",
+                      stdout.getvalue())
+        saved = Response.objects.get(survey=survey, user=self.user)
+        self.assertEqual(saved.response_type, ResponseType.SUBMITTED)
+        self.assertEqual(saved.answers.count(), 6)
+        self.assertEqual(get_results(survey)["tally"].total, 1)
+        self.assertFalse(PendingSubmission.objects.exists())
+        self.assertRedirects(
+            self.client.get(response.json()["redirect_url"]),
+            reverse("survey-confirmation", kwargs={"response_id": saved.pk}))
+
+    def test_last_step_and_timeout(self):
+        survey = create_survey(self.user, 1)
+        question = survey.questions.get()
+        response = self.client.post(
+            reverse("survey-detail", kwargs={"id": survey.pk}),
+            {"question_%d" % question.pk: "text", "step_type": "Submit"})
+        self.assertRedirects(
+            response, reverse("survey-accepted", kwargs={"id": survey.pk}),
+            fetch_redirect_response=False)
+        self.assertEqual(json.loads(PendingSubmission.objects.get().values),
+                         {"question_%d" % question.pk: "text"})
+
+        # The time out of another survey is accepted too, and the finalizer
+        # leaves the pending submission alone
+        other = create_survey(self.user, 1)
+        Attempt.start(self.user, other)
+        Attempt.objects.filter(survey=other).update(
+            deadline=timezone.now() - timedelta(minutes=1))
+        api = self.client.get(
+            reverse("api-survey-timeout", kwargs={"id": other.pk}))
+        self.assertEqual(api.json()["status"], "accepted")
+        call_command("finalize_expired_attempts", grace=0, stdout=StringIO())
+        self.assertFalse(Response.objects.exists())
+
+        call_command("flush_submissions", stdout=StringIO())
+        self.assertEqual(
+            dict(Response.objects.values_list("survey_id", "response_type")),
+            {survey.pk: ResponseType.SUBMITTED, other.pk: ResponseType.TIMEUP})
+
+
+class AdminQueryBudgetTest(SurveyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(
+            "admin", password="password")
+        self.client.force_login(self.admin)
+
+    def add_responses(self, survey, count):
+        for i in range(count):
+            user = User.objects.create_user(f"user-{survey.pk}-{i}")
+            form = ResponseForm(
+                answer_data(survey), survey=survey, user=user,
+                session_data={})
+            self.assertTrue(form.is_valid())
+            form.save()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelists(self):
+        for _ in range(2):
+            self.add_responses(create_survey(self.user, 3), 2)
+        responses_url = reverse("admin:survey_response_changelist")
+        surveys_url = reverse("admin:survey_survey_changelist")
+        budget = (self.count_queries(responses_url),
+                  self.count_queries(surveys_url))
+
+        for _ in range(3):
+            self.add_responses(create_survey(self.user, 3), 5)
+        self.assertEqual(
+            (self.count_queries(responses_url),
+             self.count_queries(surveys_url)),
+            budget)
+
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(responses_url)
+        for query in context.captured_queries:
+            self.assertNotIn("DISTINCT", query["sql"])
+
+        survey = Survey.objects.first()
+        page = self.client.get(responses_url, {"survey": survey.pk})
+        self.assertEqual(
+            page.context["cl"].result_count, survey.responses.count())
+
+    def test_answers_are_paginated(self):
+        survey = create_survey(self.user, 60)
+        self.add_responses(survey, 1)
+        url = reverse(
+            "admin:survey_response_change", args=[Response.objects.get().pk])
+        first = self.count_queries(url)
+        page = self.client.get(url)
+        formset = page.context["inline_admin_formsets"][0].formset
+        self.assertEqual(len(formset.forms), 50)
+        page = self.client.get(url, {"answers_page": 2})
+        formset = page.context["inline_admin_formsets"][0].formset
+        self.assertEqual(len(formset.forms), 10)
+        self.assertLess(first, 20)
+
+
+class SearchTest(SurveyTestCase):
+
+    def add_response(self, survey, text):
+        user = User.objects.create_user(f"user-{User.objects.count()}")
+        data = answer_data(survey)
+        for question in survey.questions.filter(
+                question_type=QuestionType.TEXT):
+            data["question_%d" % question.pk] = text
+        form = ResponseForm(data, survey=survey, user=user, session_data={})
+        self.assertTrue(form.is_valid())
+        return form.save()
+
+    def test_search_is_ranked_and_kept_up_to_date(self):
+        survey = create_survey(self.user, 3)
+        other = create_survey(self.user, 1)
+        once = self.add_response(survey, "The coffee machine is broken")
+        twice = self.add_response(survey, "Coffee, coffee and more coffee")
+        self.add_response(survey, "Nothing to say")
+        self.add_response(other, "Coffee is fine")
+
+        results = search_answers("COFFEE", survey_id=survey.pk)
+        self.assertEqual([hit.response_id for hit in results.hits],
+                         [twice.pk, once.pk])
+        self.assertIn("\x02coffee\x03", results.hits[1].snippet)
+        self.assertEqual(len(search_answers("coff* broken").hits), 1)
+        # Not the choices of the radio and select questions
+        self.assertEqual(search_answers("option").hits, [])
+        self.assertEqual(
+            search_answers("coffee", indexed=False).hits[0].survey_id,
+            other.pk)
+
+        first = search_answers("coffee", survey_id=survey.pk, per_page=1)
+        second = search_answers(
+            "coffee", survey_id=survey.pk, page=2, per_page=1)
+        self.assertTrue(first.has_next)
+        self.assertFalse(second.has_next)
+        self.assertEqual(second.hits[0].response_id, once.pk)
+
+        Answer.objects.filter(response=once).update(body="Tea please")
+        self.assertEqual(search_answers("tea").hits[0].response_id, once.pk)
+        twice.delete()
+        self.assertEqual(
+            search_answers("coffee", survey_id=survey.pk).hits, [])
+
+    def test_api_and_admin(self):
+        survey = create_survey(self.user, 1)
+        response = self.add_response(survey, "Better <b>coffee</b>")
+        self.client.force_login(self.user)
+        url = reverse("api-survey-search", kwargs={"id": survey.pk})
+        api = self.client.get(
+            url, {"q": "coffee", "question": survey.questions.get().pk}
+        ).json()
+        self.assertEqual(api["results"][0]["response_id"], response.pk)
+        self.assertEqual(api["results"][0]["highlight"],
+                         "Better &lt;b&gt;<mark>coffee</mark>&lt;/b&gt;")
+        self.assertFalse(api["has_next"])
+        self.assertEqual(
+            self.client.get(url, {"q": "coffee", "page": "x"}).status_code,
+            400)
+
+        self.client.force_login(
+            User.objects.create_superuser("admin", password="password"))
+        page = self.client.get(
+            reverse("admin:survey_survey_search", args=[survey.pk]),
+            {"q": "coffee"})
+        self.assertContains(page, "<mark>coffee</mark>")
+        self.assertContains(page, reverse(
+            "admin:survey_response_change", args=[response.pk]))
+
+
+class LoadTestTest(SurveyTestCase):
+
+    def test_loadtest(self):
+        stdout = StringIO()
+        call_command(
+            "loadtest", respondents=4, concurrency=1, questions=4,
+            timeout_ratio=0.5, json=True, stdout=stdout)
+        summary = json.loads(stdout.getvalue())
+        self.assertEqual(summary["errors"], 0)
+        self.assertEqual(summary["requests_by_name"]["submit"]["requests"], 2)
+        self.assertEqual(summary["requests_by_name"]["timeout"]["requests"], 2)
+        self.assertGreater(summary["queries_per_step"], 0)
+        self.assertGreater(summary["session_bytes"], 0)
+        # The fixture is removed
+        self.assertFalse(Survey.objects.exists())
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_fixture_stays_out_of_real_inboxes(self):
+        survey, users = create_fixture(2, 1)
+        self.assertTrue(survey.is_active)
+        self.assertEqual(get_inbox_page(self.user)[0], [])
+        self.assertEqual(get_inbox_page(users[1])[0], [survey])
+        self.assertFalse(users[1].has_usable_password())
+
+        # Left by a killed run
+        stdout = StringIO()
+        call_command("loadtest", cleanup=True, stdout=stdout)
+        self.assertIn("1 surveys and 2 users deleted", stdout.getvalue())
+        self.assertEqual(list(User.objects.all()), [self.user])
+
+    def test_budget_exceeded(self):
+        with self.assertRaisesMessage(CommandError, "queries_per_step"):
+            call_command(
+                "loadtest", "--budget", "queries_per_step=0.5", respondents=1,
+                concurrency=1, questions=2, stdout=StringIO())
+
+
+@override_settings(SURVEY_DB_REPLICAS=["replica1"])
+class ReplicaRoutingTest(TransactionTestCase):
+
+    def test_router(self):
+        self.assertEqual(router.db_for_read(Survey), "default")
+        with use_replica():
+            self.assertEqual(router.db_for_read(Survey), "replica1")
+            self.assertEqual(router.db_for_read(Session), "default")
+            self.assertEqual(router.db_for_write(Survey), "default")
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Survey), "default")
+
+    def test_pin_after_write(self):
+        reads = []
+
+        def view(request):
+            if request.method == "POST":
+                router.db_for_write(Response)
+            with use_replica():
+                reads.append(router.db_for_read(Response))
+            return HttpResponse()
+
+        middleware = ReplicaPinMiddleware(view)
+        factory = RequestFactory()
+        response = middleware(factory.post("/"))
+        self.assertIn(PIN_COOKIE, response.cookies)
+        factory.cookies[PIN_COOKIE] = "1"
+        middleware(factory.get("/"))
+        response = middleware(RequestFactory().get("/"))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(reads, ["default", "default", "replica1"])
+
+    def test_streaming_response_reads_replica(self):
+        @read_replica
+        def view(request):
+            return StreamingHttpResponse(
+                router.db_for_read(Survey) for _ in range(2))
+
+        response = view(RequestFactory().get("/"))
+        self.assertEqual(b"".join(response.streaming_content),
+                         b"replica1replica1")
+
+
+class MetricsTest(SurveyTestCase):
+
+    def test_server_timing(self):
+        survey = create_survey(self.user, 2)
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("survey-detail-step", kwargs={"id": survey.pk, "step": 0}))
+        timings = [
+            entry.split(";")[0]
+            for entry in response["Server-Timing"].split(", ")]
+        for name in ["db", "valid_survey", "form", "template", "total"]:
+            self.assertIn(name, timings)
+
+    def test_metrics_endpoint(self):
+        survey = create_survey(self.user, 2)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 302)
+        self.client.force_login(self.user)
+        self.client.get(reverse(
+            "survey-detail-step", kwargs={"id": survey.pk, "step": 0}))
+        text = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn("# TYPE survey_request_db_queries histogram", text)
+        self.assertIn(
+            'survey_timer_seconds_count{timer="form",'
+            'view="survey-detail-step"}', text)
+        self.assertIn(
+            'survey_request_session_bytes_bucket{view="survey-detail-step",'
+            'le="+Inf"}', text)
+
+    def test_processes_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Histogram written by another worker process
+            with open(os.path.join(directory, "metrics-1.json"), "w") as file:
+                json.dump([[
+                    "survey_response_bytes", [["view", "other"]],
+                    [1, 0, 0, 0, 0, 0, 0, 2, 5000, 3],
+                ]], file)
+            with override_settings(SURVEY_METRICS_DIR=directory):
+                self.client.force_login(self.user)
+                text = self.client.get(reverse("metrics")).content.decode()
+                own = os.path.join(directory, "metrics-%d.json" % os.getpid())
+                self.assertTrue(os.path.exists(own))
+        self.assertIn(
+            'survey_response_bytes_bucket{view="other",le="256"} 1', text)
+        self.assertIn(
+            'survey_response_bytes_bucket{view="other",le="+Inf"} 3', text)
+        self.assertIn('survey_response_bytes_count{view="other"} 3', text)
+
+
+class LiveDashboardTest(SurveyTestCase):
+
+    def submit(self, survey, user, response_type=ResponseType.SUBMITTED):
+        form = ResponseForm(
+            answer_data(survey), survey=survey, user=user,
+            session_data={"response_type": response_type})
+        self.assertTrue(form.is_valid())
+        with self.captureOnCommitCallbacks(execute=True):
+            return form.save()
+
+    def test_snapshot_is_built_once_per_change(self):
+        survey = create_survey(self.user, 3)
+        self.assertEqual(live.get_snapshot(survey.pk)["total"], 0)
+        version = live.get_version(survey.pk)
+        self.submit(survey, self.user)
+        self.submit(survey, User.objects.create_user("other"),
+                    ResponseType.TIMEUP)
+        self.assertNotEqual(live.get_version(survey.pk), version)
+
+        cache.delete(live.BUILD_LOCK_KEY.format(survey_id=survey.pk))
+        with CaptureQueriesContext(connection) as one:
+            live.get_snapshot(survey.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            Attempt.start(User.objects.create_user("third"), survey)
+        cache.delete(live.BUILD_LOCK_KEY.format(survey_id=survey.pk))
+        # 100 viewers of a new version
+        with CaptureQueriesContext(connection) as many:
+            snapshots = [live.get_snapshot(survey.pk) for _ in range(100)]
+        self.assertEqual(len(many), len(one))
+        snapshot = snapshots[-1]
+        self.assertEqual((snapshot["submitted"], snapshot["timeup"]), (1, 1))
+        self.assertEqual(snapshot["completion_ratio"], 0.5)
+        self.assertEqual(snapshot["in_progress"], 1)
+        self.assertEqual(
+            [question["answered"] for question in snapshot["questions"]],
+            [2, 2, 2])
+
+    @override_settings(SURVEY_LIVE_SNAPSHOT_SECONDS=0.05)
+    def test_snapshot_expires(self):
+        survey = create_survey(self.user, 1)
+        key = live.SNAPSHOT_KEY.format(survey_id=survey.pk)
+        live.get_snapshot(survey.pk)
+        self.assertIsNotNone(cache.get(key))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(key))
+
+    @override_settings(SURVEY_LIVE_INTERVAL=0.01)
+    def test_change_feed(self):
+        survey = create_survey(self.user, 1)
+        version = live.get_version(survey.pk)
+        live.FEED.subscribe(survey.pk)
+        try:
+            live.notify_change(survey.pk)
+            self.assertEqual(live.FEED.wait(survey.pk, version, 5),
+                             live.get_version(survey.pk))
+        finally:
+            live.FEED.unsubscribe(survey.pk)
+
+    def test_event_stream(self):
+        survey = create_survey(self.user, 2)
+        url = reverse("api-survey-live", kwargs={"id": survey.pk})
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = b"".join(response.streaming_content).decode().split("\n\n")
+        self.assertTrue(events[0].startswith("retry: "))
+        event_id, event, data = events[1].split("\n")
+        self.assertEqual(event, "event: snapshot")
+        self.assertEqual(len(json.loads(data[len("data: "):])["questions"]), 2)
+
+        # Not sent again on reconnection
+        response = self.client.get(
+            url, HTTP_LAST_EVENT_ID=event_id[len("id: "):])
+        self.assertNotIn(b"event: snapshot",
+                         b"".join(response.streaming_content))
+        response = self.client.get(
+            reverse("survey-live", kwargs={"id": survey.pk}))
+        self.assertContains(response, "live-snapshot")
+
+    @override_settings(SURVEY_LIVE_INTERVAL=0.01,
+                       SURVEY_LIVE_STREAM_SECONDS=0.2)
+    def test_long_streams(self):
+        survey = create_survey(self.user, 1)
+        url = reverse("api-survey-live", kwargs={"id": survey.pk})
+        self.client.force_login(self.user)
+        for long_streams, lasts_longer in ((False, False), (True, True)):
+            with override_settings(SURVEY_LIVE_LONG_STREAMS=long_streams):
+                start = time.monotonic()
+                b"".join(self.client.get(url).streaming_content)
+                self.assertEqual(time.monotonic() - start >= 0.2, lasts_longer)
+
+
+class DefinitionTest(SurveyTestCase):
+
+    def import_file(self, content, suffix=".json", **options):
+        with tempfile.NamedTemporaryFile(
+                "w", suffix=suffix, delete=False) as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_survey", file.name, user="staff",
+                         stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_round_trip(self):
+        survey = create_survey(self.user, 4)
+        stdout = StringIO()
+        call_command("export_survey", survey.pk, format="yaml", stdout=stdout)
+        output = self.import_file(stdout.getvalue(), suffix=".yaml")
+        self.assertIn("4 questions created", output)
+        copy = Survey.objects.exclude(pk=survey.pk).get()
+
+        def describe(survey):
+            return [
+                (q.text, q.question_type, q.get_clean_choices(), q.position)
+                for q in survey.questions.all()
+            ]
+
+        self.assertEqual(describe(copy), describe(survey))
+
+    def test_reimport_is_a_diff(self):
+        survey = create_survey(self.user, 4)
+        kept = survey.questions.get(position=1)
+        form = ResponseForm(answer_data(survey), survey=survey, user=self.user,
+                            session_data={})
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(get_compiled_survey(survey).steps_count, 4)
+
+        stdout = StringIO()
+        call_command("export_survey", survey.pk, stdout=stdout)
+        definition = json.loads(stdout.getvalue())
+        questions = definition["questions"]
+        questions[0]["text"] = "Changed"
+        del questions[2]
+        questions.append(
+            {"text": "New", "type": "radio", "choices": ["Yes", "No"]})
+        questions[0], questions[1] = questions[1], questions[0]
+        output = self.import_file(
+            json.dumps(definition), survey=survey.pk, force=True)
+
+        self.assertIn(
+            "1 questions created, 2 updated, 1 deleted, 0 kept, 1 unchanged",
+            output)
+        self.assertEqual(
+            [q.text for q in survey.questions.all()],
+            ["Question 1", "Changed", "Question 3", "New"])
+        self.assertEqual(survey.questions.get(text="Question 1").pk, kept.pk)
+        self.assertEqual(Answer.objects.filter(question=kept).count(), 1)
+        self.assertEqual(
+            [q.text for q in get_compiled_survey(survey).questions],
+            ["Question 1", "Changed", "Question 3", "New"])
+
+    def test_reimport_keeps_answered_questions(self):
+        survey = create_survey(self.user, 4)
+        answered = survey.questions.get(position=1)
+        Answer.objects.create(
+            response=Response.objects.create(survey=survey, user=self.user),
+            question=answered, body="Option A")
+
+        stdout = StringIO()
+        call_command("export_survey", survey.pk, stdout=stdout)
+        definition = json.loads(stdout.getvalue())
+        del definition["questions"][1:3]
+        output = self.import_file(json.dumps(definition), survey=survey.pk)
+
+        self.assertIn(
+            "0 questions created, 1 updated, 1 deleted, 1 kept, 1 unchanged",
+            output)
+        self.assertIn(
+            f"Question {answered.pk} 'Question 1' has answers and was kept",
+            output)
+        self.assertEqual(
+            [(q.text, q.position) for q in survey.questions.all()],
+            [("Question 0", 0), ("Question 3", 1), ("Question 1", 2)])
+        self.assertEqual(Answer.objects.filter(question=answered).count(), 1)
+
+        output = self.import_file(
+            json.dumps(definition), survey=survey.pk, force=True)
+        self.assertIn("1 deleted, 0 kept", output)
+        self.assertEqual(
+            [q.text for q in survey.questions.all()],
+            ["Question 0", "Question 3"])
+        self.assertFalse(Answer.objects.exists())
+
+    def test_invalid_definition(self):
+        definition = {
+            "title": "Survey", "description": "", "duration": 10,
+            "questions": [
+                {"text": "Pick", "type": "radio", "choices": ["Only"]}],
+        }
+        with self.assertRaises(CommandError) as context:
+            self.import_file(json.dumps(definition))
+        self.assertIn("Missing description.", str(context.exception))
+        self.assertIn("Question 0: Choices must contain more than one item.",
+                      str(context.exception))
+        self.assertFalse(Survey.objects.exists())
+
+    def test_bulk_import(self):
+        definition = {
+            "title": "Big", "description": "Big survey", "duration": 10,
+            "questions": [
+                {"text": f"Question {i}", "type": "select",
+                 "choices": ["A", "B", "C"]}
+                for i in range(2000)
+            ],
+        }
+        with CaptureQueriesContext(connection) as context:
+            self.import_file(json.dumps(definition))
+        self.assertEqual(Question.objects.count(), 2000)
+        self.assertLess(len(context.captured_queries), 30)
+
+    def test_admin(self):
+        survey = create_survey(self.user, 2)
+        self.client.force_login(
+            User.objects.create_superuser("admin", password="password"))
+        exported = self.client.post(
+            reverse("admin:survey_survey_changelist"),
+            {"action": "export_definitions", "_selected_action": [survey.pk]})
+        definition = json.loads(exported.content)
+        self.assertEqual(len(definition["questions"]), 2)
+
+        definition["title"] = "Renamed"
+        upload = StringIO(json.dumps(definition))
+        upload.name = "survey.json"
+        response = self.client.post(reverse("admin:survey_survey_import"), {
+            "definition": upload, "survey": survey.pk})
+        self.assertRedirects(
+            response, reverse("admin:survey_survey_change", args=[survey.pk]))
+        survey.refresh_from_db()
+        self.assertEqual(survey.title, "Renamed")
+
+
+class IngestTest(SurveyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.survey = create_survey(self.user, 3)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "responses.jsonl")
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_lines(self, records):
+        with open(self.path, "a") as file:
+            for record in records:
+                if not isinstance(record, str):
+                    record = json.dumps(record)
+                file.write(record + "\n")
+
+    def ingest(self, **options):
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("ingest_responses", self.path, survey=self.survey.pk,
+                         stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_ingest(self):
+        User.objects.create_user("jdoe")
+        answers = answer_data(self.survey)
+        self.write_lines([
+            {"user": "jdoe", "answers": answers},
+            {"answers": answers},
+            {"answers": {key.split("_")[1]: value
+                         for key, value in answers.items()}},
+            "not json",
+            {"user": "unknown", "answers": answers},
+            {"user": "jdoe", "answers": answers},
+            {"answers": {key: "option-z" for key in answers}},
+        ])
+        output = self.ingest(batch_size=4)
+
+        self.assertIn("7 lines: 3 accepted, 4 rejected", output)
+        self.assertEqual(
+            Response.objects.filter(survey=self.survey).count(), 3)
+        self.assertEqual(
+            Answer.objects.filter(response__survey=self.survey).count(), 9)
+        self.assertTrue(has_participated(
+            User.objects.get(username="jdoe"), self.survey.pk))
+        self.assertEqual(get_results(self.survey)["tally"].submitted, 3)
+        with open(self.path + ".rejects.jsonl") as file:
+            rejects = [json.loads(line) for line in file]
+        self.assertEqual([reject["line"] for reject in rejects], [4, 5, 6, 7])
+        self.assertIn("already responded", rejects[2]["error"])
+
+    def test_resume(self):
+        self.write_lines([{"answers": answer_data(self.survey)}] * 3)
+        self.ingest()
+        self.write_lines([{"answers": answer_data(self.survey)}] * 2)
+        output = self.ingest()
+        self.assertIn("Resuming after line 3", output)
+        self.assertIn("5 lines: 5 accepted, 0 rejected", output)
+        self.assertEqual(
+            Response.objects.filter(survey=self.survey).count(), 5)
+
+    def test_workers(self):
+        self.write_lines([{"answers": answer_data(self.survey)}] * 5 + ["{}"])
+        output = self.ingest(workers=2, batch_size=3)
+        self.assertIn("6 lines: 5 accepted, 1 rejected", output)
+
+
+class ArchiveTest(SurveyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.survey = create_survey(self.user, 3)
+        for user in [self.user, User.objects.create_user("jdoe")]:
+            form = ResponseForm(answer_data(self.survey), survey=self.survey,
+                                user=user, session_data={})
+            self.assertTrue(form.is_valid())
+            form.save()
+        Survey.objects.filter(pk=self.survey.pk).update(
+            expire_date=timezone.now() - timedelta(days=400))
+
+    def export(self):
+        return list(iter_response_rows(self.survey.pk))
+
+    def test_archive_and_restore(self):
+        exported = self.export()
+        created_at = dict(Response.objects.values_list("pk", "created_at"))
+        stdout = StringIO()
+        call_command("archive_responses", directory=self.directory,
+                     stdout=stdout)
+        self.assertIn("Archived 2 responses", stdout.getvalue())
+        self.assertFalse(Response.objects.exists())
+        self.assertFalse(Answer.objects.exists())
+        self.assertFalse(AnswerChoice.objects.exists())
+        self.assertEqual(get_results(self.survey)["tally"].submitted, 2)
+
+        reader = open_archive(self.survey)
+        self.assertEqual(reader.survey["id"], self.survey.pk)
+        self.assertEqual(len(reader.survey["questions"]), 3)
+        [record] = reader.responses(user="jdoe")
+        self.assertEqual(len(record["answers"]), 3)
+        self.assertEqual(self.export(), exported)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("restore_responses", self.survey.pk,
+                         stdout=StringIO())
+        self.assertEqual(
+            dict(Response.objects.values_list("pk", "created_at")),
+            created_at)
+        self.assertEqual(Answer.objects.count(), 6)
+        self.assertEqual(AnswerChoice.objects.count(), 6)
+        self.assertEqual(self.export(), exported)
+        self.assertFalse(os.listdir(self.directory))
+
+    def test_rebuild_skips_archived_surveys(self):
+        call_command("archive_responses", directory=self.directory,
+                     stdout=StringIO())
+        results = get_results(self.survey)
+        stdout = StringIO()
+        call_command("rebuild_tallies", stdout=stdout)
+        self.assertIn(f"Survey {self.survey.pk}: archived, skipped",
+                      stdout.getvalue())
+        self.assertEqual(get_results(self.survey)["tally"].submitted, 2)
+        self.assertEqual(get_results(self.survey)["choices"],
+                         results["choices"])
+        self.assertEqual(sum(results["choices"].values()), 6)
+
+    def test_retention(self):
+        Survey.objects.filter(pk=self.survey.pk).update(
+            expire_date=timezone.now() - timedelta(days=10))
+        with self.assertRaises(CommandError):
+            call_command("archive_responses", survey=[self.survey.pk],
+                         directory=self.directory)
+        call_command("archive_responses", days=5, directory=self.directory,
+                     stdout=StringIO())
+        self.assertFalse(Response.objects.exists())
+
+
+class AsyncViewsTest(TransactionTestCase):
+    """
+    The async views run the ORM in another thread, which doesn't see the
+    transaction of a TestCase.
+    """
+
+    def setUp(self):
+        cache.clear()
+        clear_local_cache()
+        self.user = User.objects.create_user(
+            "staff", password="password", is_staff=True)
+        self.factory = AsyncRequestFactory()
+        self.session = SessionStore()
+
+    def request(self, view, method, data=None, **kwargs):
+        if method == "post":
+            request = self.factory.post(
+                "/", urlencode(data, doseq=True),
+                content_type="application/x-www-form-urlencoded")
+        else:
+            request = self.factory.get("/")
+        request.user = self.user
+        request.session = self.session
+        return async_to_sync(view)(request, **kwargs)
+
+    def test_walk_survey(self):
+        survey = create_survey(self.user, 3)
+        data = answer_data(survey)
+        questions = list(survey.questions.all())
+        for step, question in enumerate(questions):
+            page = self.request(
+                async_views.survey_detail, "get", id=survey.pk, step=step)
+            self.assertContains(page, question.text)
+            field_name = "question_%d" % question.pk
+            last = step == len(questions) - 1
+            response = self.request(async_views.survey_detail, "post", {
+                field_name: data[field_name],
+                "step_type": "Submit" if last else "Next!",
+            }, id=survey.pk, step=step)
+            self.assertEqual(response.status_code, 302)
+
+        saved = Response.objects.get(survey=survey, user=self.user)
+        self.assertEqual(response.url, reverse(
+            "survey-confirmation", kwargs={"response_id": saved.pk}))
+        self.assertEqual(saved.answers.count(), 3)
+        self.assertIsNotNone(Attempt.objects.get().finalized_at)
+
+        # Answered: redirected from the cache, the timeout API is idempotent
+        page = self.request(
+            async_views.survey_detail, "get", id=survey.pk, step=0)
+        self.assertEqual(page.url, reverse("survey-participated"))
+        api = self.request(async_views.timeout, "get", id=survey.pk)
+        self.assertEqual(json.loads(api.content)["response_id"], saved.pk)
+
+    def test_staff_required(self):
+        survey = create_survey(self.user, 1)
+        self.user.is_staff = False
+        page = self.request(async_views.survey_detail, "get", id=survey.pk)
+        self.assertEqual(page.status_code, 302)
+        self.assertFalse(Attempt.objects.exists())
@@ -1,15 +1,47 @@
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.urls import path
 
-from .views import ConfirmView, IndexView, SurveyPerticipated, SurveyInstruction, SurveyDetail, TimeOutView, timeout
+from survey.db import read_replica
+
+from .views import (
+    ConfirmView, IndexView, SubmissionAccepted, SurveyPerticipated,
+    SurveyInstruction, SurveyDetail, SurveyLive, SurveyResults, TimeOutView,
+    export_responses, metrics, survey_live_stream, survey_manifest,
+    survey_search, survey_submit, timeout)
+
+if getattr(settings, "SURVEY_ASYNC_VIEWS", False):
+    from .async_views import survey_detail as survey_detail_view
+    from .async_views import timeout as timeout_view
+else:
+    survey_detail_view = staff_member_required(SurveyDetail.as_view())
+    timeout_view = timeout
 
 urlpatterns = [
-    path('', staff_member_required(IndexView.as_view()), name='survey-list'),
-    path('api/survey/<id>/timeout/', timeout, name='api-survey-timeout'),
+    path('', staff_member_required(read_replica(IndexView.as_view())),
+         name='survey-list'),
+    path('api/survey/<id>/timeout/', timeout_view, name='api-survey-timeout'),
+    path('api/survey/<id>/export/', export_responses,
+         name='api-survey-export'),
+    path('api/survey/<id>/manifest/', survey_manifest,
+         name='api-survey-manifest'),
+    path('api/survey/<id>/submit/', survey_submit, name='api-survey-submit'),
+    path('api/survey/<id>/live/', survey_live_stream, name='api-survey-live'),
+    path('api/survey/<id>/search/', survey_search, name='api-survey-search'),
     path('survey/<id>/instructions/', staff_member_required(SurveyInstruction.as_view()), name='survey-instructions'),
+    path('metrics', metrics, name='metrics'),
     path('survey-participated/', SurveyPerticipated.as_view(), name='survey-participated'),
-    path('survey/<id>/', staff_member_required(SurveyDetail.as_view()), name='survey-detail'),
-    path('<id>-<step>/', staff_member_required(SurveyDetail.as_view()), name="survey-detail-step"),
+    path('survey/<id>/', survey_detail_view, name='survey-detail'),
+    path('survey/<id>/results/',
+         staff_member_required(read_replica(SurveyResults.as_view())),
+         name='survey-results'),
+    path('survey/<id>/live/',
+         staff_member_required(read_replica(SurveyLive.as_view())),
+         name='survey-live'),
+    path('<id>-<step>/', survey_detail_view, name="survey-detail-step"),
     path('survey/<response_id>/confirm/', staff_member_required(ConfirmView.as_view()), name="survey-confirmation"),
+    path('survey/<id>/accepted/',
+         staff_member_required(SubmissionAccepted.as_view()),
+         name="survey-accepted"),
     path('survey/<response_id>/timeout/', staff_member_required(TimeOutView.as_view()), name="survey-timeout"),
 ]
\ No newline at end of file
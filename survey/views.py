@@ -1,13 +1,32 @@
+import json
 import logging
-from datetime import datetime, timedelta
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http.response import JsonResponse
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError
+from django.http import Http404
+from django.http.response import (
+    HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse)
+from django.middleware.csrf import get_token
+from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import TemplateView, View
 from django.shortcuts import redirect, render, reverse, get_object_or_404
+from django.utils import timezone
 
+from survey import buffer
+from survey.db import read_replica
 from survey.decorators import valid_survey
+from survey.drafts import get_draft_store
+from survey.export import CONTENT_TYPES, FORMATS, iter_export
+from survey.inbox import get_inbox_page
+from survey.live import get_snapshot, iter_events, long_streams_enabled
+from survey.metrics import collect, render_prometheus, timer
+from survey.participation import has_participated
+from survey.schema import get_compiled_survey
+from survey.search import highlight, search_answers
+from survey.tallies import get_results
 from .forms import ResponseForm
-from .models import Response, Survey, ResponseType
+from .models import Attempt, PendingSubmission, Response, Survey, ResponseType
 
 LOGGER = logging.getLogger(__name__)
 
@@ -17,8 +36,15 @@ class IndexView(TemplateView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        surveys = Survey.objects.exclude(responses__user=self.request.user)    
+        try:
+            before = int(self.request.GET["before"])
+        except (KeyError, ValueError):
+            before = None
+        with timer("inbox"):
+            surveys, next_cursor = get_inbox_page(
+                self.request.user, before=before)
         context["surveys"] = surveys
+        context["next_cursor"] = next_cursor
         return context
 
 
@@ -34,9 +60,8 @@ class SurveyInstruction(View):
         if survey_status and survey_status in ['participated', 'timeout']:
             return redirect(reverse("survey-participated"))
 
-        session_key = kwargs['session_key']
         survey = kwargs['survey']
-        if session_key in request.session:
+        if kwargs['attempt'] is not None:
             return redirect(survey.get_absolute_url())
         template_name = 'survey/instruction.html'
         context = {}
@@ -52,21 +77,19 @@ class SurveyDetail(View):
     @valid_survey
     def setup(self, request, *args, **kwargs):
         """
-        Setup session and initializing values
+        Start the attempt of the user if needed. The remaining time comes
+        from its deadline, so showing a step doesn't write the session.
         """
         self.survey_status = kwargs['survey_status']
         self.survey = kwargs.get("survey")
         self.step = kwargs.get("step", 0)
-        self.session_key = 'survey_{}_{}'.format(request.user.id, kwargs['id'])
-        if self.session_key not in request.session:
-            request.session[self.session_key] = {}
-            request.session[self.session_key]['end_date'] = datetime.timestamp(datetime.now())
-            request.session[self.session_key]['end_date'] = datetime.timestamp(
-                datetime.now() + timedelta(minutes=self.survey.duration))
-
-        remaining_time = request.session[self.session_key]['end_date'] - datetime.timestamp(datetime.now())
-        request.session[self.session_key]['remaining'] = remaining_time if remaining_time>=0 else 0
-        self.session_data = request.session[self.session_key]
+        self.session_key = kwargs['session_key']
+        self.attempt = kwargs['attempt']
+        if self.attempt is None and not self.survey_status:
+            self.attempt = Attempt.start(request.user, self.survey)
+        self.session_data = {}
+        if self.attempt is not None and self.attempt.is_expired():
+            self.session_data['response_type'] = ResponseType.TIMEUP
 
         return super().setup(request, *args, **kwargs)
 
@@ -77,31 +100,39 @@ class SurveyDetail(View):
             return redirect(reverse("survey-participated"))
 
         template_name = "survey/survey.html"
-        form = ResponseForm(
-            survey=self.survey,
-            user=request.user,
-            step=self.step,
-            session_data=self.session_data
-        )
-        context = {
+        return render(request, template_name,
+                      self.get_context_data(self.get_form(request)))
+
+    def get_form(self, request):
+        with timer("form"):
+            return ResponseForm(
+                survey=self.survey,
+                user=request.user,
+                step=self.step,
+                session_data=self.session_data
+            )
+
+    def get_context_data(self, form):
+        return {
             "response_form": form,
             "survey": self.survey,
             "step": self.step,
-            "time_remaining": int(self.session_data['remaining']),
+            "time_remaining": int(self.attempt.get_remaining()),
         }
-        return render(request, template_name, context)
 
     def post(self, request, *args, **kwargs):
         survey = kwargs.get("survey")
-        form = ResponseForm(
-            request.POST,
-            survey=self.survey,
-            user=request.user,
-            step=self.step,
-            session_data=self.session_data
-        )
+        with timer("form"):
+            form = ResponseForm(
+                request.POST,
+                survey=self.survey,
+                user=request.user,
+                step=self.step,
+                session_data=self.session_data
+            )
+            is_valid = form.is_valid()
         context = {"response_form": form, "survey": survey}
-        if form.is_valid():
+        if is_valid:
             return self.treat_valid_form(form, kwargs, request, self.survey)
         return self.handle_invalid_form(context, request)
 
@@ -111,12 +142,10 @@ class SurveyDetail(View):
         return render(request, template_name, context)
 
     def treat_valid_form(self, form, kwargs, request, survey):
-        session_key = self.session_key
+        draft_store = get_draft_store()
 
-        # Saving data in session
-        for key, value in list(form.cleaned_data.items()):
-            request.session[session_key][key] = value
-            request.session.modified = True
+        # Saving the answers of this step in the draft
+        draft_store.save(request.user.id, survey.id, form.cleaned_data)
         request_step = request.POST['step_type']
         if request_step == 'Prev!':
             # if there is previous step
@@ -140,20 +169,42 @@ class SurveyDetail(View):
                 return redirect(next_)        
 
         response = None
+        accepted = False
         # when it's the last step
         if not form.has_next_step():
+            draft = draft_store.load_all(request.user.id, survey.id)
             save_form = ResponseForm(
-                request.session[session_key],
+                draft,
                 survey=survey,
                 user=request.user,
-                session_data=self.session_data
+                session_data=self.session_data,
+                draft_data=draft
             )
             if save_form.is_valid():
-                response = save_form.save()
+                with timer("save"):
+                    if buffer.is_enabled():
+                        try:
+                            buffer.enqueue(save_form)
+                        except IntegrityError:
+                            # Submitted twice, the first one is pending
+                            pass
+                        accepted = True
+                    else:
+                        try:
+                            response = save_form.save()
+                        except IntegrityError:
+                            # Saved meanwhile, e.g. by the
+                            # finalize_expired_attempts command
+                            response = Response.objects.get(
+                                survey=survey, user=request.user)
             else:
                 LOGGER.warning("A step of the multipage form failed",
                 "but should have been discovered before.")
-        del request.session[session_key]
+        # Set by the previous versions
+        request.session.pop(self.session_key, None)
+        draft_store.clear_all(request.user.id, survey.id)
+        if accepted:
+            return redirect("survey-accepted", id=survey.id)
         if response is None:
             return redirect(reverse("survey-list"))
         return redirect("survey-confirmation", response_id=response.id)
@@ -168,6 +219,102 @@ class ConfirmView(TemplateView):
         return context
 
 
+class SubmissionAccepted(View):
+    """
+    View for a submission accepted by the write-behind buffer: shows the
+    confirmation of the response once flushed.
+    """
+
+    def get(self, request, *args, **kwargs):
+        response = Response.objects.filter(
+            survey_id=kwargs['id'], user=request.user).first()
+        if response is not None:
+            name = "survey-confirmation"
+            if response.response_type == ResponseType.TIMEUP:
+                name = "survey-timeout"
+            return redirect(name, response_id=response.id)
+        pending = get_object_or_404(
+            PendingSubmission.objects.select_related("survey"),
+            survey_id=kwargs['id'], user=request.user)
+        template_name = 'survey/accepted.html'
+        context = {}
+        context['survey'] = pending.survey
+        context['pending'] = pending
+        return render(request, template_name, context)
+
+
+class SurveyResults(TemplateView):
+    """
+    View showing the results of a survey from its tallies.
+    """
+    template_name = 'survey/results.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        survey = get_object_or_404(Survey, id=kwargs['id'])
+        results = get_results(survey)
+        questions = []
+        answered = results["questions"]
+        for question in get_compiled_survey(survey).questions:
+            questions.append({
+                "question": question,
+                "submitted": answered.get(
+                    (question.pk, ResponseType.SUBMITTED), 0),
+                "timeup": answered.get((question.pk, ResponseType.TIMEUP), 0),
+                "choices": [
+                    {
+                        "label": label,
+                        "submitted": results["choices"].get(
+                            (question.pk, slug, ResponseType.SUBMITTED), 0),
+                        "timeup": results["choices"].get(
+                            (question.pk, slug, ResponseType.TIMEUP), 0),
+                    }
+                    for slug, label in question.get_choices()
+                ],
+            })
+        context['survey'] = survey
+        context['tally'] = results["tally"]
+        context['questions'] = questions
+        return context
+
+
+class SurveyLive(TemplateView):
+    """
+    Live dashboard of the responses of a survey, updated by the events of
+    survey_live_stream.
+    """
+    template_name = 'survey/live.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        survey = get_object_or_404(Survey, id=kwargs['id'])
+        context['survey'] = survey
+        context['snapshot'] = get_snapshot(survey.pk)
+        return context
+
+
+@staff_member_required
+@read_replica
+def survey_live_stream(request, id: int):
+    """
+    API endpoint streaming the live data of a survey as server-sent events,
+    see survey.live.
+    """
+    survey = get_object_or_404(Survey, id=id)
+    # A long stream holds a worker thread, and would block the event loop
+    # under ASGI: by default send one snapshot and let the browser reconnect
+    duration = 0
+    if long_streams_enabled() and not isinstance(request, ASGIRequest):
+        duration = None
+    response = StreamingHttpResponse(
+        iter_events(survey.pk, request.headers.get("Last-Event-ID"), duration),
+        content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Not buffered by nginx
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 class SurveyPerticipated(TemplateView):
 
     template_name = 'survey/participated.html'
@@ -196,23 +343,268 @@ def timeout(request, id: int):
     API endpoint for saving user input from session of a survey when 
     the survey time is out.
     """
+    return save_timeout(request, id)
+
 
+def save_timeout(request, id):
+    """
+    Save the draft of the user as a TIMEUP response, shared by the sync and
+    async timeout endpoints.
+    """
     session_key = 'survey_{}_{}'.format(request.user.id, id)
     survey = get_object_or_404(Survey, id=id)
-    if session_key in request.session:
-        request.session[session_key]['response_type'] = ResponseType.TIMEUP
-        session_data = request.session[session_key]
+    if has_participated(request.user, survey.id):
+        # Already saved, e.g. by the finalize_expired_attempts command
+        response = Response.objects.filter(
+            survey=survey, user=request.user).first()
+        request.session.pop(session_key, None)
+        if response is None:
+            return _accepted_response(survey, status=200)
+        return JsonResponse(
+            {"status": "success", "response_id": response.id}, status=200)
+    if Attempt.objects.filter(survey=survey, user=request.user).exists():
+        draft_store = get_draft_store()
+        draft = draft_store.load_all(request.user.id, survey.id)
         save_form = ResponseForm(
-            request.session[session_key],
+            draft,
             survey=survey,
             user=request.user,
-            session_data=session_data
+            session_data={'response_type': ResponseType.TIMEUP},
+            draft_data=draft
         )
         if save_form.is_valid():
-            response = save_form.save()
-            del request.session[session_key]
+            if buffer.is_enabled():
+                with timer("save"):
+                    try:
+                        buffer.enqueue(save_form)
+                    except IntegrityError:
+                        pass
+                request.session.pop(session_key, None)
+                draft_store.clear_all(request.user.id, survey.id)
+                return _accepted_response(survey, status=200)
+            try:
+                with timer("save"):
+                    response = save_form.save()
+            except IntegrityError:
+                # Saved meanwhile, e.g. by the finalize_expired_attempts
+                # command
+                response = Response.objects.get(
+                    survey=survey, user=request.user)
+            request.session.pop(session_key, None)
+            draft_store.clear_all(request.user.id, survey.id)
             return JsonResponse(
                 {"status": "success", "response_id": response.id},
                 status=200)
-        else:
-            return JsonResponse({"status": "fail"}, status=400)
+    return JsonResponse({"status": "fail"}, status=400)
+
+
+@staff_member_required
+@read_replica
+def export_responses(request, id: int):
+    """
+    API endpoint streaming the responses of a survey as CSV or JSON lines.
+    Use '?format=jsonl' for JSON lines and '?gzip=1' to compress.
+    """
+    survey = get_object_or_404(Survey, id=id)
+    export_format = request.GET.get("format", "csv")
+    if export_format not in FORMATS:
+        return HttpResponseBadRequest(f"Unknown format '{export_format}'")
+    compress = request.GET.get("gzip") in ["1", "true"]
+
+    filename = "survey_{}.{}".format(survey.id, export_format)
+    content_type = CONTENT_TYPES[export_format]
+    if compress:
+        filename += ".gz"
+        content_type = "application/gzip"
+    response = StreamingHttpResponse(
+        iter_export(survey, export_format=export_format, compress=compress),
+        content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(
+        filename)
+    return response
+
+
+@require_GET
+@staff_member_required
+@read_replica
+def survey_search(request, id: int):
+    """
+    API endpoint searching the answers to the text questions of a survey,
+    best matches first. Use '?q=<words>', '&question=<id>' to search the
+    answers to one question and '&page=<n>' for the next pages.
+    """
+    survey = get_object_or_404(Survey, id=id)
+    try:
+        page = int(request.GET.get("page", 1))
+        question_id = None
+        if request.GET.get("question"):
+            question_id = int(request.GET["question"])
+    except ValueError:
+        return JsonResponse({"status": "fail", "error": "invalid"}, status=400)
+    with timer("search"):
+        results = search_answers(
+            request.GET.get("q", ""), survey_id=survey.pk,
+            question_id=question_id, page=page)
+    return JsonResponse({
+        "query": results.query,
+        "page": results.page,
+        "has_next": results.has_next,
+        "results": [
+            {
+                "answer_id": hit.answer_id,
+                "response_id": hit.response_id,
+                "question_id": hit.question_id,
+                "user_id": hit.user_id,
+                "body": hit.body,
+                "highlight": highlight(hit.snippet),
+                "score": hit.score,
+            }
+            for hit in results.hits
+        ],
+    })
+
+
+def _get_open_survey(id):
+    survey = get_object_or_404(Survey, id=id, is_active=True)
+    if survey.expire_date and survey.expire_date < timezone.now():
+        raise Http404
+    return survey
+
+
+def _accepted_response(survey, status=202):
+    return JsonResponse(
+        {"status": "accepted",
+         "redirect_url": reverse("survey-accepted", kwargs={"id": survey.id})},
+        status=status)
+
+
+def _participated_response(user, survey):
+    response = Response.objects.filter(survey=survey, user=user).first()
+    if response is None:
+        # Accepted by the write-behind buffer, not flushed yet
+        return JsonResponse(
+            {"status": "fail", "error": "participated", "pending": True,
+             "redirect_url": reverse(
+                 "survey-accepted", kwargs={"id": survey.id})},
+            status=409)
+    return JsonResponse(
+        {"status": "fail", "error": "participated",
+         "response_id": response.id},
+        status=409)
+
+
+@require_GET
+@staff_member_required
+def survey_manifest(request, id: int):
+    """
+    API endpoint returning the whole survey at once, so a client can render
+    the steps itself and submit all the answers with survey_submit. Starts
+    the attempt of the user.
+    """
+    survey = _get_open_survey(id)
+    if has_participated(request.user, survey.pk):
+        return _participated_response(request.user, survey)
+    attempt = Attempt.start(request.user, survey)
+    schema = get_compiled_survey(survey)
+    # Sets the CSRF cookie needed to submit
+    get_token(request)
+    return JsonResponse({
+        "id": survey.id,
+        "title": survey.title,
+        "description": survey.description,
+        "duration": survey.duration,
+        "deadline": attempt.deadline.isoformat(),
+        "version": schema.digest,
+        "submit_url": reverse("api-survey-submit", kwargs={"id": survey.id}),
+        "questions": [
+            {
+                "id": question.pk,
+                "field_name": question.field_name,
+                "text": question.text,
+                "type": question.question_type,
+                "choices": [
+                    {"value": slug, "label": label}
+                    for slug, label in question.get_choices()
+                ],
+            }
+            for question in schema.questions
+        ],
+    })
+
+
+@require_POST
+@staff_member_required
+def survey_submit(request, id: int):
+    """
+    API endpoint saving all the answers of a survey at once. Expects a JSON
+    body like {"version": <manifest version>, "answers": {"question_<id>":
+    value}}, where a multiple select value is a list of choice values.
+    The answers are validated by ResponseForm and saved in one transaction,
+    or accepted by the write-behind buffer (202) with SURVEY_WRITE_BEHIND.
+    """
+    survey = _get_open_survey(id)
+    try:
+        payload = json.loads(request.body)
+        answers = payload["answers"]
+        if not isinstance(answers, dict):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"status": "fail", "error": "invalid"}, status=400)
+
+    if has_participated(request.user, survey.pk):
+        return _participated_response(request.user, survey)
+    schema = get_compiled_survey(survey)
+    if payload.get("version") != schema.digest:
+        # The questions changed since the client got the manifest
+        return JsonResponse(
+            {"status": "fail", "error": "version", "version": schema.digest},
+            status=409)
+
+    session_data = {}
+    attempt = Attempt.objects.filter(survey=survey, user=request.user).first()
+    if attempt is not None and attempt.deadline < timezone.now():
+        session_data["response_type"] = ResponseType.TIMEUP
+    with timer("form"):
+        form = ResponseForm(
+            answers,
+            survey=survey,
+            user=request.user,
+            session_data=session_data,
+            draft_data={}
+        )
+        is_valid = form.is_valid()
+    if not is_valid:
+        return JsonResponse(
+            {"status": "fail", "errors": form.errors.get_json_data()},
+            status=400)
+    write_behind = buffer.is_enabled()
+    try:
+        with timer("save"):
+            response = buffer.enqueue(form) if write_behind else form.save()
+    except ValidationError as error:
+        return JsonResponse(
+            {"status": "fail", "errors": error.messages}, status=400)
+    except IntegrityError:
+        # Another request of the same user saved a response meanwhile
+        return _participated_response(request.user, survey)
+
+    request.session.pop(
+        'survey_{}_{}'.format(request.user.id, survey.id), None)
+    get_draft_store().clear_all(request.user.id, survey.id)
+    if write_behind:
+        return _accepted_response(survey)
+    return JsonResponse(
+        {"status": "success", "response_id": response.id,
+         "response_type": response.response_type},
+        status=201)
+
+
+@staff_member_required
+def metrics(request):
+    """
+    Request metrics of all the worker processes in the Prometheus text
+    format.
+    """
+    return HttpResponse(
+        render_prometheus(collect()),
+        content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,139 @@
+"""
+Warm-up of a worker process at startup.
+
+When SURVEY_WARMUP is on, SurveyConfig.ready() runs warm_up() so the first
+requests of a new worker don't pay for:
+
+- building the URL resolver,
+- loading and parsing the templates of the survey app (kept by the cached
+  template loader, so this is only useful with DEBUG off),
+- compiling the question sets of the open surveys (SURVEY_WARMUP_SURVEYS
+  at most, newest first) and rendering the markup of their first step,
+  which also loads the form widget templates.
+
+The database connections opened by the warm-up are closed, so they aren't
+shared with processes forked afterwards. Database errors (e.g. before the
+first migration) are logged and skip the rest of the stage.
+"""
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.db import DatabaseError, connections
+from django.db.models import Q
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+from django.urls import NoReverseMatch, get_resolver, reverse
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+# Report of the last warm-up of the process, stage -> (seconds, count)
+last_report = None
+
+
+def warm_urls():
+    resolver = get_resolver()
+    # Fills the reverse and the namespace dicts
+    reverse("survey-list")
+    # reverse() builds and caches a resolver by namespace, e.g. for
+    # {% url 'admin:logout' %} in the base template
+    namespaces = [("", resolver)]
+    while namespaces:
+        prefix, namespace_resolver = namespaces.pop()
+        name = next((key for key in namespace_resolver.reverse_dict
+                     if isinstance(key, str)), None)
+        if prefix and name:
+            try:
+                reverse(prefix + name)
+            except NoReverseMatch:
+                pass
+        namespace_dict = namespace_resolver.namespace_dict
+        for namespace, (_, sub_resolver) in namespace_dict.items():
+            namespaces.append((f"{prefix}{namespace}:", sub_resolver))
+    return len(resolver.url_patterns)
+
+
+def get_template_names():
+    """
+    Return the names of the templates of the survey app.
+    """
+    directory = Path(apps.get_app_config("survey").path) / "templates"
+    return sorted(path.relative_to(directory).as_posix()
+                  for path in directory.rglob("*.html"))
+
+
+def warm_templates():
+    count = 0
+    for name in get_template_names():
+        try:
+            get_template(name)
+        except (TemplateDoesNotExist, TemplateSyntaxError) as error:
+            LOGGER.warning("Can't load template %s: %s", name, error)
+            continue
+        count += 1
+    return count
+
+
+def get_open_surveys(limit):
+    from survey.models import Survey
+    return list(Survey.objects.filter(is_active=True).filter(
+        Q(expire_date__isnull=True) | Q(expire_date__gt=timezone.now())
+    ).order_by("-pk")[:limit])
+
+
+def warm_surveys(limit):
+    from survey.forms import ResponseForm
+    from survey.rendering import render_question
+
+    surveys = get_open_surveys(limit)
+    for survey in surveys:
+        # Compiles the survey and renders the markup of its first step
+        form = ResponseForm(
+            survey=survey, user=AnonymousUser(), step=0, session_data={},
+            draft_data={})
+        for bound_field in form:
+            render_question(bound_field)
+    return len(surveys)
+
+
+def warm_up(surveys=None):
+    """
+    Warm the process up and log the time of each stage.
+
+    :param int surveys: Maximum number of surveys to preload,
+        SURVEY_WARMUP_SURVEYS by default.
+    :rtype: OrderedDict stage -> (seconds, count)
+    """
+    global last_report
+    from django.conf import settings
+
+    if surveys is None:
+        surveys = getattr(settings, "SURVEY_WARMUP_SURVEYS", 50)
+    stages = [
+        ("urls", warm_urls),
+        ("templates", warm_templates),
+        ("surveys", lambda: warm_surveys(surveys)),
+    ]
+    report = OrderedDict()
+    for name, stage in stages:
+        start = time.perf_counter()
+        try:
+            count = stage()
+        except DatabaseError as error:
+            LOGGER.warning("Warm-up stage %s failed: %s", name, error)
+            count = 0
+        report[name] = (time.perf_counter() - start, count)
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+
+    last_report = report
+    LOGGER.info(
+        "Warm-up in %.3fs: %s", sum(seconds for seconds, _ in report.values()),
+        ", ".join(f"{name} {seconds:.3f}s ({count})"
+                  for name, (seconds, count) in report.items()))
+    return report